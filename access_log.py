@@ -0,0 +1,466 @@
+#!/usr/bin/python3
+
+import bisect
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple, Counter, OrderedDict
+from enum import IntEnum
+
+# every access attempt the centrals report, with the door it was at, kept in
+# append-only segment files.
+# A segment is a row of zlib blocks, each with a header: compressed length, record
+# count, earliest and latest time of its records. The segment's .idx file holds
+# the offset and header of every block, so a query only decompresses the blocks
+# overlapping its time range.
+# Records are kept in the order they were recorded. That is time order unless the
+# clock was stepped, like on a Pi without an RTC, so blocks may overlap in time.
+# Records come in through a queue and are written by a thread of their own, the
+# serial loop never waits for the disk.
+
+
+class AccessKind(IntEnum):
+    # authenticated, the door opened
+    OPENED = 1
+    # authenticated with a bond that isn't in the database
+    UNKNOWN = 2
+    # connected and disconnected without authenticating
+    FAILED = 3
+
+
+# name is None for FAILED and UNKNOWN, reason is the HCI disconnect reason of FAILED,
+# door is the door of the central that reported it, None if it wasn't told
+class AccessRecord(namedtuple('AccessRecord', ['time', 'kind', 'address', 'name',
+                                               'battery_level', 'reason', 'door'])):
+    __slots__ = ()
+
+
+_NO_NAME = 0xffff
+_BLOCK = struct.Struct('<IIdd')
+# offset of the block in the segment, then its header
+_INDEX = struct.Struct('<QIIdd')
+
+
+# the records of a block stored column by column: times (double), kinds, addresses
+# (6 bytes each), battery levels, reasons, positions in the names and in the doors
+# (uint16), then the names and the doors of the block. Queries search the kind and
+# name columns without building a record for every row.
+# ordered is whether the times never go backwards within the block
+class _Columns(namedtuple('_Columns', ['times', 'kinds', 'addresses', 'battery_levels',
+                                       'reasons', 'name_pos', 'door_pos', 'names', 'doors',
+                                       'ordered'])):
+    __slots__ = ()
+
+    def record(self, i):
+        pos = int.from_bytes(self.name_pos[2 * i:2 * i + 2], 'little')
+        door = int.from_bytes(self.door_pos[2 * i:2 * i + 2], 'little')
+        return AccessRecord(self.times[i], AccessKind(self.kinds[i]),
+                            self.addresses[6 * i:6 * i + 6].hex(':').upper(),
+                            None if pos == _NO_NAME else self.names[pos],
+                            self.battery_levels[i], self.reasons[i],
+                            None if door == _NO_NAME else self.doors[door])
+
+    # positions of the rows with t1 <= time <= t2
+    def between(self, t1, t2):
+        if self.ordered:
+            return range(bisect.bisect_left(self.times, t1), bisect.bisect_right(self.times, t2))
+        return [i for i, t in enumerate(self.times) if t1 <= t <= t2]
+
+    # positions of the rows with `kind` and t1 <= time <= t2
+    def find_kind(self, kind, t1, t2):
+        rows = self.between(t1, t2)
+        if not self.ordered:
+            yield from (i for i in rows if self.kinds[i] == kind)
+            return
+        i = self.kinds.find(kind, rows.start, rows.stop)
+        while i >= 0:
+            yield i
+            i = self.kinds.find(kind, i + 1, rows.stop)
+
+    # position of the last row of the name at `pos`, -1 if there is none
+    def rfind_name(self, pos):
+        needle = pos.to_bytes(2, 'little')
+        i = self.name_pos.rfind(needle)
+        # a match across two rows
+        while i % 2:
+            i = self.name_pos.rfind(needle, 0, i + 1)
+        return i // 2 if i >= 0 else -1
+
+
+# the strings of one column of records as (their positions, the distinct strings)
+def _strings(values):
+    strings = []
+    string_pos = {}
+    positions = []
+    for value in values:
+        if value is None:
+            positions.append(_NO_NAME)
+        else:
+            pos = string_pos.get(value)
+            if pos is None:
+                pos = string_pos[value] = len(strings)
+                strings.append(value)
+            positions.append(pos)
+    return positions, strings
+
+
+def _payload(records):
+    name_pos, names = _strings(r[3] for r in records)
+    door_pos, doors = _strings(r[6] for r in records)
+    n = len(records)
+    return b''.join([
+        struct.pack('<{}d'.format(n), *(r[0] for r in records)),
+        bytes(r[1] for r in records),
+        b''.join(bytes.fromhex(r[2].replace(':', '')) for r in records),
+        bytes(r[4] for r in records),
+        bytes(r[5] for r in records),
+        struct.pack('<{}H'.format(n), *name_pos),
+        struct.pack('<{}H'.format(n), *door_pos),
+        '\n'.join(names).encode('utf8'), b'\0', '\n'.join(doors).encode('utf8'),
+    ])
+
+
+def _columns(payload, n):
+    ends = [8 * n, 9 * n, 15 * n, 16 * n, 17 * n, 19 * n, 21 * n]
+    names, doors = payload[ends[6]:].decode('utf8').split('\0')
+    times = struct.unpack_from('<{}d'.format(n), payload)
+    return _Columns(
+        times, payload[ends[0]:ends[1]],
+        payload[ends[1]:ends[2]], payload[ends[2]:ends[3]], payload[ends[3]:ends[4]],
+        payload[ends[4]:ends[5]], payload[ends[5]:ends[6]],
+        names.split('\n') if names else [], doors.split('\n') if doors else [],
+        all(a <= b for a, b in zip(times, times[1:])))
+
+
+def _pack_block(records):
+    payload = zlib.compress(_payload(records))
+    times = [r[0] for r in records]
+    return _BLOCK.pack(len(payload), len(records), min(times), max(times)) + payload
+
+
+# the blocks of one segment file as (offset, length, count, earliest, latest), the index
+# is brought up to date with the segment when opened and a block torn by a crash is cut off
+class _Segment:
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename[:-len('.seg')] + '.idx'
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        blocks = []
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                data = f.read()
+            blocks = [block for block in
+                      _INDEX.iter_unpack(data[:len(data) - len(data) % _INDEX.size])
+                      if block[0] + _BLOCK.size + block[1] <= size]
+        end = blocks[-1][0] + _BLOCK.size + blocks[-1][1] if blocks else 0
+        # blocks written after the last index entry
+        with open(filename, 'ab+') as f:
+            f.seek(end)
+            while True:
+                header = f.read(_BLOCK.size)
+                if len(header) < _BLOCK.size:
+                    break
+                length, count, first, last = _BLOCK.unpack(header)
+                if end + _BLOCK.size + length > size:
+                    break
+                blocks.append((end, length, count, first, last))
+                end += _BLOCK.size + length
+                f.seek(end)
+            if end < size:
+                f.truncate(end)
+        with open(self.index_filename, 'wb') as f:
+            f.write(b''.join(_INDEX.pack(*block) for block in blocks))
+        self.blocks = blocks
+        self.size = end
+
+    def first_time(self):
+        return self.blocks[0][3] if self.blocks else None
+
+    # write a packed block, the segment before its index entry, returns the entry
+    def append(self, block, data_file, index_file):
+        length, count, first, last = _BLOCK.unpack_from(block)
+        entry = (self.size, length, count, first, last)
+        data_file.write(block)
+        data_file.flush()
+        os.fsync(data_file.fileno())
+        index_file.write(_INDEX.pack(*entry))
+        index_file.flush()
+        self.blocks.append(entry)
+        self.size += len(block)
+        return entry
+
+
+class AccessLog:
+    # records per block, and the longest a record waits in memory for its block
+    BLOCK_RECORDS = 256
+    FLUSH_INTERVAL = 10
+    # a new segment is started when the current one is this big or old
+    SEGMENT_SIZE = 4 * 1024 * 1024
+    SEGMENT_SECONDS = 30 * 24 * 3600
+    # decoded blocks kept for the next query, about a year of a busy door
+    CACHE_BLOCKS = 512
+
+    def __init__(self, directory='access_log'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._segments = [_Segment(os.path.join(directory, f))
+                          for f in sorted(os.listdir(directory)) if f.endswith('.seg')]
+        # blocks of all segments as (latest, earliest, segment, offset, length, count),
+        # in the order they were written
+        self._blocks = []
+        # whether every block is later than the ones before it, as long as the clock
+        # was never stepped back
+        self._ordered = True
+        for segment in self._segments:
+            for offset, length, count, first, last in segment.blocks:
+                self._add_block(last, first, segment, offset, length, count)
+        # records handed to the writer but not in a block yet
+        self._pending = []
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._files = None
+        self._cache = OrderedDict()
+        # what stopped the writer thread
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _add_block(self, *block):
+        if self._blocks and block[1] < self._blocks[-1][0]:
+            self._ordered = False
+        self._blocks.append(block)
+
+    def _check_writer(self):
+        if self._error is not None:
+            raise OSError("access log writer stopped: {}".format(self._error)) from self._error
+
+    # returns at once, the record is written by the writer thread
+    # raises ValueError for a record that doesn't fit the columns, so a garbled one
+    # is refused here instead of stopping the writer, and OSError once the writer
+    # stopped on an error
+    def record(self, kind, address, name=None, battery_level=0, reason=0, t=None,
+               door=None):
+        self._check_writer()
+        kind = AccessKind(kind)
+        try:
+            raw = bytes.fromhex(address.replace(':', ''))
+        except (AttributeError, ValueError):
+            raw = b''
+        if len(raw) != 6:
+            raise ValueError("address {!r} is not 6 bytes".format(address))
+        for field, value in (('battery level', battery_level), ('reason', reason)):
+            if not 0 <= value <= 255:
+                raise ValueError("{} {} is out of 0..255".format(field, value))
+        for field, value in (('name', name), ('door', door)):
+            if value is not None and ('\n' in value or '\0' in value):
+                raise ValueError("{} {!r} has a line break or NUL".format(field, value))
+        self._queue.put((time.time() if t is None else t, int(kind), address,
+                         name, int(battery_level), int(reason), door))
+
+    def _open_files(self, segment):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+        self._files = (open(segment.filename, 'ab'), open(segment.index_filename, 'ab'))
+
+    def _current_segment(self, first):
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.size >= self.SEGMENT_SIZE or (
+                segment.blocks and first - segment.first_time() >= self.SEGMENT_SECONDS):
+            # numbered, a name from the time would sort a segment started after
+            # the clock was stepped back before the ones written earlier
+            segment = _Segment(os.path.join(
+                self.directory, 'access-{:08d}.seg'.format(
+                    int(os.path.basename(segment.filename)[7:-4]) + 1 if segment else 0)))
+            self._segments.append(segment)
+            self._open_files(segment)
+        elif self._files is None:
+            self._open_files(segment)
+        return segment
+
+    def _write_block(self):
+        with self._lock:
+            records = list(self._pending)
+        segment = self._current_segment(records[0][0])
+        offset, length, count, first, last = segment.append(
+            _pack_block(records), *self._files)
+        with self._lock:
+            self._add_block(last, first, segment, offset, length, count)
+            del self._pending[:count]
+
+    # records not written when the disk fails stay pending, they are still found
+    # by the queries until the log is closed. Whatever stops the writer is kept,
+    # record() and close() raise it instead of records being dropped silently
+    def _write_loop(self):
+        try:
+            self._write_records()
+        except Exception as e:
+            self._error = e
+
+    def _write_records(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.FLUSH_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item:
+                with self._lock:
+                    self._pending.append(item)
+                if len(self._pending) < self.BLOCK_RECORDS:
+                    continue
+            if self._pending:
+                self._write_block()
+            if item is None:
+                break
+
+    # write what is left and stop the writer, raises OSError if it failed
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+        self._check_writer()
+
+    # columns of the blocks that overlap [t1, t2], in the order they were written
+    # or newest first
+    def _columns(self, t1, t2, newest_first=False):
+        with self._lock:
+            blocks = list(self._blocks)
+            pending = list(self._pending)
+            ordered = self._ordered
+        if ordered:
+            # blocks in time order, the ones that matter are found by bisection
+            start = bisect.bisect_left(blocks, (t1,))
+            end = start
+            while end < len(blocks) and blocks[end][1] <= t2:
+                end += 1
+            blocks = blocks[start:end]
+        else:
+            blocks = [block for block in blocks if block[0] >= t1 and block[1] <= t2]
+        if newest_first:
+            blocks.reverse()
+            if pending:
+                yield _columns(_payload(pending), len(pending))
+        handles = {}
+        try:
+            for last, first, segment, offset, length, count in blocks:
+                key = (segment.filename, offset)
+                columns = self._cache.get(key)
+                if columns is None:
+                    f = handles.get(segment)
+                    if f is None:
+                        f = handles[segment] = open(segment.filename, 'rb')
+                    f.seek(offset + _BLOCK.size)
+                    columns = _columns(zlib.decompress(f.read(length)), count)
+                    self._cache[key] = columns
+                    if len(self._cache) > self.CACHE_BLOCKS:
+                        self._cache.popitem(last=False)
+                else:
+                    self._cache.move_to_end(key)
+                yield columns
+        finally:
+            for f in handles.values():
+                f.close()
+        if pending and not newest_first:
+            yield _columns(_payload(pending), len(pending))
+
+    # records with t1 <= time <= t2 in the order they were recorded, either bound can be None,
+    # only the ones of `door` unless that is None
+    def records(self, t1=None, t2=None, door=None):
+        t1 = float('-inf') if t1 is None else t1
+        t2 = float('inf') if t2 is None else t2
+        for columns in self._columns(t1, t2):
+            if door is not None and door not in columns.doors:
+                continue
+            for i in columns.between(t1, t2):
+                record = columns.record(i)
+                if door is None or record.door == door:
+                    yield record
+
+    # who opened the door, or any door if it is None, between t1 and t2
+    def opened_between(self, t1, t2, door=None):
+        return [r for r in self.records(t1, t2, door) if r.kind != AccessKind.FAILED]
+
+    # {name: AccessRecord} of every member's latest access
+    def last_access(self):
+        last = {}
+        for columns in self._columns(float('-inf'), float('inf'), newest_first=True):
+            for name in set(columns.names).difference(last):
+                last[name] = columns.record(columns.rfind_name(columns.names.index(name)))
+        return last
+
+    # {address: number of failed connections} between t1 and t2
+    def failed_connections(self, t1=None, t2=None):
+        t1 = float('-inf') if t1 is None else t1
+        t2 = float('inf') if t2 is None else t2
+        failed = Counter()
+        for columns in self._columns(t1, t2):
+            for i in columns.find_kind(AccessKind.FAILED, t1, t2):
+                failed[columns.addresses[6 * i:6 * i + 6]] += 1
+        return Counter({address.hex(':').upper(): n for address, n in failed.items()})
+
+
+# a year of door traffic: members coming in during the day and some failed connections
+def _bench_year(directory=None, per_day=300, members=200):
+    import random
+    import tempfile
+    directory = directory or tempfile.mkdtemp()
+    log = AccessLog(directory)
+    names = ['member{}'.format(i) for i in range(members)]
+    addresses = ['C0:00:00:00:{:02X}:{:02X}'.format(i >> 8, i & 0xff) for i in range(members)]
+    now = time.time()
+    start = now - 365 * 24 * 3600
+    count = 365 * per_day
+    written = time.perf_counter()
+    for i in range(count):
+        t = start + i * (365 * 24 * 3600) / count
+        member = random.randrange(members)
+        door = random.choice(('front', 'workshop'))
+        if random.random() < 0.05:
+            log.record(AccessKind.FAILED, addresses[member], None, 0, 0x13, t, door)
+        else:
+            log.record(AccessKind.OPENED, addresses[member], names[member],
+                       random.randrange(101), 0, t, door)
+    queued = time.perf_counter() - written
+    log.close()
+    written = time.perf_counter() - written
+    size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+    print("{} records: queued in {:.0f} ms ({:.1f} us each), on disk after {:.0f} ms, "
+          "{} bytes".format(count, queued * 1000, queued / count * 1e6, written * 1000, size))
+
+    start_open = time.perf_counter()
+    log = AccessLog(directory)
+    print("open: {:.1f} ms".format((time.perf_counter() - start_open) * 1000))
+    for title, query in [
+            ("opened in one hour", lambda: len(log.opened_between(now - 86400 * 100,
+                                                                  now - 86400 * 100 + 3600))),
+            ("opened in one week", lambda: len(log.opened_between(now - 86400 * 7, now))),
+            ("last access per member", lambda: len(log.last_access())),
+            ("failed connections", lambda: sum(log.failed_connections().values())),
+            ("last access, cached", lambda: len(log.last_access())),
+            ("failed connections, cached", lambda: sum(log.failed_connections().values()))]:
+        started = time.perf_counter()
+        result = query()
+        print("{}: {} in {:.1f} ms".format(title, result, (time.perf_counter() - started) * 1000))
+    log.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_year(*sys.argv[2:3])
+    elif len(sys.argv) >= 2:
+        # access_log.py <directory> [t1 t2]: who opened which door
+        log = AccessLog(sys.argv[1])
+        t1, t2 = (float(t) for t in sys.argv[2:4]) if len(sys.argv) >= 4 else (None, None)
+        for r in log.records(t1, t2):
+            print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r.time)),
+                  r.door or '', r.kind.name, r.address, r.name or '', r.battery_level)
+        log.close()
+    else:
+        print("usage: {} bench | <directory> [t1 t2]".format(sys.argv[0]))
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from key_db import _write_atomic
+
+# battery readings of every coin the central talks to. Each coin keeps its latest
+# readings, one mean per day and one per week, each in a ring buffer of fixed
+# size, so the store doesn't grow however long it runs.
+# The discharge slope is fitted to the daily means whenever a day is finished,
+# a forecast only divides.
+
+DAY = 24 * 3600
+WEEK = 7 * DAY
+
+
+# the last `capacity` (time, value) pairs in two preallocated arrays
+class RingBuffer:
+    __slots__ = ('times', 'values', 'start', 'size')
+
+    def __init__(self, capacity):
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('f', bytes(4 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, t, value):
+        capacity = len(self.times)
+        i = (self.start + self.size) % capacity
+        self.times[i] = t
+        self.values[i] = value
+        if self.size < capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % capacity
+
+    # (time, value) pairs, oldest first
+    def items(self):
+        capacity = len(self.times)
+        for n in range(self.size):
+            i = (self.start + n) % capacity
+            yield self.times[i], self.values[i]
+
+    def last(self):
+        if not self.size:
+            return None
+        i = (self.start + self.size - 1) % len(self.times)
+        return self.times[i], self.values[i]
+
+
+# mean of the readings in the current period, pushed to a ring when the period is over
+class _Rollup:
+    __slots__ = ('period', 'ring', 'current', 'total', 'count')
+
+    def __init__(self, period, capacity):
+        self.period = period
+        self.ring = RingBuffer(capacity)
+        self.current = None
+        self.total = 0.0
+        self.count = 0
+
+    # returns whether a period was finished
+    def add(self, t, value):
+        period = int(t // self.period)
+        finished = self.current is not None and period != self.current
+        if finished:
+            self.ring.append((self.current + 0.5) * self.period, self.total / self.count)
+            self.total = 0.0
+            self.count = 0
+        self.current = period
+        self.total += value
+        self.count += 1
+        return finished
+
+    # the finished periods and the running one
+    def items(self):
+        yield from self.ring.items()
+        if self.count:
+            yield (self.current + 0.5) * self.period, self.total / self.count
+
+
+# least squares slope of (time, value) pairs in value per second, None for too few
+def _slope(points):
+    n = len(points)
+    if n < 2:
+        return None
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var = sum((t - mean_t) ** 2 for t, _ in points)
+    if var == 0:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / var
+
+
+class CoinSeries:
+    __slots__ = ('readings', 'daily', 'weekly', 'slope')
+
+    def __init__(self, readings, days, weeks):
+        self.readings = RingBuffer(readings)
+        self.daily = _Rollup(DAY, days)
+        self.weekly = _Rollup(WEEK, weeks)
+        # percent per day, negative while discharging
+        self.slope = None
+
+    def add(self, t, level, slope_days):
+        self.readings.append(t, level)
+        self.weekly.add(t, level)
+        if self.daily.add(t, level):
+            points = list(self.daily.ring.items())[-slope_days:]
+            slope = _slope(points)
+            self.slope = slope * DAY if slope is not None else None
+
+
+class BatteryStore:
+    # per coin: raw readings, days and weeks kept
+    READINGS = 64
+    DAYS = 90
+    WEEKS = 104
+    # coins kept, the one heard from longest ago is dropped first
+    MAX_COINS = 1024
+    # days the discharge slope is fitted to
+    SLOPE_DAYS = 30
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.coins = OrderedDict()
+        if filename is not None and os.path.exists(filename):
+            self._load()
+
+    def _series(self, address):
+        series = self.coins.get(address)
+        if series is None:
+            series = self.coins[address] = CoinSeries(self.READINGS, self.DAYS, self.WEEKS)
+            if len(self.coins) > self.MAX_COINS:
+                self.coins.popitem(last=False)
+        else:
+            self.coins.move_to_end(address)
+        return series
+
+    def add(self, address, level, t=None):
+        self._series(address).add(time.time() if t is None else t, level, self.SLOPE_DAYS)
+
+    def level(self, address):
+        series = self.coins.get(address)
+        last = series.readings.last() if series is not None else None
+        return last[1] if last is not None else None
+
+    # discharge in percent per day, None until the coin was seen on two days
+    def slope(self, address):
+        series = self.coins.get(address)
+        return series.slope if series is not None else None
+
+    # days until the coin is at `empty` percent, None when it isn't discharging
+    def days_left(self, address, empty=0, now=None):
+        series = self.coins.get(address)
+        if series is None or series.slope is None or series.slope >= 0:
+            return None
+        t, level = series.readings.last()
+        now = time.time() if now is None else now
+        return max(0.0, (level - empty) / -series.slope - (now - t) / DAY)
+
+    # [(address, level, days left)] of the coins empty within `days`, soonest first
+    def dying_within(self, days, empty=0, now=None):
+        dying = []
+        for address in self.coins:
+            left = self.days_left(address, empty, now)
+            if left is not None and left <= days:
+                dying.append((address, self.level(address), left))
+        return sorted(dying, key=lambda d: d[2])
+
+    def daily(self, address):
+        return list(self.coins[address].daily.items())
+
+    def weekly(self, address):
+        return list(self.coins[address].weekly.items())
+
+    def save(self):
+        coins = {}
+        for address, series in self.coins.items():
+            coins[address] = {
+                'readings': list(series.readings.items()),
+                'daily': list(series.daily.ring.items()),
+                'weekly': list(series.weekly.ring.items()),
+                'day': [series.daily.current, series.daily.total, series.daily.count],
+                'week': [series.weekly.current, series.weekly.total, series.weekly.count],
+                'slope': series.slope,
+            }
+        _write_atomic(self.filename, json.dumps(coins))
+
+    def _load(self):
+        with open(self.filename) as f:
+            coins = json.load(f)
+        for address, saved in coins.items():
+            series = self._series(address)
+            for ring, key in ((series.readings, 'readings'), (series.daily.ring, 'daily'),
+                              (series.weekly.ring, 'weekly')):
+                for t, value in saved[key]:
+                    ring.append(t, value)
+            series.daily.current, series.daily.total, series.daily.count = saved['day']
+            series.weekly.current, series.weekly.total, series.weekly.count = saved['week']
+            series.slope = saved['slope']
+
+
+# `days` of readings from many coins, each draining at its own rate
+def _fill(store, rates, start_t, days, per_day):
+    import random
+    for day in range(days):
+        for n in range(per_day):
+            t = start_t + day * DAY + n * DAY / per_day
+            for address, rate in rates.items():
+                store.add(address, round(max(0, 100 - rate * day + random.uniform(-2, 2))), t)
+
+
+def _bench_store(coins=300, per_day=4, days=365):
+    import random
+    import tracemalloc
+    rates = {'C0:00:00:00:{:02X}:{:02X}'.format(i >> 8, i & 0xff): random.uniform(0.05, 0.5)
+             for i in range(coins)}
+    start_t = time.time() - days * DAY
+    store = BatteryStore()
+    started = time.perf_counter()
+    _fill(store, rates, start_t, days, per_day)
+    elapsed = time.perf_counter() - started
+    count = coins * per_day * days
+    print("{} readings in {:.0f} ms, {:.1f} us each".format(
+        count, elapsed * 1000, elapsed / count * 1e6))
+
+    # the same coins after half the time and after all of it
+    tracemalloc.start()
+    sizes = []
+    for fill_days in (days // 2, days):
+        before = tracemalloc.get_traced_memory()[0]
+        _fill(BatteryStore(), rates, start_t, fill_days, 1)
+        sizes.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+    print("peak memory after {} days {:.0f} KiB, after {} days {:.0f} KiB".format(
+        days // 2, sizes[0] / 1024, days, sizes[1] / 1024))
+
+    now = start_t + days * DAY
+    started = time.perf_counter()
+    dying = store.dying_within(30, now=now)
+    print("{} coins die within 30 days, found in {:.2f} ms".format(
+        len(dying), (time.perf_counter() - started) * 1000))
+    errors = [abs(store.slope(address) + rate) for address, rate in rates.items()
+              if store.level(address) > 10]
+    if errors:
+        print("slope error of the coins still above 10%: {:.3f} %/day at most".format(
+            max(errors)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_store(*map(int, sys.argv[2:3]))
+    elif len(sys.argv) >= 2:
+        # battery.py <store file> [days]: coins that will be empty soon
+        store = BatteryStore(sys.argv[1])
+        for address, level, left in store.dying_within(float(sys.argv[2]) if len(sys.argv) >= 3
+                                                       else 30):
+            print(address, '{:.0f}%'.format(level), '{:.1f} days'.format(left))
+    else:
+        print("usage: {} bench [coins] | <store file> [days]".format(sys.argv[0]))
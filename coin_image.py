@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+import contextlib
+import os
+import re
+import weakref
+import sys
+import tempfile
+import time
+from key_db import open_db
+
+# the coin firmware reserves a flash range for its keys:
+# address (6 bytes, little endian like bt_addr_t), IRK (16), LTK (16), spacekey (32)
+# where it is depends on the build, the linker map of the firmware tells
+KEY_STORAGE_SIZE = 6 + 16 + 16 + 32
+KEY_STORAGE_SYMBOL = 'keykeeper_keys'
+
+# erase unit of the nRF52 flash, the key storage page holds nothing else worth keeping
+FLASH_PAGE_SIZE = 0x1000
+
+_DATA = 0x00
+_EOF = 0x01
+_EXT_SEGMENT = 0x02
+_EXT_LINEAR = 0x04
+_RECORD_SIZE = 16
+
+
+# key storage contents of a coin
+def key_material(coin):
+    return coin.address[::-1] + coin.irk + coin.ltk + coin.spacekey
+
+
+# one Intel HEX record line including its checksum
+def _record(rtype, offset, data):
+    raw = bytes((len(data), offset >> 8, offset & 0xff, rtype)) + data
+    return ':{}{:02X}\n'.format(raw.hex().upper(), -sum(raw) & 0xff)
+
+
+# contiguous (address, bytearray) segments and the start address records of a HEX file
+def parse_hex(lines):
+    segments = []
+    start_records = []
+    base = 0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise ValueError("line {}: not an Intel HEX record".format(lineno))
+        raw = bytes.fromhex(line[1:])
+        if len(raw) < 5 or len(raw) != raw[0] + 5 or sum(raw) & 0xff:
+            raise ValueError("line {}: broken record".format(lineno))
+        rtype = raw[3]
+        data = raw[4:-1]
+        if rtype == _DATA:
+            addr = base + (raw[1] << 8 | raw[2])
+            if segments and segments[-1][0] + len(segments[-1][1]) == addr:
+                segments[-1][1].extend(data)
+            else:
+                segments.append((addr, bytearray(data)))
+        elif rtype == _EXT_LINEAR:
+            base = int.from_bytes(data, 'big') << 16
+        elif rtype == _EXT_SEGMENT:
+            base = int.from_bytes(data, 'big') << 4
+        elif rtype == _EOF:
+            break
+        else:
+            start_records.append(line + '\n')
+    return _merge(segments), start_records
+
+
+# the parts of segments inside (or outside) the range [start, end)
+def _clip(segments, start, end, inside=True):
+    clipped = []
+    for addr, data in segments:
+        if inside:
+            lo, hi = max(addr, start), min(addr + len(data), end)
+            if lo < hi:
+                clipped.append((lo, data[lo - addr:hi - addr]))
+        else:
+            if addr < start:
+                clipped.append((addr, data[:min(len(data), start - addr)]))
+            if addr + len(data) > end:
+                lo = max(addr, end)
+                clipped.append((lo, data[lo - addr:]))
+    return clipped
+
+
+# HEX text of segments
+def _render(segments, start_records=()):
+    lines = []
+    upper = None
+    for addr, data in segments:
+        pos = 0
+        while pos < len(data):
+            chunk_addr = addr + pos
+            size = min(_RECORD_SIZE - chunk_addr % _RECORD_SIZE, len(data) - pos)
+            if chunk_addr >> 16 != upper:
+                upper = chunk_addr >> 16
+                lines.append(_record(_EXT_LINEAR, 0, upper.to_bytes(2, 'big')))
+            lines.append(_record(_DATA, chunk_addr & 0xffff, bytes(data[pos:pos + size])))
+            pos += size
+    lines.extend(start_records)
+    lines.append(_record(_EOF, 0, b''))
+    return ''.join(lines)
+
+
+# short-lived file written by write(f), in RAM where possible
+@contextlib.contextmanager
+def _temp_hex(write):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    with tempfile.NamedTemporaryFile('w', suffix='.hex', dir=directory) as f:
+        write(f)
+        f.flush()
+        yield f.name
+
+
+# sorted segments with touching ones joined, later data wins
+def _merge(segments):
+    merged = []
+    for addr, data in sorted(segments, key=lambda s: s[0]):
+        if merged and merged[-1][0] + len(merged[-1][1]) >= addr:
+            last_addr, last = merged[-1]
+            offset = addr - last_addr
+            last[offset:offset + len(data)] = data
+        else:
+            merged.append((addr, bytearray(data)))
+    return merged
+
+
+# the base firmware, parsed once and rendered to HEX text except for the key storage,
+# which gets filled in for every coin
+class FirmwareTemplate:
+    def __init__(self, segments, start_records, key_storage):
+        if key_storage >> 16 != (key_storage + KEY_STORAGE_SIZE - 1) >> 16:
+            raise ValueError("key storage must not cross a 64 KiB boundary")
+        self.key_storage = key_storage
+        self.key_page = key_storage & ~(FLASH_PAGE_SIZE - 1)
+        key_end = key_storage + KEY_STORAGE_SIZE
+        if key_end > self.key_page + FLASH_PAGE_SIZE:
+            raise ValueError("key storage must not cross a flash page")
+        # a base without the key storage gets an erased one
+        segments = _merge(list(segments) + [
+            (addr, data) for addr, data in
+            [(key_storage, bytearray(b'\xff' * KEY_STORAGE_SIZE))]
+            if not any(a <= addr and a + len(d) >= key_end for a, d in segments)])
+        for addr, data in segments:
+            if addr <= key_storage and addr + len(data) >= key_end:
+                data[key_storage - addr:key_end - addr] = b'\xff' * KEY_STORAGE_SIZE
+
+        head = []
+        tail = []
+        self._key_records = []
+        upper = None
+        for addr, data in segments:
+            pos = 0
+            while pos < len(data):
+                chunk_addr = addr + pos
+                size = min(_RECORD_SIZE - chunk_addr % _RECORD_SIZE, len(data) - pos)
+                chunk = bytes(data[pos:pos + size])
+                pos += size
+                out = tail if self._key_records else head
+                if chunk_addr >> 16 != upper:
+                    upper = chunk_addr >> 16
+                    out.append(_record(_EXT_LINEAR, 0, upper.to_bytes(2, 'big')))
+                if chunk_addr < key_end and chunk_addr + size > key_storage:
+                    self._key_records.append((chunk_addr, chunk))
+                else:
+                    out.append(_record(_DATA, chunk_addr & 0xffff, chunk))
+        tail.extend(start_records)
+        tail.append(_record(_EOF, 0, b''))
+        self._head = ''.join(head)
+        self._tail = ''.join(tail)
+        self._segments = segments
+        self._start_records = list(start_records)
+        self._app_image = None
+        self._app_image_path = None
+
+    @classmethod
+    def from_file(cls, filename, key_storage):
+        with open(filename) as f:
+            segments, start_records = parse_hex(f)
+        return cls(segments, start_records, key_storage)
+
+    # the records of the key storage holding the keys of `coin`
+    def _patched_records(self, coin):
+        keys = key_material(coin)
+        records = []
+        for addr, chunk in self._key_records:
+            start = max(addr, self.key_storage)
+            end = min(addr + len(chunk), self.key_storage + KEY_STORAGE_SIZE)
+            chunk = chunk[:start - addr] + keys[start - self.key_storage:end - self.key_storage] + \
+                chunk[end - addr:]
+            records.append(_record(_DATA, addr & 0xffff, chunk))
+        return ''.join(records)
+
+    # HEX text of the firmware with the keys of `coin`
+    def image(self, coin):
+        return self._head + self._patched_records(coin) + self._tail
+
+    # write the image of `coin` to an open text file
+    def write_image(self, coin, f):
+        f.write(self._head)
+        f.write(self._patched_records(coin))
+        f.write(self._tail)
+
+    # {address: image} for many coins at once
+    def images(self, coins):
+        return {coin.address: self.image(coin) for coin in coins}
+
+    # write the images of many coins into `directory` as coin_<address>.hex,
+    # returns {address: path}
+    def write_images(self, coins, directory='.'):
+        paths = {}
+        for coin in coins:
+            path = os.path.join(directory, 'coin_{}.hex'.format(coin.address.hex()))
+            with open(path, 'w') as f:
+                self.write_image(coin, f)
+            paths[coin.address] = path
+        return paths
+
+    # path of a short-lived image for oocd.program(), in RAM where possible
+    def temp_image(self, coin):
+        return _temp_hex(lambda f: self.write_image(coin, f))
+
+    # HEX text of everything but the key page, the same for every coin
+    def app_image(self):
+        if self._app_image is None:
+            self._app_image = _render(
+                _clip(self._segments, self.key_page, self.key_page + FLASH_PAGE_SIZE, False),
+                self._start_records)
+        return self._app_image
+
+    # app_image() as a file, written once and removed with the template
+    def app_image_path(self):
+        if self._app_image_path is None:
+            fd, path = tempfile.mkstemp(
+                suffix='.hex', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.app_image())
+            weakref.finalize(self, os.remove, path)
+            self._app_image_path = path
+        return self._app_image_path
+
+    # HEX text of the key page only, holding the keys of `coin`
+    def key_page_image(self, coin):
+        page = [(addr, bytearray(data)) for addr, data in
+                _clip(self._segments, self.key_page, self.key_page + FLASH_PAGE_SIZE)]
+        keys = key_material(coin)
+        for addr, data in page:
+            lo = max(addr, self.key_storage)
+            hi = min(addr + len(data), self.key_storage + KEY_STORAGE_SIZE)
+            if lo < hi:
+                data[lo - addr:hi - addr] = keys[lo - self.key_storage:hi - self.key_storage]
+        return _render(page)
+
+    def temp_key_page(self, coin):
+        return _temp_hex(lambda f: f.write(self.key_page_image(coin)))
+
+
+# address of `symbol` in a GNU ld map file, like the zephyr.map of the firmware build
+def read_key_storage(map_filename, symbol=KEY_STORAGE_SYMBOL):
+    line = re.compile(r'\s+0x([0-9a-fA-F]+)\s+{}\s*$'.format(re.escape(symbol)))
+    with open(map_filename) as f:
+        for text in f:
+            match = line.match(text)
+            if match:
+                return int(match.group(1), 16)
+    raise ValueError("{}: no symbol {}".format(map_filename, symbol))
+
+
+# the key storage address of a base firmware, from the linker map next to it
+def _key_storage_of(filename):
+    map_filename = os.path.splitext(filename)[0] + '.map'
+    if not os.path.exists(map_filename):
+        raise ValueError("no key storage address for {}: {} is missing".format(
+            filename, map_filename))
+    return read_key_storage(map_filename)
+
+
+_templates = {}
+
+
+# the template of a base firmware file, parsed again only when the file changed
+# without key_storage the address is read from the firmware's linker map
+def load_template(filename='coin_base.hex', key_storage=None):
+    if key_storage is None:
+        key_storage = _key_storage_of(filename)
+    mtime = os.stat(filename).st_mtime_ns
+    cached = _templates.get((filename, key_storage))
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, FirmwareTemplate.from_file(filename, key_storage))
+        _templates[(filename, key_storage)] = cached
+    return cached[1]
+
+
+# images for members of the database, as {name: path}
+def write_member_images(db, names, base='coin_base.hex', directory='.'):
+    template = load_template(base)
+    paths = template.write_images([db.coins[db.names[name]] for name in names], directory)
+    return {name: paths[db.names[name]] for name in names}
+
+
+# a firmware of about the size the programming logs show, 0x1c940 bytes,
+# as (segments, start records, key storage address)
+def _synthetic_base(size=0x1c940, key_storage=0x000FE000):
+    data = bytearray(os.urandom(size))
+    return [(0, data)], [], key_storage
+
+
+def _bench_images(count=1000):
+    from key_db import _coin_material
+    base = _synthetic_base()
+    start = time.perf_counter()
+    template = FirmwareTemplate(*base)
+    print("template: {:.1f} ms".format((time.perf_counter() - start) * 1000))
+    coins = list(_coin_material(count, set()))
+    start = time.perf_counter()
+    for coin in coins:
+        template._patched_records(coin)
+    elapsed = time.perf_counter() - start
+    print("{} key patches in {:.1f} ms, {:.1f} us per coin".format(
+        count, elapsed * 1000, elapsed / count * 1e6))
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        template.write_images(coins, directory)
+        elapsed = time.perf_counter() - start
+    print("{} image files in {:.1f} ms, {:.1f} us per image".format(
+        count, elapsed * 1000, elapsed / count * 1e6))
+    images = template.images(coins[:1])
+
+    # the patched image has to parse back to the base plus the keys
+    coin = coins[0]
+    segments, _ = parse_hex(images[coin.address].splitlines())
+    assert segments == [base[0][0], (base[2], bytearray(key_material(coin)))]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_images(*map(int, sys.argv[2:3]))
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'write':
+        # write <db file> <base hex> <name>...
+        db = open_db(sys.argv[2], '')
+        for name, path in write_member_images(db, sys.argv[4:], sys.argv[3]).items():
+            print(name, path)
+    else:
+        print("usage: {} bench [count] | write <db> <base hex> <name>...".format(sys.argv[0]))
@@ -2,9 +2,19 @@
 
 import json
 import base64
+import csv
+import getpass
+import hashlib
 import os
+import sys
 import secrets
-from simplecrypt import encrypt, decrypt
+import shutil
+import sqlite3
+import threading
+from collections.abc import Mapping
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import metrics
 
 
 # generate human-readable colon-separated BLE address string
@@ -13,76 +23,850 @@ def addr_to_str(addr):
     return ":".join(hex_arr)
 
 
+# decrypt the whole-file simplecrypt format of older versions
+def _legacy_decrypt(passw, data):
+    from simplecrypt import decrypt
+    return decrypt(passw, base64.b64decode(data)).decode('utf8')
+
+
+# 6-byte address key, in the order the address is written
+def addr_key(addr):
+    return bytes.fromhex(addr.replace(':', ''))
+
+
+# colon-separated address string of an address key
+def addr_key_to_str(key):
+    return ":".join(["%02X" % b for b in key])
+
+
+# random static BLE address, the two top bits have to be set
+def _random_static_addr():
+    addr = bytearray(secrets.token_bytes(6))
+    addr[5] |= 0xc0
+    return addr_to_str(addr)
+
+
+# key material of one coin, hex strings only appear at the JSON/serial boundary
+class CoinRecord:
+    __slots__ = ('address', 'irk', 'ltk', 'spacekey')
+
+    def __init__(self, address, irk, ltk, spacekey):
+        self.address = bytes(address)
+        self.irk = bytes(irk)
+        self.ltk = bytes(ltk)
+        self.spacekey = bytes(spacekey)
+
+    # from the address string and [irk, ltk, spacekey] hex list of db.json
+    @classmethod
+    def from_hex(cls, addr, keys):
+        irk, ltk, spacekey = keys
+        return cls(addr_key(addr), bytes.fromhex(irk), bytes.fromhex(ltk),
+                   bytes.fromhex(spacekey))
+
+    @property
+    def address_str(self):
+        return addr_key_to_str(self.address)
+
+    # [irk, ltk, spacekey] as stored in db.json and sent to the central
+    def hex_keys(self):
+        return [self.irk.hex().upper(), self.ltk.hex().upper(),
+                self.spacekey.hex().upper()]
+
+    def __eq__(self, other):
+        return isinstance(other, CoinRecord) and \
+            self.address == other.address and self.irk == other.irk and \
+            self.ltk == other.ltk and self.spacekey == other.spacekey
+
+    def __repr__(self):
+        return 'CoinRecord({})'.format(self.address_str)
+
+
+# key material for many coins from a single draw of randomness
+# yields CoinRecords with addresses not in `taken` and unique among each other
+def _coin_material(count, taken):
+    size = 6 + 16 + 16 + 32
+    random = secrets.token_bytes(size * count)
+    for i in range(0, size * count, size):
+        addr = bytearray(random[i:i + 6])
+        addr[0] |= 0xc0
+        addr = bytes(addr)
+        while addr in taken:
+            addr = addr_key(_random_static_addr())
+        taken.add(addr)
+        yield CoinRecord(addr, random[i + 6:i + 22], random[i + 22:i + 38],
+                         random[i + 38:i + size])
+
+
+# db.json layout of the in-memory state
+def _to_json_db(identity, coins, names):
+    return {
+        'identity': identity,
+        'coins': {coin.address_str: coin.hex_keys() for coin in coins.values()},
+        'names': {name: addr_key_to_str(addr) for name, addr in names.items()},
+    }
+
+
+# digest over identity and coins, stays the same for every storage
+def _fingerprint(identity, coins):
+    canonical = json.dumps(
+        [identity, {coin.address_str: coin.hex_keys() for coin in coins}],
+        sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('ASCII')).hexdigest()
+
+
+# check names for a batch, returns the accepted names and (index, name, error)
+def _check_new_names(names, is_taken):
+    accepted = []
+    errors = []
+    seen = set()
+    for i, name in enumerate(names):
+        if not name:
+            errors.append((i, name, "empty name"))
+        elif name in seen or is_taken(name):
+            errors.append((i, name, "name is already taken"))
+        else:
+            seen.add(name)
+            accepted.append(name)
+    return accepted, errors
+
+
+# write a file so that it is either completely there or not at all
+def _write_atomic(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+# AEAD for single database records, the key is derived once per unlock
+class RecordCipher:
+    ITERATIONS = 200000
+
+    def __init__(self, passw, salt=None, iterations=ITERATIONS):
+        self.salt = salt if salt is not None else secrets.token_bytes(16)
+        self.iterations = iterations
+        key = hashlib.pbkdf2_hmac(
+            'sha256', passw.encode('utf8'), self.salt, iterations, 32)
+        self._aead = AESGCM(key)
+
+    @classmethod
+    def from_params(cls, passw, params):
+        return cls(passw, base64.b64decode(params['salt']), params['iterations'])
+
+    def params(self):
+        return {
+            'kdf': 'pbkdf2-sha256',
+            'salt': str(base64.b64encode(self.salt), 'ASCII'),
+            'iterations': self.iterations,
+        }
+
+    # the associated data binds a record to where it is stored
+    def seal(self, text, aad):
+        nonce = secrets.token_bytes(12)
+        sealed = self._aead.encrypt(nonce, text.encode('utf8'), aad.encode('utf8'))
+        return str(base64.b64encode(nonce + sealed), 'ASCII')
+
+    def open(self, token, aad):
+        data = base64.b64decode(token)
+        try:
+            return self._aead.decrypt(
+                data[:12], data[12:], aad.encode('utf8')).decode('utf8')
+        except InvalidTag:
+            raise ValueError("wrong password or corrupted db file!")
+
+
+# snapshot file plus an append-only journal of the changes made since
+# records are replayed with overwrite semantics, so replaying a journal
+# over a snapshot that already contains it does no harm
+# with a password every coin and journal record is encrypted on its own
+DB_SECONDS = metrics.histogram(
+    'keykeeper_db_seconds', 'time spent loading, decrypting and saving the database',
+    ('operation',))
+
+
+class JournalStore:
+    def __init__(self, filename, passw='', compact_threshold=64 * 1024):
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.p = passw
+        self.compact_threshold = compact_threshold
+        self.journal_size = 0
+        # whole-file simplecrypt envelope, needs a rewrite in the new format
+        self.legacy = False
+        self._cipher = None
+        self._sealed = {}
+        self._compactor = None
+
+    def _get_cipher(self):
+        if self._cipher is None:
+            self._cipher = RecordCipher(self.p)
+        return self._cipher
+
+    def _seal(self, text):
+        if len(self.p) > 0:
+            return self._get_cipher().seal(text, 'journal')
+        return text
+
+    def _unseal(self, data):
+        if self.legacy:
+            return _legacy_decrypt(self.p, data)
+        if len(self.p) > 0:
+            return self._cipher.open(data, 'journal')
+        return data
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    # returns the snapshot and the journal records written after it
+    def read(self):
+        with open(self.filename, "r") as f:
+            json_db = json.load(f)
+        self.legacy = False
+        self._cipher = None
+        self._sealed = {}
+        if list(json_db.keys()) == ['encrypted']:
+            envelope = json_db['encrypted']
+            with metrics.timed(DB_SECONDS, 'decrypt'):
+                if isinstance(envelope, str):
+                    self.legacy = True
+                    json_db = json.loads(_legacy_decrypt(self.p, envelope))
+                else:
+                    json_db = self._open_snapshot(envelope)
+        else:
+            # a plain file stays plain until the next save rewrites it
+            self.p = ''
+        records = []
+        self.journal_size = 0
+        if os.path.exists(self.journal_filename):
+            with open(self.journal_filename, "rb") as f:
+                for line in f:
+                    # a torn last line is a write that never completed
+                    if not line.endswith(b'\n'):
+                        f.close()
+                        os.truncate(self.journal_filename, self.journal_size)
+                        break
+                    records.append(json.loads(self._unseal(line[:-1].decode('ASCII'))))
+                    self.journal_size += len(line)
+        return json_db, records
+
+    def _open_snapshot(self, envelope):
+        self._cipher = RecordCipher.from_params(self.p, envelope['kdf'])
+        json_db = {
+            'identity': json.loads(self._cipher.open(envelope['identity'], 'identity')),
+            'coins': {},
+            'names': {},
+        }
+        for addr, token in envelope['coins'].items():
+            record = self._cipher.open(token, addr)
+            name, *coin = json.loads(record)
+            json_db['coins'][addr] = coin
+            json_db['names'][name] = addr
+            self._sealed[addr] = (record, token)
+        return json_db
+
+    # encrypt the snapshot, reusing the ciphertext of unchanged coins
+    def _seal_snapshot(self, json_db):
+        cipher = self._get_cipher()
+        sealed = {}
+        coins = {}
+        for name, addr in json_db['names'].items():
+            record = json.dumps([name, *json_db['coins'][addr]])
+            cached = self._sealed.get(addr)
+            if cached is not None and cached[0] == record:
+                token = cached[1]
+            else:
+                token = cipher.seal(record, addr)
+            sealed[addr] = (record, token)
+            coins[addr] = token
+        self._sealed = sealed
+        return {
+            'kdf': cipher.params(),
+            'identity': cipher.seal(json.dumps(json_db['identity']), 'identity'),
+            'coins': coins,
+        }
+
+    def append(self, records):
+        data = ''.join(self._seal(json.dumps(r)) + '\n' for r in records)
+        with open(self.journal_filename, 'a') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+
+    def write_snapshot(self, json_db):
+        if len(self.p) > 0:
+            data = json.dumps({'encrypted': self._seal_snapshot(json_db)})
+        else:
+            data = json.dumps(json_db)
+        # keep the previous version around
+        if os.path.exists(self.filename):
+            shutil.copyfile(self.filename, self.filename + '.old')
+        _write_atomic(self.filename, data)
+
+    # replace snapshot and journal, for when the whole file has to change
+    # must not run while a compaction is in progress
+    def rewrite(self, json_db):
+        self.legacy = False
+        self._cipher = None
+        self._sealed = {}
+        self.write_snapshot(json_db)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.journal_size = 0
+
+    # fold the journal into a new snapshot in the background
+    # capture() is called with the lock held, it copies the state and
+    # returns a function that builds the snapshot from the copy
+    def compact_async(self, capture, lock):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+
+        def compact():
+            with lock:
+                build_snapshot = capture()
+                journal_size = self.journal_size
+            with metrics.timed(DB_SECONDS, 'compact'):
+                self.write_snapshot(build_snapshot())
+            # records appended while the snapshot was written stay in the journal
+            with lock:
+                with open(self.journal_filename, 'r') as f:
+                    f.seek(journal_size)
+                    tail = f.read()
+                _write_atomic(self.journal_filename, tail)
+                self.journal_size = len(tail)
+
+        self._compactor = threading.Thread(target=compact, daemon=True)
+        self._compactor.start()
+
+    def wait_for_compaction(self):
+        if self._compactor is not None:
+            self._compactor.join()
+
+
 class KeykeeperDB:
     def __init__(self, filename='db.json', passw=''):
         self.n = filename
         self.p = passw
-        if os.path.exists(filename):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._listeners = []
+        self._store = JournalStore(filename, passw)
+        if self._store.exists():
             self.load(self.n, self.p)
         else:
             self.coins = {}
             self.names = {}
+            self._owners = {}
+            self._saved = (None, {}, {})
             self.generate_identity()
             self.fresh = True
 
     def generate_identity(self):
-        central_addr = bytearray(secrets.token_bytes(6))
-        central_addr[5] |= 0xc0
         central_irk = secrets.token_bytes(16)
-        self.identity = [addr_to_str(central_addr), central_irk.hex().upper()]
+        self._apply([('identity', [
+            _random_static_addr(), central_irk.hex().upper()])])
 
     def generate_coin(self, name):
         assert name not in self.names.keys()
-        addr = bytearray(secrets.token_bytes(6))
-        addr[5] |= 0xc0
-        addr = addr_to_str(addr)
-        while addr in self.coins.keys():
-            addr = bytearray(secrets.token_bytes(6))
-            addr[5] |= 0xc0
-            addr = addr_to_str(addr)
-        irk = secrets.token_bytes(16).hex().upper()
-        ltk = secrets.token_bytes(16).hex().upper()
-        spacekey = secrets.token_bytes(32).hex().upper()
-        self.coins[addr] = [irk, ltk, spacekey]
-        self.names[name] = addr
+        coin, = _coin_material(1, set(self.coins))
+        self._apply([('add', name, coin)])
+
+    # generate coins for many members, returns (index, name, error) of rejected names
+    def generate_coins(self, names):
+        accepted, errors = _check_new_names(names, self.names.__contains__)
+        self._apply([('add', name, coin) for name, coin in
+                     zip(accepted, _coin_material(len(accepted), set(self.coins)))])
+        return errors
+
+    # remove a member and their coin, returns False if the name is unknown
+    def remove_coin(self, name):
+        if name not in self.names:
+            return False
+        self._apply([('del', name, self.names[name])])
+        return True
+
+    # new keys and address for a member's coin, returns False if the name is unknown
+    def rekey_coin(self, name):
+        if name not in self.names:
+            return False
+        coin, = _coin_material(1, set(self.coins))
+        self._apply([('del', name, self.names[name]), ('add', name, coin)])
+        return True
+
+    # listener(changes) is called with the change tuples of every modification
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    # apply a change to the in-memory state, called with the lock held
+    def _change(self, op, *args):
+        if op == 'add':
+            name, coin = args
+            self.coins[coin.address] = coin
+            self.names[name] = coin.address
+            self._owners[coin.address] = name
+        elif op == 'del':
+            name, addr = args
+            self.coins.pop(addr, None)
+            self.names.pop(name, None)
+            self._owners.pop(addr, None)
+        elif op == 'identity':
+            self.identity, = args
+        else:
+            raise ValueError("invalid journal record: {}".format(op))
+
+    # apply a journal record read from disk
+    def _replay(self, record):
+        op = record['op']
+        if op == 'add':
+            self._change(op, record['name'],
+                         CoinRecord.from_hex(record['addr'], record['coin']))
+        elif op == 'del':
+            self._change(op, record['name'], addr_key(record['addr']))
+        else:
+            self._change(op, record.get('identity'))
+
+    # journal record of a change
+    @staticmethod
+    def _record(change):
+        op = change[0]
+        if op == 'add':
+            return {'op': op, 'name': change[1], 'addr': change[2].address_str,
+                    'coin': change[2].hex_keys()}
+        if op == 'del':
+            return {'op': op, 'name': change[1], 'addr': addr_key_to_str(change[2])}
+        return {'op': op, 'identity': change[1]}
+
+    # bring the copy of what snapshot and journal hold up to date with saved
+    # changes, called with the lock held
+    def _persisted(self, changes):
+        identity, coins, names = self._saved
+        for op, *args in changes:
+            if op == 'add':
+                name, coin = args
+                coins[coin.address] = coin
+                names[name] = coin.address
+            elif op == 'del':
+                name, addr = args
+                coins.pop(addr, None)
+                names.pop(name, None)
+            else:
+                identity, = args
+        self._saved = (identity, coins, names)
+
+    def _apply(self, changes):
+        with self._lock:
+            for change in changes:
+                self._change(*change)
+            self._pending.extend(changes)
+        for listener in self._listeners:
+            listener(changes)
+
+    def _json_db(self):
+        return _to_json_db(self.identity, self.coins, self.names)
+
+    # saved state for a compaction, called with the lock held, changes that
+    # aren't saved yet must not get into the snapshot through it
+    # the conversion to JSON happens later, in the compaction thread
+    def _capture(self):
+        identity, coins, names = self._saved[0], dict(self._saved[1]), dict(self._saved[2])
+        return lambda: _to_json_db(identity, coins, names)
+
+    # name of the member owning a coin address key, None if unknown
+    def name_of(self, addr):
+        return self._owners.get(addr)
+
+    # stable digest of everything a central gets synced from
+    def fingerprint(self):
+        return _fingerprint(self.identity, self.coins.values())
 
     def load(self, filename, passw=''):
+        with metrics.timed(DB_SECONDS, 'load'):
+            self._load(filename, passw)
+
+    def _load(self, filename, passw):
         self.n = filename
         self.p = passw
-        with open(filename, "r") as f:
-            json_db = json.load(f)
-        if list(json_db.keys()) == ['encrypted']:
-            json_db = json.loads(
-                decrypt(passw, base64.b64decode(json_db['encrypted'])))
+        self._store.wait_for_compaction()
+        self._store = JournalStore(filename, passw)
+        json_db, records = self._store.read()
         assert list(json_db.keys()) == [
             'identity', 'coins', 'names'], "invalid db file!"
         self.identity = json_db['identity']
         assert len(self.identity) == 2, "invalid db file!"
-        self.coins = json_db['coins']
-        self.names = json_db['names']
+        self.coins = {}
+        self.names = {}
+        self._owners = {}
+        coins = json_db['coins']
+        for name, addr in json_db['names'].items():
+            self._change('add', name, CoinRecord.from_hex(addr, coins[addr]))
+        assert len(self.coins) == len(coins), "invalid db file!"
+        for record in records:
+            self._replay(record)
         assert len(self.coins) == len(self.names), "invalid db file!"
+        self._pending = []
+        self._saved = (self.identity, dict(self.coins), dict(self.names))
         self.fresh = False
+        # one-time migration away from the whole-file encryption
+        if self._store.legacy:
+            self._store.rewrite(self._json_db())
 
+    # persist changes, usually by appending them to the journal
     def save(self):
-        # TODO: save old version
-        json_db = json.dumps({
-            'identity': self.identity,
-            'coins': self.coins,
-            'names': self.names,
-        })
-        if len(self.p) > 0:
-            e = str(base64.b64encode(encrypt(self.p, json_db)), 'ASCII')
-            json_db = json.dumps({
-                'encrypted': e,
-            })
-        with open(self.n, 'w') as f:
-            f.write(json_db)
+        with metrics.timed(DB_SECONDS, 'save'):
+            self._save()
+
+    def _save(self):
+        rewrite = self._store.p != self.p or not self._store.exists()
+        if rewrite:
+            self._store.wait_for_compaction()
+        with self._lock:
+            if rewrite:
+                self._store.p = self.p
+                self._store.rewrite(self._json_db())
+                self._saved = (self.identity, dict(self.coins), dict(self.names))
+            elif self._pending:
+                self._store.append([self._record(c) for c in self._pending])
+                self._persisted(self._pending)
+            self._pending = []
+            compact = self._store.journal_size > self._store.compact_threshold
+        if compact:
+            self._store.compact_async(self._capture, self._lock)
+
+    def set_password(self, passw):
+        self.p = passw
+
+    # save and wait for a running compaction, before exiting
+    def close(self):
+        self.save()
+        self._store.wait_for_compaction()
+
+
+# read-only dict view of an SQL table, rows are fetched when accessed
+# keys and values are converted from and to their SQL columns on the way
+class _SQLMapping(Mapping):
+    def __init__(self, conn, table, key, columns, key_to_sql, key_from_sql, value_from_row):
+        self._conn = conn
+        self._get = 'SELECT {} FROM {} WHERE {} = ?'.format(
+            ', '.join(columns), table, key)
+        self._keys = 'SELECT {} FROM {} ORDER BY rowid'.format(key, table)
+        self._items = 'SELECT {}, {} FROM {} ORDER BY rowid'.format(
+            key, ', '.join(columns), table)
+        self._len = 'SELECT COUNT(*) FROM {}'.format(table)
+        self._key_to_sql = key_to_sql
+        self._key_from_sql = key_from_sql
+        self._value_from_row = value_from_row
+
+    def __getitem__(self, key):
+        row = self._conn.execute(self._get, (self._key_to_sql(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._value_from_row(key, row)
+
+    def __contains__(self, key):
+        return self._conn.execute(
+            self._get, (self._key_to_sql(key),)).fetchone() is not None
+
+    def __iter__(self):
+        return (self._key_from_sql(row[0]) for row in self._conn.execute(self._keys))
+
+    def __len__(self):
+        return self._conn.execute(self._len).fetchone()[0]
+
+    def items(self):
+        items = []
+        for row in self._conn.execute(self._items):
+            key = self._key_from_sql(row[0])
+            items.append((key, self._value_from_row(key, row[1:])))
+        return items
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+
+def _same(x):
+    return x
+
+
+# KeykeeperDB stored in SQLite, coins and names are looked up through indexes
+# the columns keep the hex format of db.json, with a password every key column
+# is sealed on its own, bound to the coin address and column name
+class KeykeeperSQLiteDB:
+    _KEY_COLUMNS = ('irk', 'ltk', 'spacekey')
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS cipher (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            params TEXT NOT NULL,
+            token TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS identity (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            addr TEXT NOT NULL,
+            irk TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS coins (
+            name TEXT NOT NULL,
+            addr TEXT NOT NULL,
+            irk TEXT NOT NULL,
+            ltk TEXT NOT NULL,
+            spacekey TEXT NOT NULL);
+        CREATE UNIQUE INDEX IF NOT EXISTS coins_by_name ON coins (name);
+        CREATE UNIQUE INDEX IF NOT EXISTS coins_by_addr ON coins (addr);
+    '''
+
+    def __init__(self, filename='db.sqlite', passw=''):
+        fresh = not os.path.exists(filename)
+        self._listeners = []
+        self.load(filename, passw)
+        if fresh:
+            self.generate_identity()
+            self.fresh = True
+
+    def generate_identity(self):
+        central_irk = secrets.token_bytes(16)
+        self.identity = [_random_static_addr(), central_irk.hex().upper()]
+        self._store_identity()
+        self._notify([('identity', self.identity)])
+
+    def _store_identity(self):
+        self._conn.execute('INSERT OR REPLACE INTO identity VALUES (0, ?, ?)',
+                           (self.identity[0], self._seal(self.identity[1], 'identity')))
 
+    def _seal(self, value, aad):
+        return self._cipher.seal(value, aad) if self._cipher is not None else value
+
+    def _open(self, value, aad):
+        return self._cipher.open(value, aad) if self._cipher is not None else value
+
+    # key columns of a coin as stored
+    def _seal_coin(self, coin):
+        addr = coin.address_str
+        return [self._seal(key, '{}/{}'.format(addr, column))
+                for key, column in zip(coin.hex_keys(), self._KEY_COLUMNS)]
+
+    def _coin_from_row(self, addr, row):
+        addr = addr_key_to_str(addr)
+        return CoinRecord.from_hex(addr, [self._open(key, '{}/{}'.format(addr, column))
+                                          for key, column in zip(row, self._KEY_COLUMNS)])
+
+    def generate_coin(self, name):
+        assert name not in self.names
+        coin, = _coin_material(1, self._addresses())
+        self.insert_coins([(name, coin)])
+
+    # generate coins for many members, returns (index, name, error) of rejected names
+    def generate_coins(self, names):
+        accepted, errors = _check_new_names(names, self.names.__contains__)
+        self.insert_coins(zip(accepted, _coin_material(len(accepted), self._addresses())))
+        return errors
+
+    def _addresses(self):
+        return {addr_key(row[0]) for row in self._conn.execute('SELECT addr FROM coins')}
+
+    # remove a member and their coin, returns False if the name is unknown
+    def remove_coin(self, name):
+        addr = self.names.get(name)
+        if addr is None:
+            return False
+        self._conn.execute('DELETE FROM coins WHERE name = ?', (name,))
+        self._notify([('del', name, addr)])
+        return True
+
+    # new keys and address for a member's coin, returns False if the name is unknown
+    def rekey_coin(self, name):
+        addr = self.names.get(name)
+        if addr is None:
+            return False
+        coin, = _coin_material(1, self._addresses())
+        self._conn.execute('UPDATE coins SET addr = ?, irk = ?, ltk = ?, spacekey = ? '
+                           'WHERE name = ?', (coin.address_str, *self._seal_coin(coin), name))
+        self._notify([('del', name, addr), ('add', name, coin)])
+        return True
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, changes):
+        for listener in self._listeners:
+            listener(changes)
+
+    # name of the member owning a coin address key, None if unknown
+    def name_of(self, addr):
+        row = self._conn.execute(
+            'SELECT name FROM coins WHERE addr = ?', (addr_key_to_str(addr),)).fetchone()
+        return row[0] if row else None
+
+    # insert many (name, CoinRecord) rows in one transaction
+    def insert_coins(self, rows):
+        rows = list(rows)
+        self._conn.executemany('INSERT INTO coins VALUES (?, ?, ?, ?, ?)',
+                               ((name, coin.address_str, *self._seal_coin(coin))
+                                for name, coin in rows))
+        self._notify([('add', name, coin) for name, coin in rows])
+
+    # stable digest of everything a central gets synced from
+    def fingerprint(self):
+        return _fingerprint(self.identity, self.coins.values())
+
+    # a plain database opened with a password is encrypted, on disk with the next save
+    def load(self, filename, passw=''):
+        self.n = filename
+        self.p = passw
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(self._SCHEMA)
+        self._cipher = None
+        row = self._conn.execute('SELECT params, token FROM cipher').fetchone()
+        if row is not None:
+            with metrics.timed(DB_SECONDS, 'decrypt'):
+                cipher = RecordCipher.from_params(passw, json.loads(row[0]))
+                # raises for a wrong password
+                cipher.open(row[1], 'cipher')
+            self._cipher = cipher
+        row = self._conn.execute('SELECT addr, irk FROM identity').fetchone()
+        self.identity = [row[0], self._open(row[1], 'identity')] if row else None
+        self.coins = _SQLMapping(
+            self._conn, 'coins', 'addr', self._KEY_COLUMNS,
+            addr_key_to_str, addr_key, self._coin_from_row)
+        self.names = _SQLMapping(
+            self._conn, 'coins', 'name', ('addr',),
+            _same, _same, lambda name, row: addr_key(row[0]))
+        self.fresh = False
+        if self._cipher is None and len(passw) > 0:
+            self.set_password(passw)
+
+    # changes since the last save are one transaction
+    def save(self):
+        with metrics.timed(DB_SECONDS, 'save'):
+            self._conn.commit()
+
+    # seal every key column for the new password, or store them plain without
+    # one, committed with the next save
     def set_password(self, passw):
+        coins = self.coins.values()
+        self._cipher = RecordCipher(passw) if len(passw) > 0 else None
+        self._conn.execute('DELETE FROM cipher')
+        if self._cipher is not None:
+            self._conn.execute('INSERT INTO cipher VALUES (0, ?, ?)', (
+                json.dumps(self._cipher.params()), self._cipher.seal('keykeeper', 'cipher')))
+        if self.identity is not None:
+            self._store_identity()
+        self._conn.executemany(
+            'UPDATE coins SET irk = ?, ltk = ?, spacekey = ? WHERE addr = ?',
+            ((*self._seal_coin(coin), coin.address_str) for coin in coins))
         self.p = passw
 
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+# open a database, the file extension decides the storage
+def open_db(filename='db.json', passw=''):
+    if filename.endswith('.sqlite'):
+        return KeykeeperSQLiteDB(filename, passw)
+    return KeykeeperDB(filename, passw)
+
+
+# add every member listed in the first column of a CSV file, with one save
+# returns (line number, name, error) for the rows that were not imported
+def import_csv(db, filename):
+    with open(filename, newline='') as f:
+        rows = [(n, row[0].strip()) for n, row in enumerate(csv.reader(f), 1) if row]
+    if rows and rows[0][1].lower() == 'name':
+        rows.pop(0)
+    errors = db.generate_coins([name for _, name in rows])
+    db.save()
+    return [(rows[i][0], name, error) for i, name, error in errors]
+
+
+# copy a JSON database (encrypted or not) into a new SQLite database
+def migrate_json_to_sqlite(json_filename, sqlite_filename, passw=''):
+    assert not os.path.exists(sqlite_filename), "sqlite database exists already!"
+    src = KeykeeperDB(json_filename, passw)
+    # the keys stay encrypted under the same password
+    dst = KeykeeperSQLiteDB(sqlite_filename, passw)
+    dst.identity = list(src.identity)
+    dst._store_identity()
+    dst.insert_coins((name, src.coins[addr]) for name, addr in src.names.items())
+    dst.save()
+    return dst
+
+
+# unlock and single-coin save latency, per-record AEAD against simplecrypt
+def _bench_crypto(sizes=(1000, 10000), passw='benchmark'):
+    import tempfile
+    import time
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'db.json')
+            db = KeykeeperDB(filename, passw)
+            for i in range(n):
+                db.generate_coin('member{}'.format(i))
+            db.save()
+            start = time.perf_counter()
+            db = KeykeeperDB(filename, passw)
+            unlock = time.perf_counter() - start
+            start = time.perf_counter()
+            db.generate_coin('one more')
+            db.save()
+            save = time.perf_counter() - start
+            print("{:>6} coins, per-record: unlock {:8.3f} s, save {:8.3f} s".format(
+                n, unlock, save))
+            try:
+                from simplecrypt import encrypt
+            except ImportError:
+                continue
+            data = json.dumps(db._json_db())
+            start = time.perf_counter()
+            blob = encrypt(passw, data)
+            save = time.perf_counter() - start
+            start = time.perf_counter()
+            _legacy_decrypt(passw, base64.b64encode(blob))
+            unlock = time.perf_counter() - start
+            print("{:>6} coins, simplecrypt: unlock {:8.3f} s, save {:8.3f} s".format(
+                n, unlock, save))
+
+
+# import a cohort of members from CSV into a fresh database
+def _bench_import(n=5000, passw='benchmark'):
+    import tempfile
+    import time
+    with tempfile.TemporaryDirectory() as tmp:
+        members = os.path.join(tmp, 'members.csv')
+        with open(members, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name'])
+            writer.writerows([['member{}'.format(i)] for i in range(n)])
+        for filename, p in (('db.json', ''), ('db.json', passw), ('db.sqlite', '')):
+            db = open_db(os.path.join(tmp, p + filename), p)
+            db.save()
+            start = time.perf_counter()
+            errors = import_csv(db, members)
+            elapsed = time.perf_counter() - start
+            print("{:>10} {:>9}: imported {} members in {:.3f} s, {} errors".format(
+                filename, 'encrypted' if p else 'plain', n, elapsed, len(errors)))
+
 
 if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'migrate':
+        migrate_json_to_sqlite(
+            sys.argv[2], sys.argv[3], getpass.getpass('database password: '))
+        sys.exit()
+    if len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        _bench_crypto()
+        sys.exit()
+    if len(sys.argv) == 2 and sys.argv[1] == 'bench_import':
+        _bench_import()
+        sys.exit()
+    if len(sys.argv) == 4 and sys.argv[1] == 'import':
+        db = open_db(sys.argv[2], getpass.getpass('database password: '))
+        for line, name, error in import_csv(db, sys.argv[3]):
+            print("line {}: {!r}: {}".format(line, name, error))
+        sys.exit()
     db = KeykeeperDB('new_db.json', '')
     db.generate_coin('Paul')
     db.generate_coin('Katja')
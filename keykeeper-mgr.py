@@ -1,84 +1,196 @@
 #!/usr/bin/env python3
 
+import asyncio
 import urwid
-import time
-import threading
+import bisect
 import os
-import fcntl
-import multiprocessing
-from key_db import KeykeeperDB
-from serialmgr import KeykeeperSerialMgr
+import sys
+import time
+from collections import deque
+import metrics
+from access_log import AccessLog
+from battery import BatteryStore
+from key_db import KeykeeperDB, addr_key
+from serialmgr import KeykeeperCentrals, CENTRAL_PORTS
+from status_bus import send, EventKind, CentralStatus, CoinProgress
+
+# status events are applied right away, the widgets follow at most this often
+FRAME_TIME = 1 / 30
+# lines of coin status the wait prompt keeps
+COIN_STATUS_LINES = 40
+# firmware the coin images are built from
+BASE_IMAGE = 'coin_base.hex'
+# address of the key storage in that firmware, read from its linker map
+# (coin_base.map) unless set
+KEY_STORAGE = os.environ.get('KEYKEEPER_KEY_STORAGE')
+# metrics are collected only when this is set, for the node exporter's textfile collector
+METRICS_FILE = os.environ.get('KEYKEEPER_METRICS_FILE')
+# by-id names of the centrals, one per door
+CENTRALS = os.environ.get('KEYKEEPER_CENTRALS', CENTRAL_PORTS)
+# coins whose battery is expected to be empty within this many days are listed
+LOW_BATTERY_DAYS = 30
+# the battery history is saved this often and on exit
+BATTERY_SAVE_INTERVAL = 3600
+
+
+# the tasks of a logic class on the event loop it shares with urwid,
+# cancelled together on shutdown
+class TaskGroup:
+    def __init__(self, loop):
+        self.loop = loop
+        self._tasks = set()
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def cancel_all(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 class KeyKeeperManagerLogic:
-    def __init__(self, central_status_pipe, coin_status_pipe):
-        self.central_status_pipe = central_status_pipe
-        self.coin_status_pipe = coin_status_pipe
-        self._request_shutdown = threading.Event()
+    def __init__(self, status):
+        self.status = status
         self._db = KeykeeperDB()
-        self._serial_mgr = KeykeeperSerialMgr(self._db, central_status_pipe)
-        self._serial_mgr_process = multiprocessing.Process(target=self._serial_mgr.run, daemon=True)
-        self._serial_mgr_process.start()
-        
-    def shutdown(self):
-        self._request_shutdown.set()
-
+        self._access_log = AccessLog()
+        self._battery = BatteryStore('battery.json')
+        self._centrals = KeykeeperCentrals(self._db, status, CENTRALS,
+                                           access_log=self._access_log, battery=self._battery)
+        self._session = None
+        self._provisioning = None
+        self._provisioning_lock = asyncio.Lock()
+        self._save_pending = False
+
+    def start(self, loop):
+        self._tasks = TaskGroup(loop)
+        self._tasks.spawn(self._centrals.run_async())
+        self._tasks.spawn(self._save_battery_periodically())
+        if METRICS_FILE:
+            self._tasks.spawn(metrics.export_periodically(METRICS_FILE))
+
+    async def shutdown(self):
+        await self._tasks.cancel_all()
+        if self._provisioning is not None:
+            self._provisioning.close()
+        if self._session is not None:
+            await self._session.close()
+        self._battery.save()
+        self._db.close()
+        # raises when the access log couldn't be written
+        self._access_log.close()
+
+    async def _save_battery_periodically(self):
+        while True:
+            await asyncio.sleep(BATTERY_SAVE_INTERVAL)
+            self._battery.save()
+
+    # changes made in one go are saved together, on the event loop
+    def _save_soon(self):
+        if not self._save_pending:
+            self._save_pending = True
+            self._tasks.spawn(self._save())
+
+    async def _save(self):
+        await asyncio.sleep(0)
+        self._save_pending = False
+        self._db.save()
 
     # consider this list read-only
     def get_usernames(self):
-        return self._usernames
+        return list(self._db.names)
+
+    # [(name or address, level, days left)] of the coins empty within `days`
+    def low_batteries(self, days):
+        return [(self._db.name_of(addr_key(address)) or address, level, left)
+                for address, level, left in self._battery.dying_within(days)]
 
 
     # try to add user, return False if name is already taken
     def add_user(self, name):
-        if name not in self._usernames:
-            self._usernames.append(name)
-            return True
-        return False
+        if name in self._db.names:
+            return False
+        self._db.generate_coin(name)
+        self._save_soon()
+        return True
 
 
     # try to remove user, return False if user is not found
     def remove_user(self, name):
-        if name in self._usernames:
-            self._usernames.remove(name)
+        if self._db.remove_coin(name):
+            self._save_soon()
             return True
         return False
 
+    # one openocd for all coins written in this run
+    async def _openocd(self):
+        # openocd is only needed once a coin gets written
+        import oocd
+        if self._session is None:
+            self._session = oocd.OpenOCDSession()
+            await self._session.start()
+        return self._session
+
+    # the persistent provisioning queue, writing a member whose coin an earlier
+    # run left unfinished continues from where it stopped
+    async def _queue(self):
+        from coin_image import load_template
+        from provisioning import ProvisioningQueue
+        if self._provisioning is None:
+            template = load_template(BASE_IMAGE, int(KEY_STORAGE, 0) if KEY_STORAGE else None)
+            self._provisioning = ProvisioningQueue(
+                self._db, template, await self._openocd(),
+                status_pipe=self.status, sync=self._centrals.wait_synced)
+        return self._provisioning
+
+    # writes the coin in the background, the task's result is an error or None
     def write_coin(self, name):
-        pass
+        return self._tasks.spawn(self._write_coins([name]))
+
+    # writes the coins of many members, one after the other as they are put on
+    # the jig, the task's result is {name: error} of the coins that failed
+    def write_coins(self, names):
+        return self._tasks.spawn(self._write_coins(names, single=False))
 
+    # writes a coin with new keys for a member who has one already, their old
+    # coin stops opening the door, the task's result is an error or None
+    def reset_coin(self, name):
+        return self._tasks.spawn(self._write_coins([name], replace=True))
+
+    async def _write_coins(self, names, single=True, replace=False):
+        if single and names[0] not in self._db.names:
+            return "user cannot be found"
+        async with self._provisioning_lock:
+            queue = await self._queue()
+            errors = queue.enqueue(names, replace)
+            errors.update(await queue.run([name for name in names if name not in errors]))
+        return errors.get(names[0]) if single else errors
 
 
 class KeyKeeperManagerDummyLogic:
-    def __init__(self, central_status_pipe, coin_status_pipe):
-        self.central_status_pipe = central_status_pipe
-        self.coin_status_pipe = coin_status_pipe
-        self.ready = threading.Event()
-        self.request_central_update = threading.Event()
-        self.request_shutdown = threading.Event()
+    def __init__(self, status):
+        self.status = status
 
         self._usernames = ['Anna', 'Nicole', 'Luca', 'Melanie', 'Leon', 'Julia', 'Michelle', 'Tom', 'Lea', 'Tim', 'Lena', 'Michael', 'Stefanie', 'Lisa', 'Daniel', 'Christina', 'Hannah', 'Dennis', 'Jonas', 'Christian',
                            'Laura', 'Jannik', 'Sandra', 'Lukas', 'Julia', 'Nadine', 'Stefan', 'Martin', 'Jan', 'Sarah', 'Sabrina', 'Anja', 'Alexander', 'Thomas', 'Sebastian', 'Katrin', 'Lara', 'Niklas', 'Jan', 'Finn']
 
-        def background_task(central_status_pipe, coin_status_pipe):
-            # TODO use asyncIO scheduler for different tasks
-            os.write(central_status_pipe, str(
-                "status: connecting to central").encode('utf8'))
-            time.sleep(1)
-            os.write(central_status_pipe, str(
-                "status: synchronizing database").encode('utf8'))
-            time.sleep(0.2)
-            os.write(central_status_pipe, str(
-                "status: central connected and scanning").encode('utf8'))
-            self.request_shutdown.wait()
-            # time.sleep(5)
-            # os.write(central_status_pipe, str(count).encode('utf8')) # that's how we can update the status message
-
-        self.thread = threading.Thread(target=background_task, args=(central_status_pipe, coin_status_pipe))
-        self.thread.start()
-
-    def shutdown(self):
-        self.request_shutdown.set()
+    def start(self, loop):
+        self._tasks = TaskGroup(loop)
+        self._tasks.spawn(self._background_task())
+
+    async def _background_task(self):
+        send(self.status, CentralStatus("connecting to central"))
+        await asyncio.sleep(1)
+        send(self.status, CentralStatus("synchronizing database"))
+        await asyncio.sleep(0.2)
+        send(self.status, CentralStatus("central connected and scanning"))
+
+    async def shutdown(self):
+        await self._tasks.cancel_all()
     # consider this list read-only
 
     def get_usernames(self):
@@ -98,21 +210,36 @@ class KeyKeeperManagerDummyLogic:
             return True
         return False
 
-    # try to write coin, writes status messages callback
-    # this is blocking, we don't allow the user to fiddle around while
-    # programming a chip
-    # TODO: CORRECTION: for status updates, this cannot be blocking
-    # TODO: move into background task
+    # writes the coin in the background, the task's result is an error or None
     def write_coin(self, name):
-        if name not in self._usernames:
-            # callback("writing coin FAILED, user cannot be found")
-            return
-        time.sleep(2)
-        # callback("writing coin SUCCEEDED")
+        return self._tasks.spawn(self._write_coin(name))
 
-    def reset_coin(self, name, callback):
-        time.sleep(2)
-        # callback("resetting coin SUCCEEDED")
+    async def _write_coin(self, name):
+        if name not in self._usernames:
+            return "user cannot be found"
+        for text in ["coin is unlocked", "programming started", "programming finished",
+                     "verifying", "verified OK"]:
+            await asyncio.sleep(0.4)
+            send(self.status, CoinProgress('', text))
+        return None
+
+    def write_coins(self, names):
+        return self._tasks.spawn(self._write_coins(names))
+
+    async def _write_coins(self, names):
+        errors = {}
+        for name in names:
+            error = await self._write_coin(name)
+            if error is not None:
+                errors[name] = error
+        return errors
+
+    def reset_coin(self, name):
+        return self._tasks.spawn(self._write_coin(name))
+
+    def low_batteries(self, days):
+        return [(name, 20 - i * 5, i * 8.5) for i, name in enumerate(self._usernames[:4])
+                if i * 8.5 <= days]
 
 class QuestionBox(urwid.Filler):
     def __init__(self, questionstr, callback_confirm=None, callback_cancel=None,valign=urwid.widget.MIDDLE,
@@ -128,6 +255,102 @@ class QuestionBox(urwid.Filler):
         else:
             return super(QuestionBox, self).keypress(size, key)
 
+# member names sorted case-insensitively, so the names starting with a
+# prefix are one slice of it, found by two binary searches
+class MemberIndex:
+    def __init__(self, names=()):
+        self._keys = sorted((name.casefold(), name) for name in names)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, position):
+        return self._keys[position][1]
+
+    def add(self, name):
+        bisect.insort(self._keys, (name.casefold(), name))
+
+    def remove(self, name):
+        key = (name.casefold(), name)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    # (start, end) positions of the names starting with prefix
+    def prefix_range(self, prefix):
+        prefix = prefix.casefold()
+        return (bisect.bisect_left(self._keys, (prefix,)),
+                bisect.bisect_left(self._keys, (prefix + '\U0010ffff',)))
+
+
+# list walker over a slice of a MemberIndex, buttons are only created
+# for the rows urwid actually asks for and call on_select(button, name)
+class MemberListWalker(urwid.ListWalker):
+    CACHE_SIZE = 256
+
+    def __init__(self, index, on_select):
+        self.index = index
+        self.on_select = on_select
+        self._widgets = {}
+        self.set_prefix('')
+
+    def set_prefix(self, prefix):
+        self.start, self.end = self.index.prefix_range(prefix)
+        self.focus = self.start
+        self._widgets.clear()
+        self._modified()
+
+    def _widget(self, position):
+        widget = self._widgets.get(position)
+        if widget is None:
+            if len(self._widgets) >= self.CACHE_SIZE:
+                self._widgets.clear()
+            name = self.index[position]
+            widget = urwid.AttrWrap(urwid.Button(name, self.on_select, name),
+                                    'buttn', 'buttnf')
+            self._widgets[position] = widget
+        return widget
+
+    def get_focus(self):
+        if self.start == self.end:
+            return None, None
+        return self._widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        if position + 1 >= self.end:
+            return None, None
+        return self._widget(position + 1), position + 1
+
+    def get_prev(self, position):
+        if position - 1 < self.start:
+            return None, None
+        return self._widget(position - 1), position - 1
+
+
+# member list with a search line, typing narrows it to the matching names
+class MemberChooser(urwid.WidgetWrap):
+    def __init__(self, index, on_select, on_cancel):
+        self.search = urwid.Edit("search: ")
+        self.walker = MemberListWalker(index, on_select)
+        urwid.connect_signal(self.search, 'postchange',
+                             lambda *args: self.walker.set_prefix(self.search.edit_text))
+        super().__init__(urwid.Pile([
+            ('pack', self.search),
+            urwid.ListBox(self.walker),
+            ('pack', urwid.AttrWrap(urwid.Button("back to menu", on_cancel),
+                                    'buttn', 'buttnf_deny')),
+        ], focus_item=1))
+
+    def keypress(self, size, key):
+        if key == 'backspace' or (len(key) == 1 and key.isprintable()):
+            return self.search.keypress((size[0],), key)
+        return super().keypress(size, key)
+
+
 class KeyKeeperManagerTUI:
     def __init__(self, app_logic):
         urwid.set_encoding('utf8')
@@ -142,52 +365,78 @@ class KeyKeeperManagerTUI:
 
         def remove_user(user_data):
             self.choose_user_prompt = urwid.Overlay(
-                urwid.LineBox(urwid.ListBox([
-                    *[urwid.AttrWrap(urwid.Button(n, remove_user_chosen),
-                                     'buttn', 'buttnf') for n in self.app_logic.get_usernames()],
-                    urwid.AttrWrap(urwid.Button("back to menu", back_to_menu),
-                                   'buttn', 'buttnf_deny'),
-                ]), title="which user shall be removed?"),
+                urwid.LineBox(MemberChooser(self.members, remove_user_chosen, back_to_menu),
+                              title="which user shall be removed?"),
                 self.mainframe,
                 'center', ('relative', 50),
                 'middle', ('relative', 50))
             self.loop.widget = self.choose_user_prompt
 
-        def remove_user_chosen(user_data):
-            id = self.choose_user_prompt.top_w.base_widget.focus_position
-            name = self.app_logic.get_usernames()[id]
+        def remove_user_chosen(button, name):
             if self.app_logic.remove_user(name):
+                self.members.remove(name)
                 self.hint_text.set_text("user [{}] has been deleted.".format(name))
             self.loop.widget = self.mainframe
 
         def write_coin(user_data):
             self.choose_user_prompt = urwid.Overlay(
-                urwid.LineBox(urwid.ListBox([
-                    *[urwid.AttrWrap(urwid.Button(n, write_coin_chosen),
-                                     'buttn', 'buttnf') for n in self.app_logic.get_usernames()],
-                    urwid.AttrWrap(urwid.Button("back to menu", back_to_menu),
-                                   'buttn', 'buttnf_deny'),
-                ]), title="whose coin shall be written?"),
+                urwid.LineBox(MemberChooser(self.members, write_coin_chosen, back_to_menu),
+                              title="whose coin shall be written?"),
                 self.mainframe,
                 'center', ('relative', 50),
                 'middle', ('relative', 50))
             self.loop.widget = self.choose_user_prompt
 
-        def write_coin_chosen(user_data):
-            id = self.choose_user_prompt.top_w.base_widget.focus_position
-            name = self.app_logic.get_usernames()[id]
-
+        def write_coin_chosen(button, name, write=None):
+            self.coin_status.clear()
             self.wait_prompt.top_w.base_widget.body[0].set_text("writing coin\n")
             self.loop.widget = self.wait_prompt
-            self.app_logic.write_coin(name)
+            # the UI keeps running while the coin is written
+            (write or self.app_logic.write_coin)(name).add_done_callback(
+                lambda task: coin_written(name, task))
+
+        def coin_written(name, task):
+            if task.cancelled():
+                return
+            error = task.exception() or task.result()
+            if error is None:
+                self.hint_text.set_text("coin of [{}] has been written.".format(name))
+            else:
+                self.hint_text.set_text("writing coin of [{}] FAILED: {}".format(name, error))
             self.loop.widget = self.mainframe
+        # a new coin for a member who lost theirs, the old one is locked out
         def reset_coin(user_data):
-            pass
+            self.choose_user_prompt = urwid.Overlay(
+                urwid.LineBox(MemberChooser(
+                    self.members,
+                    lambda button, name: write_coin_chosen(button, name,
+                                                           self.app_logic.reset_coin),
+                    back_to_menu),
+                    title="whose coin shall be replaced? the old one stops working"),
+                self.mainframe,
+                'center', ('relative', 50),
+                'middle', ('relative', 50))
+            self.loop.widget = self.choose_user_prompt
+
+        def low_batteries(user_data):
+            coins = self.app_logic.low_batteries(LOW_BATTERY_DAYS)
+            lines = ["{:<24} {:>3.0f}%  {:>5.1f} days".format(name, level, left)
+                     for name, level, left in coins] or ["none"]
+            self.loop.widget = urwid.Overlay(
+                urwid.LineBox(urwid.ListBox(
+                    [urwid.Text(line) for line in lines] +
+                    [urwid.AttrWrap(urwid.Button("back to menu", back_to_menu),
+                                    'buttn', 'buttnf_deny')]),
+                    title="empty within {} days".format(LOW_BATTERY_DAYS)),
+                self.mainframe,
+                'center', ('relative', 50),
+                'middle', ('relative', 50))
 
         def username_entered(name):
             if name == "":
                 return
             if self.app_logic.add_user(name):
+                self.members.add(name)
                 self.confirm_writing_prompt.top_w.base_widget.body[0] \
                     .set_text("user [{}] has been added.\n".format(name)
                               + "do you want to write their coin now?")
@@ -207,13 +456,14 @@ class KeyKeeperManagerTUI:
                 ("add user", add_user),
                 ("remove user", remove_user),
                 ("write coin", write_coin),
-                ("reset coin", reset_coin)
+                ("reset coin", reset_coin),
+                ("low batteries", low_batteries)
             ]
         ])
 
         self.mainframe = urwid.Frame(
             urwid.Columns([
-                ('fixed', 18, urwid.LineBox(urwid.Filler(actionpile))),
+                ('fixed', 20, urwid.LineBox(urwid.Filler(actionpile))),
                 ('weight', 1, urwid.LineBox((urwid.ListBox([
                     self.hint_text,
                 ])))),
@@ -253,9 +503,12 @@ class KeyKeeperManagerTUI:
 
         def handle_key(key):
             if key == 'q':
-                self.app_logic.shutdown()
                 raise urwid.ExitMainLoop()
 
+        # urwid and all background work share this loop
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+
         self.loop = urwid.MainLoop(
             self.mainframe,
             palette=[
@@ -265,26 +518,99 @@ class KeyKeeperManagerTUI:
                 ('buttnf_deny', 'black', 'dark red'),
             ],
             handle_mouse=False,
-            unhandled_input=handle_key)
-
-        def handle_coin_status_update(data):
-            msg = data.decode('utf8')
-            text = self.wait_prompt.top_w.base_widget.body[0].get_text()[0] + msg
-            self.wait_prompt.top_w.base_widget.body[0].set_text(text)
-            if msg.startswith('done'):
-                pass
-                # TODO: add back-to-menu button to wait_prompt
-
-        def handle_central_status_update(data):
-            msg = data.decode('utf8')
-            self.status.set_text(msg)
-            
-                
-        self.central_status_pipe = self.loop.watch_pipe(handle_central_status_update)
-        self.coin_status_pipe = self.loop.watch_pipe(handle_coin_status_update)
-        self.app_logic = app_logic(self.central_status_pipe, self.coin_status_pipe)
-        self.loop.run()
+            unhandled_input=handle_key,
+            event_loop=urwid.AsyncioEventLoop(loop=self.event_loop))
+
+        # a flood of central events only changes this state,
+        # the widgets are updated once per frame
+        # {door: status}, door is None while no central tells its door
+        self.door_status = {None: "connecting to central..."}
+        self.last_seen = None
+        self.last_battery = None
+        self.coin_status = deque(maxlen=COIN_STATUS_LINES)
+        self.redraw_pending = False
+
+        def apply_event(event):
+            if event.kind == EventKind.CENTRAL_STATUS:
+                if event.door is not None:
+                    self.door_status.pop(None, None)
+                self.door_status[event.door] = event.text
+            elif event.kind == EventKind.COIN_AUTHENTICATED:
+                self.door_status[event.door] = "{} ({}%🔋) authenticated".format(
+                    event.name or event.address, event.battery_level)
+            elif event.kind == EventKind.COIN_SEEN:
+                self.last_seen = event
+            elif event.kind == EventKind.BATTERY_LEVEL:
+                self.last_battery = event
+            elif event.kind == EventKind.COIN_PROGRESS:
+                self.coin_status.append(event.text)
+                # TODO: add back-to-menu button to wait_prompt when done
+            elif event.kind == EventKind.STATION_STATUS:
+                self.coin_status.append("station {}: {}".format(event.station, event.text))
+
+        def at_door(event):
+            return " at {}".format(event.door) if event.door is not None else ""
+
+        def redraw(loop=None, user_data=None):
+            self.redraw_pending = False
+            if len(self.door_status) == 1:
+                status = "status: " + next(iter(self.door_status.values()))
+            else:
+                status = "status: " + " | ".join("{}: {}".format(door, text) for door, text
+                                                 in sorted(self.door_status.items(), key=str))
+            if self.last_seen is not None:
+                status += " | in range: {} ({} dBm){}".format(
+                    self.last_seen.address, self.last_seen.rssi, at_door(self.last_seen))
+            if self.last_battery is not None:
+                status += " | battery: {} {}%{}".format(
+                    self.last_battery.address, self.last_battery.level,
+                    at_door(self.last_battery))
+            self.status.set_text(status)
+            if self.coin_status:
+                self.wait_prompt.top_w.base_widget.body[0].set_text(
+                    "\n".join(self.coin_status))
+
+        def handle_status(event):
+            apply_event(event)
+            if not self.redraw_pending:
+                self.redraw_pending = True
+                self.loop.set_alarm_in(FRAME_TIME, redraw)
+
+        self.app_logic = app_logic(handle_status)
+        self.members = MemberIndex(self.app_logic.get_usernames())
+        self.app_logic.start(self.event_loop)
+        try:
+            self.loop.run()
+        finally:
+            self.event_loop.run_until_complete(self.app_logic.shutdown())
+            self.event_loop.close()
+
+
+# opening and searching the member list with many members
+def _bench_member_list(count=10000):
+    import random
+    names = ['{}{:05d}'.format(random.choice(['Anna', 'Leon', 'Julia', 'Tom', 'Lena']), i)
+             for i in range(count)]
+    start = time.perf_counter()
+    index = MemberIndex(names)
+    print("index of {} names: {:.1f} ms".format(count, (time.perf_counter() - start) * 1000))
+    chooser = MemberChooser(index, None, None)
+    start = time.perf_counter()
+    chooser.render((40, 25), focus=True)
+    print("open and draw: {:.2f} ms, {} buttons".format(
+        (time.perf_counter() - start) * 1000, len(chooser.walker._widgets)))
+    start = time.perf_counter()
+    for key in 'julia0042':
+        chooser.keypress((40, 25), key)
+        chooser.render((40, 25), focus=True)
+    print("typing 9 keys: {:.2f} ms, {} matches".format(
+        (time.perf_counter() - start) * 1000, chooser.walker.end - chooser.walker.start))
 
 
 if __name__ == '__main__':
-    KeyKeeperManagerTUI(KeyKeeperManagerDummyLogic)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_member_list(*map(int, sys.argv[2:3]))
+    else:
+        if METRICS_FILE:
+            metrics.enable()
+        KeyKeeperManagerTUI(KeyKeeperManagerDummyLogic)
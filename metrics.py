@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+import asyncio
+import bisect
+import os
+import sys
+import threading
+import time
+
+# timings and counters of the hot paths, written to a file for the Prometheus
+# node exporter's textfile collector. Until enable() is called every call
+# returns right after checking a flag.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+_enabled = False
+_lock = threading.Lock()
+_families = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+# a metric and its children, one per combination of label values
+class _Family:
+    def __init__(self, kind, name, help, labels, buckets=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self.children = {}
+        # a metric without labels is exported as 0 before anything happened
+        if not self.labels:
+            self.child(())
+        _families.append(self)
+
+    def child(self, values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labels):
+                raise ValueError("{} needs labels {}".format(self.name, self.labels))
+            child = [0] * (len(self.buckets) + 3) if self.buckets else [0]
+            self.children[values] = child
+        return child
+
+
+def counter(name, help, labels=()):
+    return _Family('counter', name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _Family('histogram', name, help, labels, tuple(buckets))
+
+
+def inc(family, *labels, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        family.child(labels)[0] += n
+
+
+# a histogram child is [count per bucket..., count above the last bucket, count, sum]
+def observe(family, value, *labels):
+    if not _enabled:
+        return
+    with _lock:
+        child = family.child(labels)
+        child[bisect.bisect_left(family.buckets, value)] += 1
+        child[-2] += 1
+        child[-1] += value
+
+
+class _Timer:
+    __slots__ = ('family', 'labels', 'start')
+
+    def __init__(self, family, labels):
+        self.family = family
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.family, time.perf_counter() - self.start, *self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+# `with timed(histogram, label...):` observes how long the block took
+def timed(family, *labels):
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(family, labels)
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+# all metrics in the Prometheus text format
+def render():
+    lines = []
+    with _lock:
+        for family in _families:
+            lines.append('# HELP {} {}'.format(family.name, family.help))
+            lines.append('# TYPE {} {}'.format(family.name, family.kind))
+            for values, child in sorted(family.children.items()):
+                if family.kind == 'counter':
+                    lines.append('{}{} {}'.format(
+                        family.name, _label_text(family.labels, values), child[0]))
+                    continue
+                cumulative = 0
+                for bound, n in zip(family.buckets + ('+Inf',), child):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(family.name, _label_text(
+                        family.labels, values, [('le', bound)]), cumulative))
+                labels = _label_text(family.labels, values)
+                lines.append('{}_count{} {}'.format(family.name, labels, child[-2]))
+                lines.append('{}_sum{} {:.6f}'.format(family.name, labels, child[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+# the textfile collector may read at any time, so the file is replaced at once
+def write_textfile(filename):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, filename)
+
+
+# rewrite the file every `interval` seconds until cancelled
+async def export_periodically(filename, interval=15):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, write_textfile, filename)
+    finally:
+        write_textfile(filename)
+
+
+# cost of one timed block with metrics off and on
+def _bench_overhead(rounds=200000):
+    family = histogram('bench_seconds', 'benchmark', ('phase',))
+    for state in (False, True):
+        if state:
+            enable()
+        else:
+            disable()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            with timed(family, 'x'):
+                pass
+        elapsed = time.perf_counter() - start
+        print("{}: {:.0f} ns per timed block".format(
+            'enabled' if state else 'disabled', elapsed / rounds * 1e9))
+    disable()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_overhead()
+    else:
+        print("usage: {} bench".format(sys.argv[0]))
@@ -3,71 +3,286 @@
 import asyncio
 import subprocess
 import os
+import re
+import sys
 import time
-import RPi.GPIO as GPIO
+from collections import namedtuple
+from enum import IntEnum
+from coin_image import FLASH_PAGE_SIZE
+import metrics
+from status_bus import send, CoinProgress
 
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BOARD)
-GPIO.setup(13, GPIO.OUT)
-GPIO.output(13, GPIO.HIGH)
+
+# power of the coin on a programming station, the coin is off while the pin is high
+# RPi.GPIO only exists on the Pi, it is imported once the jig is switched, so
+# the sessions can be used (and tested) without it
+class PowerSwitch:
+    def __init__(self, pin):
+        import RPi.GPIO as GPIO
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BOARD)
+        self.gpio = GPIO
+        self.pin = pin
+        GPIO.setup(pin, GPIO.OUT)
+        GPIO.output(pin, GPIO.HIGH)
+
+    def shutdown(self):
+        self.gpio.output(self.pin, self.gpio.HIGH)
+        time.sleep(0.1)
+
+    def power(self):
+        self.gpio.output(self.pin, self.gpio.LOW)
+        time.sleep(0.1)
+
+    def powercycle(self):
+        self.shutdown()
+        self.power()
+
+_power_switch = None
+
+def _jig_switch():
+    global _power_switch
+    if _power_switch is None:
+        _power_switch = PowerSwitch(13)
+    return _power_switch
 
 def shutdown():
-    GPIO.output(13, GPIO.HIGH)
-    time.sleep(0.1)
+    _jig_switch().shutdown()
 
 def power():
-    GPIO.output(13, GPIO.LOW)
-    time.sleep(0.1)
+    _jig_switch().power()
 
 def powercycle():
-    shutdown()
-    power()
+    _jig_switch().powercycle()
+
+class ProgressType(IntEnum):
+    CHIP_DETECTED = 0
+    APPROTECT = 1
+    PROGRAMMING_STARTED = 2
+    ERASE_RANGE = 3
+    PROGRAMMING_FINISHED = 4
+    VERIFY_STARTED = 5
+    VERIFY_RESULT = 6
+    TIMEOUT = 7
+
+
+# typed progress events, str() is the message for the coin status pipe
+class ChipDetectedEvent(namedtuple('ChipDetectedEvent', ['chip', 'flash_kb'])):
+    __slots__ = ()
+    type = ProgressType.CHIP_DETECTED
+
+    def __str__(self):
+        return 'found {} with {}kB flash'.format(self.chip, self.flash_kb)
+
+
+class ApprotectEvent(namedtuple('ApprotectEvent', ['locked'])):
+    __slots__ = ()
+    type = ProgressType.APPROTECT
+
+    def __str__(self):
+        return 'coin is locked' if self.locked else 'coin is unlocked'
+
+
+class ProgrammingStartedEvent(namedtuple('ProgrammingStartedEvent', [])):
+    __slots__ = ()
+    type = ProgressType.PROGRAMMING_STARTED
+
+    def __bool__(self):
+        return True
+
+    def __str__(self):
+        return 'programming started'
+
+
+class EraseRangeEvent(namedtuple('EraseRangeEvent', ['start', 'end'])):
+    __slots__ = ()
+    type = ProgressType.ERASE_RANGE
+
+    def __str__(self):
+        return 'erasing 0x{:08x} .. 0x{:08x}'.format(self.start, self.end)
+
+
+class ProgrammingFinishedEvent(namedtuple('ProgrammingFinishedEvent', ['ok'])):
+    __slots__ = ()
+    type = ProgressType.PROGRAMMING_FINISHED
+
+    def __str__(self):
+        return 'programming finished' if self.ok else 'programming FAILED'
+
 
-async def _run_command(command):
+class VerifyStartedEvent(namedtuple('VerifyStartedEvent', [])):
+    __slots__ = ()
+    type = ProgressType.VERIFY_STARTED
+
+    def __bool__(self):
+        return True
+
+    def __str__(self):
+        return 'verifying'
+
+
+class VerifyResultEvent(namedtuple('VerifyResultEvent', ['ok'])):
+    __slots__ = ()
+    type = ProgressType.VERIFY_RESULT
+
+    def __str__(self):
+        return 'verified OK' if self.ok else 'verification FAILED'
+
+
+class TimeoutEvent(namedtuple('TimeoutEvent', ['phase', 'seconds'])):
+    __slots__ = ()
+    type = ProgressType.TIMEOUT
+
+    def __str__(self):
+        return 'openocd stuck while {} for {} s, aborted'.format(self.phase, self.seconds)
+
+
+_CHIP_LINE = re.compile(r"Info : (nRF528\w*-\w+)\(build code: \w+\) (\d+)kB Flash")
+_ERASE_LINE = re.compile(r"Warn : Adding extra erase range, 0x([0-9a-f]+) \.\. 0x([0-9a-f]+)")
+_MARKERS = {
+    '** Programming Started **': ProgrammingStartedEvent(),
+    '** Programming Finished **': ProgrammingFinishedEvent(True),
+    '** Programming Failed **': ProgrammingFinishedEvent(False),
+    '** Verify Started **': VerifyStartedEvent(),
+    '** Verified OK **': VerifyResultEvent(True),
+    '** Verify Failed **': VerifyResultEvent(False),
+    'nRF52 device has no active AP Protection. :)': ApprotectEvent(False),
+    'nRF52 device has active AP Protection. :/': ApprotectEvent(True),
+}
+
+
+# progress event of one line of openocd output, None for other lines
+def parse_progress(line):
+    line = line.strip()
+    event = _MARKERS.get(line)
+    if event is not None:
+        return event
+    m = _CHIP_LINE.match(line)
+    if m:
+        return ChipDetectedEvent(m[1], int(m[2]))
+    m = _ERASE_LINE.match(line)
+    if m:
+        return EraseRangeEvent(int(m[1], 16), int(m[2], 16))
+    return None
+
+
+_VERIFIED = re.compile(r"^verified \d+ bytes", re.MULTILINE)
+
+# longest silence from openocd in each phase before it counts as stuck
+PHASE_TIMEOUTS = {
+    'connecting': 10,
+    'programming': 30,
+    'verifying': 30,
+}
+
+# the phase an event starts
+_PHASES = {
+    ProgressType.PROGRAMMING_STARTED: 'programming',
+    ProgressType.VERIFY_STARTED: 'verifying',
+}
+
+
+STAGE_SECONDS = metrics.histogram(
+    'keykeeper_openocd_stage_seconds', 'time spent in each stage of writing a coin', ('stage',))
+
+
+# write a progress event or message to the coin status pipe
+def _report(status_pipe, event):
+    send(status_pipe, CoinProgress(event.type.name if hasattr(event, 'type') else '', str(event)))
+
+
+# run openocd and hand out progress events while its output comes in,
+# openocd is killed when it stays silent longer than the phase allows
+async def _stream_command(command, status_pipe=None, timeouts=PHASE_TIMEOUTS):
     proc = await asyncio.create_subprocess_shell(
         command,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL)
-    stdout, _ = await proc.communicate()
-    return stdout
+        stderr=asyncio.subprocess.STDOUT)
+    events = []
+    phase = 'connecting'
+    phase_start = time.perf_counter()
+    while True:
+        try:
+            line = await asyncio.wait_for(proc.stdout.readline(), timeouts[phase])
+        except asyncio.TimeoutError:
+            proc.kill()
+            event = TimeoutEvent(phase, timeouts[phase])
+            events.append(event)
+            _report(status_pipe, event)
+            break
+        if not line:
+            break
+        event = parse_progress(line.decode('utf8', errors='ignore'))
+        if event is not None:
+            if _PHASES.get(event.type, phase) != phase:
+                now = time.perf_counter()
+                metrics.observe(STAGE_SECONDS, now - phase_start, phase)
+                phase = _PHASES[event.type]
+                phase_start = now
+            events.append(event)
+            _report(status_pipe, event)
+    await proc.wait()
+    metrics.observe(STAGE_SECONDS, time.perf_counter() - phase_start, phase)
+    return events
 
-def program(hexfile='coin.hex'):
-    # command = 'python3 test_programming.py program'
-    command = 'openocd -c \"gdb_port disabled\" -c \"tcl_port disabled\" -c \"telnet_port disabled\" -f board.ocd -c \"program {} verify exit\"'
-    powercycle()
-    stdout = asyncio.run(_run_command(command)).decode('utf8')
-    shutdown()
+
+# did programming and verification succeed according to the progress events
+def _program_outcome(events):
     programmed = False
     verified = False
 
-    for line in stdout.split('\n'):
-        if '** Programming Finished **' in line:
-            programmed = True
-        elif '** Verified OK **' in line:
-            verified = True
+    for event in events:
+        if event.type == ProgressType.PROGRAMMING_FINISHED:
+            programmed = event.ok
+        elif event.type == ProgressType.VERIFY_RESULT:
+            verified = event.ok
+    return programmed, verified
+
+# did programming and verification succeed according to openocd's output
+def _parse_program_output(output):
+    return _program_outcome(
+        [e for e in map(parse_progress, output.split('\n')) if e is not None])
 
-    #os.write(status_pipe,"Programmed: {} Verified: {}".format(programmed, verified).encode('utf8'))
+# switch the power without holding up the event loop, powercycle() sleeps
+async def _switch(switch):
+    await asyncio.get_running_loop().run_in_executor(None, switch)
+
+async def program_async(hexfile='coin.hex', status_pipe=None):
+    # command = 'python3 test_programming.py program'
+    command = 'openocd -c \"gdb_port disabled\" -c \"tcl_port disabled\" -c \"telnet_port disabled\" -f board.ocd -c \"program {} verify exit\"'.format(hexfile)
+    await _switch(powercycle)
+    try:
+        events = await _stream_command(command, status_pipe)
+    finally:
+        await _switch(shutdown)
+    programmed, verified = _program_outcome(events)
     return programmed and verified
 
-def check():
+def program(hexfile='coin.hex', status_pipe=None):
+    return asyncio.run(program_async(hexfile, status_pipe))
+
+async def check_async(status_pipe=None):
     # command = 'python3 test_programming.py check_unlocked'
     command = 'openocd -c \"gdb_port disabled\" -c \"tcl_port disabled\" -c \"telnet_port disabled\" -f board.ocd -f check_approtect.ocd'
-    powercycle()
-    stdout = asyncio.run(_run_command(command)).decode('utf8')
-    shutdown()
+    await _switch(powercycle)
+    try:
+        events = await _stream_command(command, status_pipe)
+    finally:
+        await _switch(shutdown)
     chip_found = False
     locked = True
 
-    for line in stdout.split('\n'):
-        if 'nRF528' in line:
-            chip_found = True
-        if 'nRF52 device has no active AP Protection. :)' in line:
-            locked = False
-        if 'nRF52 device has active AP Protection. :/' in line:
-            locked = True
+    for event in events:
+        if event.type == ProgressType.CHIP_DETECTED:
             chip_found = True
+        elif event.type == ProgressType.APPROTECT:
+            locked = event.locked
+            chip_found = chip_found or event.locked
     return chip_found, locked
 
+def check(status_pipe=None):
+    return asyncio.run(check_async(status_pipe))
+
 def lock():
     powercycle()
     command = 'openocd -c \"gdb_port disabled\" -c \"tcl_port disabled\" -c \"telnet_port disabled\" -f board.ocd -f set_approtect.ocd'
@@ -81,6 +296,313 @@ def unlock():
         shutdown()
 
 
+# replies of keykeeper_check in session.ocd as (chip found, locked)
+_CHECK_STATES = {
+    'unlocked': (True, False),
+    'locked': (True, True),
+    'notfound': (False, False),
+}
+
+
+# outcome and duration in seconds of one provisioning step
+class ProvisionStep(namedtuple('ProvisionStep', ['name', 'ok', 'duration'])):
+    __slots__ = ()
+
+
+# outcome of provision_coin(), error says which step went wrong
+class ProvisionResult(namedtuple('ProvisionResult', ['ok', 'steps', 'error'])):
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        return sum(step.duration for step in self.steps)
+
+
+# one openocd for many operations, driven over its TCL RPC port
+# the session doesn't switch the power, callers powercycle() as needed
+class OpenOCDSession:
+    TERMINATOR = b'\x1a'
+
+    def __init__(self, config='board.ocd', port=6666, host='127.0.0.1', spawn=True,
+                 timeouts=PHASE_TIMEOUTS):
+        self.config = config
+        self.port = port
+        self.host = host
+        self.spawn = spawn
+        self.timeouts = timeouts
+        self._proc = None
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # launch openocd if it isn't running and connect to its TCL port
+    async def start(self, timeout=10):
+        if self.spawn and (self._proc is None or self._proc.returncode is not None):
+            self._proc = await asyncio.create_subprocess_exec(
+                'openocd',
+                '-c', 'gdb_port disabled',
+                '-c', 'telnet_port disabled',
+                '-c', 'tcl_port {}'.format(self.port),
+                '-c', 'bindto {}'.format(self.host),
+                '-f', self.config,
+                '-f', 'session.ocd',
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port)
+                return
+            except OSError:
+                if time.monotonic() > deadline or \
+                        (self._proc is not None and self._proc.returncode is not None):
+                    raise
+                await asyncio.sleep(0.1)
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    # openocd hangs in a command, the next command gets a fresh one
+    def _abort(self):
+        self._disconnect()
+        if self._proc is not None and self._proc.returncode is None:
+            self._proc.kill()
+
+    # run a TCL command and return its result, reconnects once if the link broke
+    # an openocd that doesn't answer within timeout seconds is killed
+    async def command(self, command, timeout=None):
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self.start()
+                    self._writer.write(command.encode('utf8') + self.TERMINATOR)
+                    await self._writer.drain()
+                    reply = await asyncio.wait_for(
+                        self._reader.readuntil(self.TERMINATOR), timeout)
+                    return reply[:-1].decode('utf8', errors='ignore')
+                except asyncio.TimeoutError:
+                    self._abort()
+                    raise
+                except (OSError, asyncio.IncompleteReadError):
+                    self._disconnect()
+                    if attempt > 0:
+                        raise
+
+    # same result as check(), raises ValueError when openocd answers something else
+    # than a state, a coin isn't taken for locked and erased on a garbled reply
+    async def check(self):
+        state = await self.command('keykeeper_check', self.timeouts['connecting'])
+        if state not in _CHECK_STATES:
+            raise ValueError("unexpected coin state from openocd: {!r}".format(state))
+        return _CHECK_STATES[state]
+
+    # same result as program()
+    async def program(self, hexfile='coin.hex', status_pipe=None):
+        programmed, verified = await self.program_and_verify(hexfile, status_pipe)
+        return programmed and verified
+
+    # output of a command that makes up a phase of writing a coin, None when
+    # openocd got stuck in it for longer than the phase allows
+    async def _phase(self, phase, command, status_pipe):
+        start = time.perf_counter()
+        try:
+            return await self.command(command, self.timeouts[phase])
+        except asyncio.TimeoutError:
+            _report(status_pipe, TimeoutEvent(phase, self.timeouts[phase]))
+            return None
+        finally:
+            metrics.observe(STAGE_SECONDS, time.perf_counter() - start, phase)
+
+    # (programmed, verified), writing and verifying are commands of their own,
+    # each with the timeout of its phase and reported as soon as it is over
+    async def program_and_verify(self, hexfile='coin.hex', status_pipe=None):
+        hexfile = os.path.abspath(hexfile)
+        _report(status_pipe, ProgrammingStartedEvent())
+        output = await self._phase('programming', 'keykeeper_write {{{}}}'.format(hexfile),
+                                   status_pipe)
+        if output is None:
+            return False, False
+        events = [e for e in map(parse_progress, output.split('\n')) if e is not None]
+        for event in events:
+            _report(status_pipe, event)
+        programmed, _ = _program_outcome(events)
+        if not programmed:
+            return False, False
+        _report(status_pipe, VerifyStartedEvent())
+        output = await self._phase('verifying', 'keykeeper_verify {{{}}}'.format(hexfile),
+                                   status_pipe)
+        if output is None:
+            return True, False
+        verified = _VERIFIED.search(output) is not None
+        _report(status_pipe, VerifyResultEvent(verified))
+        return True, verified
+
+    # does the flash hold this image, openocd compares checksums on the target
+    async def app_matches(self, hexfile):
+        output = await self.command('keykeeper_verify {{{}}}'.format(
+            os.path.abspath(hexfile)), self.timeouts['verifying'])
+        return _VERIFIED.search(output) is not None
+
+    # erase [start, start + size) and write and verify an image there
+    async def program_range(self, hexfile, start, size):
+        output = await self.command('keykeeper_program_range {{{}}} 0x{:x} 0x{:x}'.format(
+            os.path.abspath(hexfile), start, size), self.timeouts['programming'])
+        return _VERIFIED.search(output) is not None
+
+    async def lock(self):
+        return await self.command('keykeeper_lock', self.timeouts['connecting']) == 'ok'
+
+    # erase and unlock a locked chip
+    async def recover(self):
+        return await self.command('keykeeper_recover', self.timeouts['connecting']) == 'ok'
+
+    # check, recover if locked, program and verify, then lock the coin,
+    # all while the target is powered up once
+    async def provision(self, image='coin.hex', power_on=powercycle, power_off=shutdown,
+                        status_pipe=None):
+        async def program(step, locked):
+            if not await step('program', self.program(image, status_pipe)):
+                return 'programming failed'
+        return await self._provision(program, power_on, power_off)
+
+    # like provision(), with the image of `coin` built from a coin_image.FirmwareTemplate
+    # an unlocked coin that already runs the template's firmware only gets its key page
+    # rewritten, a locked one has to be erased and fully programmed
+    async def rekey(self, template, coin, power_on=powercycle, power_off=shutdown,
+                    status_pipe=None):
+        async def program(step, locked):
+            if not locked and await step('compare', self.app_matches(
+                    template.app_image_path()), required=False):
+                _report(status_pipe, 'firmware unchanged, rewriting keys only')
+                with template.temp_key_page(coin) as key_page:
+                    if not await step('program keys', self.program_range(
+                            key_page, template.key_page, FLASH_PAGE_SIZE)):
+                        return 'programming keys failed'
+                return None
+            with template.temp_image(coin) as image:
+                if not await step('program', self.program(image, status_pipe)):
+                    return 'programming failed'
+        return await self._provision(program, power_on, power_off)
+
+    # power, check and recover around program(step, locked), which returns an error or None
+    async def _provision(self, program, power_on, power_off):
+        steps = []
+
+        # a step that isn't required can't fail, it only asks something
+        async def step(name, coro, required=True):
+            start = time.perf_counter()
+            result = await coro
+            elapsed = time.perf_counter() - start
+            metrics.observe(STAGE_SECONDS, elapsed, name)
+            steps.append(ProvisionStep(name, bool(result) or not required, elapsed))
+            return result
+
+        start = time.perf_counter()
+        await _switch(power_on)
+        elapsed = time.perf_counter() - start
+        metrics.observe(STAGE_SECONDS, elapsed, 'power')
+        steps.append(ProvisionStep('power', True, elapsed))
+        try:
+            chip_found, locked = await step('check', self.check())
+            if not chip_found:
+                steps[-1] = steps[-1]._replace(ok=False)
+                return ProvisionResult(False, steps, 'couldn\'t find coin')
+            if locked and not await step('recover', self.recover()):
+                return ProvisionResult(False, steps, 'recovering locked coin failed')
+            error = await program(step, locked)
+            if error is not None:
+                return ProvisionResult(False, steps, error)
+            if not await step('lock', self.lock()):
+                return ProvisionResult(False, steps, 'locking failed')
+            return ProvisionResult(True, steps, None)
+        except asyncio.TimeoutError:
+            return ProvisionResult(False, steps, 'openocd stopped answering')
+        except ValueError as e:
+            return ProvisionResult(False, steps, str(e))
+        finally:
+            await _switch(power_off)
+
+    async def close(self):
+        if self._writer is not None:
+            # openocd drops the connection instead of answering
+            try:
+                self._writer.write(b'shutdown' + self.TERMINATOR)
+                await asyncio.wait_for(self._reader.read(), 5)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            self._disconnect()
+        if self._proc is not None:
+            await self._proc.wait()
+            self._proc = None
+
+
+# provision a coin with a session of its own
+def provision_coin(image='coin.hex'):
+    async def run():
+        async with OpenOCDSession() as session:
+            return await session.provision(image)
+    return asyncio.run(run())
+
+
+# check a coin through a session, against openocd or a fake TCL server
+async def _test_session(port=None):
+    session = OpenOCDSession(port=port or 6666, spawn=port is None)
+    async with session:
+        power()
+        chip_found, locked = await session.check()
+        shutdown()
+    print('chip found: {}, locked: {}'.format(chip_found, locked))
+
+
+# progress events of a canned openocd output from test_programming.py
+def _test_stream(name='program', idle_timeout=None):
+    timeouts = PHASE_TIMEOUTS if idle_timeout is None else \
+        dict.fromkeys(PHASE_TIMEOUTS, idle_timeout)
+    events = asyncio.run(_stream_command(
+        'python3 test_programming.py {}'.format(name), None, timeouts))
+    for event in events:
+        print(event)
+    print('programmed: {}, verified: {}'.format(*_program_outcome(events)))
+
+
+# re-keying a coin fully and by its key page, against a simulated flash
+# written at about the speed of a J-Link at 1000 kHz
+async def _bench_rekey(rate=40000):
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import _coin_material
+    from test_programming import FakeOpenOCDTclServer, SimulatedFlash
+    template = FirmwareTemplate(*_synthetic_base())
+    first, second, third = _coin_material(3, set())
+    server = await FakeOpenOCDTclServer(flash=SimulatedFlash(rate)).start()
+    async with OpenOCDSession(port=server.port, spawn=False) as session:
+        no_power = lambda: None
+        with template.temp_image(second) as second_image:
+            for label, run in [
+                    ('new coin', session.rekey(template, first, no_power, no_power)),
+                    ('full re-key', session.provision(second_image, no_power, no_power)),
+                    ('key page re-key', session.rekey(template, third, no_power, no_power))]:
+                server.chip = 'unlocked'
+                result = await run
+                print('{:<16} {:<5} {:6.2f} s  {}'.format(
+                    label, 'ok' if result.ok else 'FAIL', result.duration,
+                    ', '.join(step.name for step in result.steps)))
+    await server.close()
+    from coin_image import parse_hex
+    assert server.flash.diff(parse_hex(template.image(third).splitlines())[0]) is None
+
+
 def _test_oocdmgr():
     chip_found, locked = check()
     if chip_found and locked:
@@ -97,4 +619,16 @@ def _test_oocdmgr():
     '''
 
 if __name__ == "__main__":
-    _test_oocdmgr()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'session':
+        asyncio.run(_test_session(*map(int, sys.argv[2:3])))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench_rekey':
+        asyncio.run(_bench_rekey(*map(int, sys.argv[2:3])))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'stream':
+        _test_stream(*sys.argv[2:3], *map(float, sys.argv[3:4]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'provision':
+        result = provision_coin(*sys.argv[2:3])
+        for step in result.steps:
+            print('{:<8} {:<5} {:6.2f} s'.format(step.name, 'ok' if step.ok else 'FAIL', step.duration))
+        print(result.error or 'coin provisioned in {:.2f} s'.format(result.duration))
+    else:
+        _test_oocdmgr()
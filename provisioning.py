@@ -0,0 +1,391 @@
+#!/usr/bin/python3
+
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from key_db import addr_key, _write_atomic
+from status_bus import send, CoinProgress
+import oocd
+
+# what has been done for a member's coin, in this order
+STEPS = ('queued', 'key', 'image', 'flashed', 'verified', 'locked', 'synced')
+
+
+# how far a member's coin got, address is set once the key exists
+class Job:
+    __slots__ = ('name', 'step', 'address')
+
+    def __init__(self, name, step='queued', address=None):
+        self.name = name
+        self.step = step
+        self.address = address
+
+    def done(self, step):
+        return STEPS.index(self.step) >= STEPS.index(step)
+
+    def __repr__(self):
+        return 'Job({}, {})'.format(self.name, self.step)
+
+
+# the jobs and their steps, every step is appended and fsynced before the next
+# one starts, a torn last line from a power loss is dropped on the next start
+class JobJournal:
+    def __init__(self, filename='provisioning.journal'):
+        self.filename = filename
+        self.jobs = OrderedDict()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply(record)
+        # start over from the current state, one line per job
+        _write_atomic(filename, ''.join(
+            json.dumps(self._record(job.name, job.step, job.address)) + '\n'
+            for job in self.jobs.values()))
+        self._file = open(filename, 'a')
+
+    @staticmethod
+    def _record(name, step, address):
+        record = {'name': name, 'step': step}
+        if address is not None:
+            record['address'] = address
+        return record
+
+    def _apply(self, record):
+        job = self.jobs.get(record['name'])
+        if job is None:
+            job = self.jobs[record['name']] = Job(record['name'])
+        job.step = record['step']
+        job.address = record.get('address', job.address)
+
+    def record(self, name, step, address=None):
+        record = self._record(name, step, address)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._apply(record)
+
+    def close(self):
+        self._file.close()
+
+
+async def _switch(switch):
+    await asyncio.get_running_loop().run_in_executor(None, switch)
+
+
+# provisions queued members one coin after the other, as the coins are put on the jig
+# a member keeps the key generated for them, a coin lost in between gets the same one
+class ProvisioningQueue:
+    POLL_INTERVAL = 1
+    SYNC_TIMEOUT = 30
+
+    def __init__(self, db, template, session, journal='provisioning.journal',
+                 image_dir='images', status_pipe=None, sync=None,
+                 power_on=oocd.powercycle, power_off=oocd.shutdown):
+        self.db = db
+        self.template = template
+        self.session = session
+        self.journal = JobJournal(journal)
+        self.image_dir = image_dir
+        self.status_pipe = status_pipe
+        self.sync = sync
+        self.power_on = power_on
+        self.power_off = power_off
+
+    def _report(self, text):
+        send(self.status_pipe, CoinProgress('QUEUE', text))
+
+    # queue members, returns {name: error} of the ones refused
+    # a member whose coin is done gets another one only with replace, with new
+    # keys and a new address, so the old coin stops opening the door
+    def enqueue(self, names, replace=False):
+        errors = {}
+        for name in names:
+            job = self.journal.jobs.get(name)
+            if job is None:
+                self.journal.record(name, 'queued')
+            elif job.done('locked'):
+                if not replace:
+                    errors[name] = "has a coin already"
+                elif not self.db.rekey_coin(name):
+                    errors[name] = "user cannot be found"
+                else:
+                    # saved before the journal names the new address, like in _prepare()
+                    self.db.save()
+                    self.journal.record(name, 'key',
+                                        self.db.coins[self.db.names[name]].address_str)
+        return errors
+
+    # jobs that still need a coin
+    def pending(self):
+        return [job for job in self.journal.jobs.values() if not job.done('locked')]
+
+    def _image_path(self, job):
+        return os.path.join(self.image_dir, 'coin_{}.hex'.format(
+            job.address.replace(':', '').lower()))
+
+    # keys for all new members in one go, then their images
+    # returns {name: error} for the jobs that can't continue
+    def _prepare(self, jobs):
+        errors = {}
+        new = [job.name for job in jobs if job.step == 'queued' and job.name not in self.db.names]
+        if new:
+            for _, name, error in self.db.generate_coins(new):
+                errors[name] = error
+            # the keys are saved before the journal names them, so a crash in
+            # between finds them in the database instead of making new ones
+            self.db.save()
+        os.makedirs(self.image_dir, exist_ok=True)
+        for job in jobs:
+            if job.name in errors:
+                continue
+            if job.step == 'queued':
+                self.journal.record(job.name, 'key',
+                                    self.db.coins[self.db.names[job.name]].address_str)
+            coin = self.db.coins.get(addr_key(job.address))
+            if coin is None or self.db.name_of(coin.address) != job.name:
+                errors[job.name] = "coin changed since it was queued"
+                continue
+            # images are rebuilt when lost, they always come out the same
+            if job.step == 'key' or not os.path.exists(self._image_path(job)):
+                with open(self._image_path(job), 'w') as f:
+                    self.template.write_image(coin, f)
+                if job.step == 'key':
+                    self.journal.record(job.name, 'image')
+        return errors
+
+    # power the jig until a coin answers, returns whether it is locked
+    async def _wait_for_coin(self):
+        waiting = False
+        while True:
+            await _switch(self.power_on)
+            chip_found, locked = await self.session.check()
+            if chip_found:
+                return locked
+            await _switch(self.power_off)
+            if not waiting:
+                self._report("waiting for a coin on the jig")
+                waiting = True
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _wait_for_removal(self):
+        self._report("take the coin off the jig")
+        while True:
+            await _switch(self.power_on)
+            try:
+                chip_found, _ = await self.session.check()
+            finally:
+                await _switch(self.power_off)
+            if not chip_found:
+                return
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def _step(self, job, step):
+        self.journal.record(job.name, step)
+        self._report("{}: {}".format(job.name, step))
+
+    # continue a job from its last step with the coin on the jig, returns an error or None
+    async def _provision(self, job):
+        coin = self.db.coins[addr_key(job.address)]
+        image = self._image_path(job)
+        try:
+            locked = await self._wait_for_coin()
+            # a locked coin is someone's finished coin, unless the journal says
+            # this job got as far as locking its own and the record didn't make it
+            while locked and not job.done('verified'):
+                self._report("{}: the coin on the jig is locked".format(job.name))
+                await self._wait_for_removal()
+                locked = await self._wait_for_coin()
+            if locked:
+                # verified and locked, only the journal didn't get to know
+                self._step(job, 'locked')
+                return None
+            if job.step == 'flashed':
+                if await self.session.app_matches(image):
+                    self._step(job, 'verified')
+                else:
+                    self._step(job, 'image')
+            if job.step == 'image':
+                # same firmware already on the coin, only its key page is written
+                if await self.session.app_matches(self.template.app_image_path()):
+                    with self.template.temp_key_page(coin) as key_page:
+                        programmed = verified = await self.session.program_range(
+                            key_page, self.template.key_page, oocd.FLASH_PAGE_SIZE)
+                else:
+                    programmed, verified = await self.session.program_and_verify(
+                        image, self.status_pipe)
+                if programmed:
+                    self._step(job, 'flashed')
+                if not programmed:
+                    return "programming failed"
+                if not verified:
+                    return "verification failed"
+                self._step(job, 'verified')
+            if not await self.session.lock():
+                return "locking failed"
+            self._step(job, 'locked')
+            return None
+        except asyncio.TimeoutError:
+            return "openocd stopped answering"
+        except ValueError as e:
+            return str(e)
+        finally:
+            await _switch(self.power_off)
+
+    def _report_rate(self, done, total, started):
+        elapsed = time.monotonic() - started
+        rate = done / elapsed
+        eta = (total - done) / rate
+        self._report("{}/{} coins, {:.1f} coins/min, ETA {}min {:02d}s".format(
+            done, total, rate * 60, int(eta // 60), int(eta % 60)))
+
+    # wait until the central knows the locked coins
+    async def _sync(self):
+        jobs = [job for job in self.journal.jobs.values()
+                if job.done('locked') and not job.done('synced')]
+        if not jobs:
+            return
+        if self.sync is not None:
+            try:
+                await asyncio.wait_for(self.sync(), self.SYNC_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._report("{} coins aren't on the central yet".format(len(jobs)))
+                return
+        for job in jobs:
+            self._step(job, 'synced')
+
+    # one attempt at the pending jobs of `names`, failed ones stay queued with
+    # their steps, returns {name: error} of the failed jobs
+    async def run(self, names):
+        names = set(names)
+        jobs = [job for job in self.pending() if job.name in names]
+        errors = self._prepare(jobs)
+        jobs = [job for job in jobs if job.name not in errors]
+        started = time.monotonic()
+        for i, job in enumerate(jobs):
+            error = await self._provision(job)
+            if error is not None:
+                errors[job.name] = error
+                self._report("{}: {}".format(job.name, error))
+            self._report_rate(i + 1, len(jobs), started)
+            if i + 1 < len(jobs):
+                await self._wait_for_removal()
+        await self._sync()
+        return errors
+
+    # one attempt at every job an earlier run left unfinished
+    async def resume(self):
+        return await self.run([job.name for job in self.pending()])
+
+    def close(self):
+        self.journal.close()
+
+
+# a jig with an operator: a locked coin is taken off and a blank one put on
+async def _simulated_jig(server, handling=0.3):
+    while True:
+        await asyncio.sleep(0.05)
+        if server.chip == 'locked':
+            await asyncio.sleep(handling)
+            server.chip = 'notfound'
+            await asyncio.sleep(handling)
+            server.flash.mass_erase()
+            server.chip = 'unlocked'
+
+
+# provision `count` members on a simulated jig, crash in the middle
+# and resume, then check that no member got a second key
+async def _test_resume(count=5, directory=None):
+    import tempfile
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import KeykeeperDB
+    from test_programming import FakeOpenOCDTclServer
+    directory = directory or tempfile.mkdtemp()
+    db_file = os.path.join(directory, 'db.json')
+    journal = os.path.join(directory, 'provisioning.journal')
+    images = os.path.join(directory, 'images')
+    template = FirmwareTemplate(*_synthetic_base())
+    names = ['member{}'.format(i) for i in range(count)]
+    server = await FakeOpenOCDTclServer().start()
+    jig = asyncio.ensure_future(_simulated_jig(server))
+    no_power = lambda: None
+
+    class Crash(Exception):
+        pass
+
+    async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+        queue = ProvisioningQueue(KeykeeperDB(db_file), template, session, journal, images,
+                                  power_on=no_power, power_off=no_power)
+        queue.POLL_INTERVAL = 0.1
+        queue.enqueue(names)
+        record = queue.journal.record
+
+        # power loss right after the middle coin got flashed
+        def crashing_record(name, step, address=None):
+            record(name, step, address)
+            if name == names[count // 2] and step == 'flashed':
+                raise Crash()
+        queue.journal.record = crashing_record
+        try:
+            await queue.run(names)
+        except Crash:
+            pass
+        queue.close()
+        before = {job.name: (job.step, job.address) for job in queue.journal.jobs.values()}
+
+        db = KeykeeperDB(db_file)
+        queue = ProvisioningQueue(db, template, session, journal, images,
+                                  power_on=no_power, power_off=no_power)
+        queue.POLL_INTERVAL = 0.1
+        errors = await queue.resume()
+        after = {job.name: (job.step, job.address) for job in queue.journal.jobs.values()}
+        queue.close()
+    jig.cancel()
+    await server.close()
+
+    for name in names:
+        print('{:<10} {:<9} -> {:<7} {}'.format(name, before[name][0], after[name][0], after[name][1]))
+    assert not errors, errors
+    assert len(db.coins) == count
+    assert all(after[name][1] == before[name][1] for name in names if before[name][1])
+    assert all(after[name][0] == 'synced' for name in names)
+
+
+# coins per minute through the queue with a simulated operator
+async def _bench_queue(count=20, handling=0.3):
+    import tempfile
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import KeykeeperDB
+    from test_programming import FakeOpenOCDTclServer
+    directory = tempfile.mkdtemp()
+    server = await FakeOpenOCDTclServer().start()
+    jig = asyncio.ensure_future(_simulated_jig(server, handling))
+    no_power = lambda: None
+    async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+        queue = ProvisioningQueue(
+            KeykeeperDB(os.path.join(directory, 'db.json')),
+            FirmwareTemplate(*_synthetic_base()), session,
+            os.path.join(directory, 'provisioning.journal'), os.path.join(directory, 'images'),
+            status_pipe=lambda event: print(event.text) if 'ETA' in event.text else None,
+            power_on=no_power, power_off=no_power)
+        queue.POLL_INTERVAL = 0.1
+        names = ['member{}'.format(i) for i in range(count)]
+        queue.enqueue(names)
+        errors = await queue.run(names)
+        queue.close()
+    jig.cancel()
+    await server.close()
+    print('{} failed'.format(len(errors)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        asyncio.run(_bench_queue(*map(int, sys.argv[2:3])))
+    else:
+        asyncio.run(_test_resume(*map(int, sys.argv[1:2])))
@@ -1,14 +1,22 @@
 #!/usr/bin/python3
 import re
-import aioserial
+import json
 import asyncio
 import multiprocessing
+import serial
 import serial.serialutil
 import os
 import sys
 import time
-from key_db import KeykeeperDB
+import getpass
+import glob
+from key_db import KeykeeperDB, open_db, addr_key, addr_key_to_str
+import metrics
+from access_log import AccessKind
+from status_bus import send, FrameDecoder, CentralStatus, CoinSeen, BatteryLevel, \
+    CoinAuthenticated
 from enum import IntEnum
+from collections import namedtuple, deque
 
 
 class StatusType(IntEnum):
@@ -20,57 +28,489 @@ class StatusType(IntEnum):
     DISCONNECTED = 5
 
 
+# typed status events, one per StatusType
+class IdentityEvent(namedtuple('IdentityEvent', ['address', 'addr_type'])):
+    __slots__ = ()
+    type = StatusType.IDENTITY
+
+
+class DeviceFoundEvent(namedtuple('DeviceFoundEvent', ['address', 'rssi', 'addr_type', 'bonded'])):
+    __slots__ = ()
+    type = StatusType.DEVICE_FOUND
+
+
+class BatteryLevelEvent(namedtuple('BatteryLevelEvent', ['level'])):
+    __slots__ = ()
+    type = StatusType.BATTERY_LEVEL
+
+
+class ConnectedEvent(namedtuple('ConnectedEvent', ['address'])):
+    __slots__ = ()
+    type = StatusType.CONNECTED
+
+
+class AuthenticatedEvent(namedtuple('AuthenticatedEvent', [])):
+    __slots__ = ()
+    type = StatusType.AUTHENTICATED
+
+    # an empty tuple would be falsy, but an event is always something
+    def __bool__(self):
+        return True
+
+
+class DisconnectedEvent(namedtuple('DisconnectedEvent', ['address', 'reason'])):
+    __slots__ = ()
+    type = StatusType.DISCONNECTED
+
+
+# log tags the central prefixes its status messages with
+_APP_TAG = '<inf> app: '
+_HCI_TAG = '<inf> bt_hci_core: '
+
+# (message prefix, pattern for the rest of the line, event constructor)
+# the prefix decides which single pattern is tried, ordered by frequency
+_APP_PATTERNS = (
+    ('Device found: ', re.compile(r"\[(.{17})\] \(RSSI (-?\d+)\) \(TYPE (\d)\) \(BONDED (\d)\)"),
+     lambda m: DeviceFoundEvent(m[1], int(m[2]), int(m[3]), m[4] == '1')),
+    ('Battery Level: ', re.compile(r"(\d{1,3})%"),
+     lambda m: BatteryLevelEvent(int(m[1]))),
+    ('Connected: ', re.compile(r"\[(.{17})\]"),
+     lambda m: ConnectedEvent(m[1])),
+    ('Disconnected: ', re.compile(r"\[(.{17})\] \(reason (\d+)\)"),
+     lambda m: DisconnectedEvent(m[1], int(m[2]))),
+    ('KEY AUTHENTICATED. OPEN DOOR PLEASE.', re.compile(r""),
+     lambda m: AuthenticatedEvent()),
+)
+_HCI_PATTERNS = (
+    ('Identity: ', re.compile(r"(.{17}) \((.*)\)"),
+     lambda m: IdentityEvent(m[1], m[2])),
+)
+
+
+# parse a status message into a typed event, returns None for other lines
+def parse_status(line):
+    i = line.find(_APP_TAG)
+    if i >= 0:
+        i += len(_APP_TAG)
+        patterns = _APP_PATTERNS
+    else:
+        i = line.find(_HCI_TAG)
+        if i < 0:
+            return None
+        i += len(_HCI_TAG)
+        patterns = _HCI_PATTERNS
+    for prefix, pattern, make_event in patterns:
+        if line.startswith(prefix, i):
+            m = pattern.match(line, i + len(prefix))
+            return make_event(m) if m else None
+    return None
+
+
+# serial port of the keykeeper central
+CENTRAL_PORT = '/dev/serial/by-id/usb-ZEPHYR_N39_BLE_KEYKEEPER_0.01-if00'
+# the ports of all centrals, one per door, the part matching * names the door
+CENTRAL_PORTS = '/dev/serial/by-id/usb-ZEPHYR_N39_BLE_KEYKEEPER_*-if00'
+
+# lines of the `stats bonds` and `stats spacekey` listings
+_BOND_LINE = re.compile(r"\[(.{17})\] keys: 34, flags: 17\r\n")
+_SPACEKEY_LINE = re.compile(r"\[(.{17})\] : ([A-F0-9]{2})\.\.\.\r\n")
+
+
 class Coin:
     def __init__(self):
         self.battery_level = 0
         self.address = "00:00:00:00:00:00"
+        self.authenticated = False
+
+
+# color codes the central's shell decorates its output with
+_ANSI_ESCAPE = re.compile(rb'''
+    \x1B    # ESC
+    [@-_]   # 7-bit C1 Fe
+    [0-?]*  # Parameter bytes
+    [ -/]*  # Intermediate bytes
+    [@-~]   # Final byte
+''', flags=re.VERBOSE)
+
+
+# serial port read directly by the event loop, yields plain lines
+class SerialLineReader:
+    def __init__(self, port, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self._serial = serial.Serial(port=port, timeout=0)
+        self._fd = self._serial.fileno()
+        self._buffer = bytearray()
+        self._lines = deque()
+        self._error = None
+        self._waiter = None
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    # called by the event loop whenever the port has data
+    def _on_readable(self):
+        try:
+            chunk = os.read(self._fd, self.chunk_size)
+            if not chunk:
+                raise serial.serialutil.SerialException(
+                    'device reports readiness to read but returned no data')
+        except (OSError, serial.serialutil.SerialException) as e:
+            self._fail(e)
+            return
+        self._buffer += chunk
+        end = self._buffer.rfind(b'\n') + 1
+        if end == 0:
+            return
+        # only strip complete lines, an escape sequence may be cut in half
+        text = _ANSI_ESCAPE.sub(b'', self._buffer[:end]).decode(errors='ignore')
+        del self._buffer[:end]
+        lines = text.split('\n')
+        lines.pop()
+        self._lines.extend(l + '\n' for l in lines)
+        self._wake()
+
+    def _fail(self, e):
+        if not isinstance(e, serial.serialutil.SerialException):
+            e = serial.serialutil.SerialException(str(e))
+        self._error = e
+        self._loop.remove_reader(self._fd)
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def readline(self):
+        while not self._lines:
+            if self._error is not None:
+                raise self._error
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._lines.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.readline()
+
+    def write(self, data):
+        try:
+            return self._serial.write(data)
+        except OSError as e:
+            raise serial.serialutil.SerialException(str(e))
+
+    def close(self):
+        if self._error is None:
+            self._loop.remove_reader(self._fd)
+            self._error = serial.serialutil.SerialException('port closed')
+            self._wake()
+        self._serial.close()
+
+
+COMMAND_SECONDS = metrics.histogram(
+    'keykeeper_central_command_seconds',
+    'time from sending a shell command to the central until its done', ('command',))
+SYNC_PHASE_SECONDS = metrics.histogram(
+    'keykeeper_sync_phase_seconds', 'time spent in each phase of syncing a central', ('phase',))
+RECONNECTS = metrics.counter(
+    'keykeeper_central_reconnects_total', 'connections to the central after the first one')
+SERIAL_ERRORS = metrics.counter(
+    'keykeeper_serial_exceptions_total', 'SerialExceptions on the central port')
+
+
+# command name without its arguments, `coin add` keeps its subcommand
+def _command_label(command):
+    words = command.split(' ', 2)
+    if words[0] in ('coin', 'stats', 'settings') and len(words) > 1:
+        return ' '.join(words[:2])
+    return words[0]
+
+
+# replies of the shell to a command it couldn't run, and errors a command prints
+# itself. Log messages come with a timestamp, they may be from anything running
+# on the central and never mark a command as failed.
+_SHELL_ERROR = re.compile(r"<err> |[\w ]+: (?:command not found|wrong parameter count)")
+
+
+# outcome of one shell command, output excludes the final `done`
+class CommandResult(namedtuple('CommandResult', ['command', 'ok', 'output'])):
+    __slots__ = ()
+
+
+# pipelined shell commands, keeps up to `window` commands waiting for their `done`
+# the shell runs commands in order, so the n-th `done` belongs to the n-th command
+class CommandChannel:
+    def __init__(self, central_serial, window=4, timeout=5):
+        assert window >= 1
+        self.central_serial = central_serial
+        self.window = window
+        self.timeout = timeout
+
+    # send commands and collect one CommandResult per command, in order
+    async def execute(self, commands):
+        results = []
+        queued = deque(commands)
+        in_flight = deque()
+        while queued or in_flight:
+            while queued and len(in_flight) < self.window:
+                command = queued.popleft()
+                self.central_serial.write(
+                    '{}\r\n'.format(command).encode('ASCII'))
+                in_flight.append((command, [], time.perf_counter()))
+            try:
+                line = await asyncio.wait_for(
+                    self.central_serial.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                # a late `done` couldn't be told apart from the one of the next
+                # command, so none of the remaining results can be trusted
+                for command, output, sent in in_flight:
+                    results.append(CommandResult(command, False, output + ['timeout']))
+                results.extend(CommandResult(command, False, ['not sent']) for command in queued)
+                break
+            if line == 'done\r\n':
+                command, output, sent = in_flight.popleft()
+                metrics.observe(COMMAND_SECONDS, time.perf_counter() - sent,
+                                _command_label(command))
+                ok = not any(_SHELL_ERROR.match(l) for l in output)
+                results.append(CommandResult(command, ok, output))
+                continue
+            # the shell echoes a command once it starts running it, so an echo
+            # of a later command means the ones before it ended without `done`
+            echoed = line.rstrip('\r\n')
+            for i in range(1, len(in_flight)):
+                command = in_flight[i][0]
+                if command != in_flight[0][0] and echoed.endswith(command):
+                    for _ in range(i):
+                        command, output, sent = in_flight.popleft()
+                        results.append(CommandResult(command, False, output))
+                    break
+            in_flight[0][1].append(line)
+        return results
+
+
+# one step of a sync plan, command is what gets sent to the shell
+class SyncStep(namedtuple('SyncStep', ['action', 'address', 'command'])):
+    __slots__ = ()
+
+    # printable without the key material
+    def __str__(self):
+        return '{:<6} {}'.format(self.action, self.address or '').rstrip()
+
+
+# plan the commands that make a central match the database
+# bonds and spacekeys are the (address, ...) tuples read back from the central
+def plan_sync(central_identity, bonds, spacekeys, db):
+    identity_addr, identity_irk = db.identity
+    setup = SyncStep('setup', identity_addr, 'central_setup {} {}'.format(
+        identity_addr, identity_irk))
+    # the central only shows the first spacekey byte
+    prefixes = {addr_key(addr): int(prefix, 16) for addr, prefix in spacekeys}
+    bonded = {addr_key(addr) for addr, in bonds}
+
+    # a foreign identity or bonds without spacekeys (or vice versa) can't be
+    # repaired coin by coin, so start over from an empty central
+    if (central_identity is not None and addr_key(central_identity) != addr_key(identity_addr)) \
+            or len(bonded) != len(bonds) or len(prefixes) != len(spacekeys) \
+            or bonded != prefixes.keys():
+        plan = [SyncStep('clear', None, 'settings clear'), setup]
+        prefixes = {}
+    elif central_identity is None:
+        plan = [setup]
+    else:
+        plan = []
+
+    present = set()
+    for addr, prefix in prefixes.items():
+        coin = db.coins.get(addr)
+        if coin is None or coin.spacekey[0] != prefix:
+            plan.append(_del_step(addr))
+        else:
+            present.add(addr)
+    for addr, coin in db.coins.items():
+        if addr not in present:
+            plan.append(_add_step(coin))
+    return plan
+
+
+def _add_step(coin):
+    addr = coin.address_str
+    return SyncStep('add', addr, 'coin add {} {} {} {}'.format(addr, *coin.hex_keys()))
+
+
+def _del_step(addr):
+    addr = addr_key_to_str(addr)
+    return SyncStep('del', addr, 'coin del {}'.format(addr))
+
+
+# commands for a batch of database changes (see KeykeeperDB._change) made since
+# the central was last in sync, and whether it needs a full resync instead
+# a coin added and removed again within the batch never reaches the central
+def plan_changes(changes):
+    net = {}
+    for change in changes:
+        op = change[0]
+        if op == 'add':
+            net[change[2].address] = change[2]
+        elif op == 'del':
+            if net.get(change[2]) is not None:
+                del net[change[2]]
+            else:
+                net[change[2]] = None
+        else:
+            return [], True
+    return [_del_step(addr) if coin is None else _add_step(coin)
+            for addr, coin in net.items()], False
+
+
+# database fingerprint and bond count last synced to each central, by port and
+# central identity. Every door has entries of its own, a central that was
+# unplugged while the others got a change must not pass for synced.
+class SyncState:
+    def __init__(self, filename='sync_state.json'):
+        self.filename = filename
+        try:
+            with open(filename, 'r') as f:
+                self.ports = json.load(f)['ports']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.ports = {}
+
+    # the state of the central on one port
+    def view(self, port):
+        return PortSyncState(self, os.path.basename(port))
+
+    def _save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'ports': self.ports}, f)
+        os.replace(tmp, self.filename)
+
+
+class PortSyncState:
+    def __init__(self, sync_state, port):
+        self.sync_state = sync_state
+        self.port = port
+
+    def is_synced(self, identity, bond_count, fingerprint):
+        return self.sync_state.ports.get(self.port, {}).get(identity) == {
+            'fingerprint': fingerprint, 'bonds': bond_count}
+
+    def record(self, identity, bond_count, fingerprint):
+        self.sync_state.ports.setdefault(self.port, {})[identity] = {
+            'fingerprint': fingerprint, 'bonds': bond_count}
+        self.sync_state._save()
+
+    def forget(self, identity):
+        if self.sync_state.ports.get(self.port, {}).pop(identity, None) is not None:
+            self.sync_state._save()
 
 
 class KeykeeperSerialMgr:
-    def __init__(self, db, status_pipe):
+    # database changes arriving within this many seconds are pushed together
+    BATCH_DELAY = 0.5
+
+    # access attempts go to access_log, an access_log.AccessLog or None,
+    # battery readings to battery, a battery.BatteryStore or None
+    # managers of several centrals share one SyncState, passed as sync_state,
+    # each one only sees the entries of its own port
+    def __init__(self, db, status_pipe, command_window=4, sync_state_file='sync_state.json',
+                 access_log=None, battery=None, port=CENTRAL_PORT, door=None, sync_state=None):
         self.config_mode = True
         self.db = db
         self.status_pipe = status_pipe
+        self.port = port
+        self.door = door
+        self.access_log = access_log
+        self.battery = battery
+        self.command_window = command_window
+        if sync_state is None:
+            sync_state = SyncState(sync_state_file)
+        self.sync_state = sync_state.view(port)
+        self._changes = []
+        self._changes_ready = asyncio.Event()
+        self._flush_timer = None
+        self._synced = asyncio.Event()
+        db.subscribe(self.notify)
 
-    # read line and remove color codes
-    async def _serial_fetch_line(self):
-        line = (await self.central_serial.readline_async()).decode(errors='ignore')
-        plain_line = re.sub(r'''
-            \x1B    # ESC
-            [@-_]   # 7-bit C1 Fe
-            [0-?]*  # Parameter bytes
-            [ -/]*  # Intermediate bytes
-            [@-~]   # Final byte
-        ''', '', line, flags=re.VERBOSE)
-        return plain_line
-
-    # parse status messages
-    def _parse_status(self, l):
-        regs = {
-            StatusType.IDENTITY: r"<inf> bt_hci_core: Identity: (.{17}) \((.*)\)",
-            StatusType.DEVICE_FOUND: r"<inf> app: Device found: \[(.{17})\] \(RSSI (-?\d+)\) \(TYPE (\d)\) \(BONDED (\d)\)",
-            StatusType.BATTERY_LEVEL: r"<inf> app: Battery Level: (\d{1,3})%",
-            StatusType.CONNECTED: r"<inf> app: Connected: \[(.{17})\]",
-            StatusType.AUTHENTICATED: r"<inf> app: KEY AUTHENTICATED. OPEN DOOR PLEASE.",
-            StatusType.DISCONNECTED: r"<inf> app: Disconnected: \[(.{17})\] \(reason (\d+)\)",
-        }
-        for k in regs:
-            m = re.search(pattern=regs[k], string=l)
-            if m:
-                return k, m.groups()
-        return None, None
+    def _status(self, text):
+        send(self.status_pipe, CentralStatus(text, self.door))
+
+    # returns once the central has every change made to the database so far
+    async def wait_synced(self):
+        await self._synced.wait()
+
+    # called by the database for every modification, pushed to the running
+    # central in batches, a central in config mode gets the whole database anyway
+    def notify(self, changes):
+        self._changes.extend(changes)
+        self._synced.clear()
+        if self._flush_timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._flush_timer = loop.call_later(self.BATCH_DELAY, self._changes_ready.set)
+
+    def _take_changes(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._changes_ready.clear()
+        changes, self._changes = self._changes, []
+        return changes
+
+    # a central that can't follow the changes one by one gets fully synced
+    def _resync(self):
+        self.sync_state.forget(self.identity)
+        self.config_mode = True
+        self.central_serial.write(b'reboot\r\n')
+
+    # apply database changes to the central while it is scanning
+    async def _push_changes(self):
+        steps, resync = plan_changes(self._take_changes())
+        # the database as of this batch, changes made while it is sent come
+        # with the next one
+        fingerprint = self.db.fingerprint()
+        bond_count = len(self.db.coins)
+        if resync:
+            self._status("identity changed, resynchronizing")
+            self._resync()
+            return
+        if not steps:
+            return
+        channel = CommandChannel(self.central_serial, self.command_window)
+        with metrics.timed(SYNC_PHASE_SECONDS, 'push'):
+            results = await channel.execute([step.command for step in steps])
+        # status lines that came in between the command output
+        for result in results:
+            for line in result.output:
+                self._handle_line(line)
+        failed = [r for r in results if not r.ok]
+        if failed:
+            self._status(
+                "{} of {} live updates failed, resynchronizing".format(len(failed), len(steps)))
+            self._resync()
+        else:
+            self.sync_state.record(self.db.identity[0], bond_count, fingerprint)
+            if not self._changes:
+                self._synced.set()
+            self._status(
+                "central connected and scanning, coins updated ({})".format(len(steps)))
 
     # read registered bonds
     async def _request_bonds(self):
         bonds = []
         self.central_serial.write(b'stats bonds\r\n')
-        line = None
-        while not (line and line.endswith('stats bonds\r\n')):
-            line = await self._serial_fetch_line()
+        async for line in self.central_serial:
             # print(line, end='', flush=True)
-        while line != 'done\r\n':
-            line = await self._serial_fetch_line()
-            bond = re.match(r"\[(.{17})\] keys: 34, flags: 17\r\n", line)
+            if line.endswith('stats bonds\r\n'):
+                break
+        async for line in self.central_serial:
+            if line == 'done\r\n':
+                break
+            bond = _BOND_LINE.match(line)
             if bond:
                 bonds.append(bond.groups())
         return bonds
@@ -79,13 +519,14 @@ class KeykeeperSerialMgr:
     async def _request_spacekeys(self):
         spacekeys = []
         self.central_serial.write(b'stats spacekey\r\n')
-        line = None
-        while not (line and line.endswith('stats spacekey\r\n')):
-            line = await self._serial_fetch_line()
+        async for line in self.central_serial:
             # print(line, end='', flush=True)
-        while line != 'done\r\n':
-            line = await self._serial_fetch_line()
-            spacekey = re.match(r"\[(.{17})\] : ([A-F0-9]{2})\.\.\.\r\n", line)
+            if line.endswith('stats spacekey\r\n'):
+                break
+        async for line in self.central_serial:
+            if line == 'done\r\n':
+                break
+            spacekey = _SPACEKEY_LINE.match(line)
             if spacekey:
                 spacekeys.append(spacekey.groups())
         return spacekeys
@@ -93,22 +534,24 @@ class KeykeeperSerialMgr:
     # read settings
     async def _read_settings(self):
         self.central_serial.write(b'settings load\r\n')
-        line = None
-        k = None
-        while k != StatusType.IDENTITY:
-            line = await self._serial_fetch_line()
+        async for line in self.central_serial:
             # print(line, end='', flush=True)
-            k, v = self._parse_status(line)
             if 'bt_hci_core: Read Static Addresses command not available' in line:
                 break
-            if k == StatusType.IDENTITY:
-                self.identity = v[0].upper()
+            event = parse_status(line)
+            if isinstance(event, IdentityEvent):
+                self.identity = event.address.upper()
+                break
 
-    async def _wait_until_done(self):
-        line = None
-        while line != 'done\r\n':
-            line = await self._serial_fetch_line()
+    async def _wait_until_done(self, command):
+        with metrics.timed(COMMAND_SECONDS, command):
+            await self._wait_for_done()
+
+    async def _wait_for_done(self):
+        async for line in self.central_serial:
             # print(line, end='', flush=True)
+            if line == 'done\r\n':
+                break
 
     # main state machine routine
 
@@ -119,99 +562,311 @@ class KeykeeperSerialMgr:
         self.spacekeys = None
 
         if self.config_mode:
-            os.write(self.status_pipe, str(
-                "status: synchronizing database").encode('utf8'))
+            self._status("synchronizing database")
+            # the sync below covers every change made so far
+            self._take_changes()
+            started = time.perf_counter()
             # just load settings, don't start scanning
-            await self._read_settings()
+            with metrics.timed(SYNC_PHASE_SECONDS, 'settings'):
+                await self._read_settings()
             # read coin data from device
-            self.bonds = await self._request_bonds()
-            self.spacekeys = await self._request_spacekeys()
-            if self.identity != self.db.identity[0]:
-                if self.identity:
-                    self.central_serial.write(b'settings clear\r\n')
-                    await self._wait_until_done()
+            with metrics.timed(SYNC_PHASE_SECONDS, 'bonds'):
+                self.bonds = await self._request_bonds()
+            fingerprint = self.db.fingerprint()
+            # nothing changed since the last sync to this central, the
+            # spacekey readback and the plan can be skipped
+            failed = []
+            if not self.sync_state.is_synced(self.identity, len(self.bonds), fingerprint):
+                self.sync_state.forget(self.identity)
+                with metrics.timed(SYNC_PHASE_SECONDS, 'spacekeys'):
+                    self.spacekeys = await self._request_spacekeys()
+                with metrics.timed(SYNC_PHASE_SECONDS, 'plan'):
+                    plan = plan_sync(self.identity, self.bonds, self.spacekeys, self.db)
+                channel = CommandChannel(self.central_serial, self.command_window)
+                with metrics.timed(SYNC_PHASE_SECONDS, 'apply'):
+                    failed = [r for r in await channel.execute(
+                        [step.command for step in plan]) if not r.ok]
+                if failed:
+                    self._status(
+                        "{} of {} sync commands failed".format(len(failed), len(plan)))
                 else:
-                    self.central_serial.write('central_setup {} {}\r\n'.format(
-                        *self.db.identity).encode('ASCII'))
-                    await self._wait_until_done()
-            if len(self.bonds) != len(self.spacekeys):
-                self.central_serial.write(b'settings clear\r\n')
-            is_present = {c: False for c in self.db.coins.keys()}
-            for bond, skey in zip(self.bonds, self.spacekeys):
-                if bond[0] != skey[0]:
-                    self.central_serial.write(b'settings clear\r\n')
-                    await self._wait_until_done()
-                if bond[0] not in self.db.coins or skey[1] != self.db.coins[bond[0]][2][:2]:
-                    self.central_serial.write(
-                        'coin del {}\r\n'.format(bond[0]).encode('ASCII'))
-                    await self._wait_until_done()
-                else:
-                    is_present[bond[0]] = True
-            for addr, present in is_present.items():
-                if not present:
-                    self.central_serial.write('coin add {} {} {} {}\r\n'.format(
-                        addr, *self.db.coins[addr]).encode('ASCII'))
-                    await self._wait_until_done()
+                    self.sync_state.record(
+                        self.db.identity[0], len(self.db.coins), fingerprint)
+            metrics.observe(SYNC_PHASE_SECONDS, time.perf_counter() - started, 'total')
+            if not failed and not self._changes:
+                self._synced.set()
             self.config_mode = False
             self.central_serial.write(b'reboot\r\n')
-            await self._wait_until_done()
+            await self._wait_until_done('reboot')
         else:
             # start BLE stack
             self.central_serial.write(b'ble_start\r\n')
-            os.write(self.status_pipe, str(
-                "status: central connected and scanning").encode('utf8'))
+            self._status("central connected and scanning")
 
-        # main event loop
-        while True:
-            line = await self._serial_fetch_line()
-            # print(line, end='', flush=True)
-            k, v = self._parse_status(line)
-            if k == StatusType.IDENTITY:
-                self.identity = v[0].upper()
-            if k == StatusType.AUTHENTICATED:
-                os.write(self.status_pipe, str("status: {} ({}%🔋) authenticated".format(
-                    self.current_coin.address, self.current_coin.battery_level)).encode('utf8'))
-            elif k == StatusType.BATTERY_LEVEL:
-                self.current_coin.battery_level = v[0]
-            elif k == StatusType.CONNECTED:
-                self.current_coin.address = v[0].upper()
-            elif k == StatusType.DISCONNECTED:
-                self.current_coin = Coin()
+        # main event loop, database changes are pushed in between status lines
+        read = None
+        # one waiter for changes outlives the lines read while it waits
+        changed = None
+        try:
+            while True:
+                if read is None:
+                    read = asyncio.ensure_future(self.central_serial.readline())
+                if changed is None:
+                    changed = asyncio.ensure_future(self._changes_ready.wait())
+                await asyncio.wait({read, changed}, return_when=asyncio.FIRST_COMPLETED)
+                if read.done():
+                    line, read = read.result(), None
+                    self._handle_line(line)
+                if changed.done():
+                    changed = None
+                if self._changes_ready.is_set():
+                    # the command channel reads the replies itself
+                    if read is not None:
+                        read.cancel()
+                        await asyncio.wait({read})
+                        read = None
+                    await self._push_changes()
+        finally:
+            for task in (read, changed):
+                if task is not None:
+                    task.cancel()
+
+    # act on a status line of the scanning central
+    # a broken access log or a garbled status line must not keep the door closed,
+    # they are only reported
+    def _record_access(self, *args, **kwargs):
+        if self.access_log is None:
+            return
+        try:
+            self.access_log.record(*args, door=self.door, **kwargs)
+        except ValueError as e:
+            self._status("access not logged: {}".format(e))
+        except OSError as e:
+            self._status(str(e))
+
+    def _handle_line(self, line):
+        # print(line, end='', flush=True)
+        event = parse_status(line)
+        if event is None:
+            return
+        k = event.type
+        if k == StatusType.IDENTITY:
+            self.identity = event.address.upper()
+        elif k == StatusType.AUTHENTICATED:
+            coin = self.current_coin
+            name = self.db.name_of(addr_key(coin.address))
+            coin.authenticated = True
+            self._record_access(AccessKind.OPENED if name is not None else AccessKind.UNKNOWN,
+                                coin.address, name, coin.battery_level)
+            send(self.status_pipe, CoinAuthenticated(name, coin.address, coin.battery_level,
+                                                     self.door))
+        elif k == StatusType.DEVICE_FOUND:
+            send(self.status_pipe, CoinSeen(event.address.upper(), event.rssi, self.door))
+        elif k == StatusType.BATTERY_LEVEL:
+            self.current_coin.battery_level = event.level
+            if self.battery is not None:
+                self.battery.add(self.current_coin.address, event.level)
+            send(self.status_pipe, BatteryLevel(self.current_coin.address, event.level,
+                                                self.door))
+        elif k == StatusType.CONNECTED:
+            self.current_coin.address = event.address.upper()
+        elif k == StatusType.DISCONNECTED:
+            if not self.current_coin.authenticated:
+                self._record_access(AccessKind.FAILED, event.address.upper(),
+                                    battery_level=self.current_coin.battery_level,
+                                    reason=event.reason)
+            self.current_coin = Coin()
+
+    # print the sync plan for the connected central without changing it
+    async def dry_run_async(self, port):
+        self.identity = None
+        self.central_serial = SerialLineReader(port=os.path.realpath(port))
+        try:
+            self.central_serial.write(b'\r\n\r\n')
+            await self._read_settings()
+            self.bonds = await self._request_bonds()
+            self.spacekeys = await self._request_spacekeys()
+        finally:
+            self.central_serial.close()
+            self.central_serial = None
+        plan = plan_sync(self.identity, self.bonds, self.spacekeys, self.db)
+        for step in plan:
+            print(step)
+        print("{} steps, central has {} bonds, database has {} coins".format(
+            len(plan), len(self.bonds), len(self.db.coins)))
 
     # main loop with reconnecting
     async def run_async(self):
         self.current_coin = Coin()
+        self.central_serial = None
 
         first_start = True
+        managed = False
         while True:
             try:
-                self.central_serial = aioserial.AioSerial(
-                    port=os.path.realpath('/dev/serial/by-id/usb-ZEPHYR_N39_BLE_KEYKEEPER_0.01-if00'))
+                self.central_serial = SerialLineReader(
+                    port=os.path.realpath(self.port))
                 self.central_serial.write(b'\r\n\r\n')
                 if first_start:
                     self.central_serial.write(b'reboot\r\n')
                     first_start = False
-                    await self._wait_until_done()
-                    
+                    await self._wait_until_done('reboot')
                 else:
+                    if managed:
+                        metrics.inc(RECONNECTS)
+                    managed = True
                     await self._manage_serial()
             except serial.serialutil.SerialException:
-                os.write(self.status_pipe, str(
-                    "status: connecting to central").encode('utf8'))
+                metrics.inc(SERIAL_ERRORS)
+                self._status("connecting to central")
                 await asyncio.sleep(1)
+            finally:
+                if self.central_serial is not None:
+                    self.central_serial.close()
+                    self.central_serial = None
     def run(self):
         asyncio.run(self.run_async())
 
 
+# door name of a central's port, the part of its name matching the * of pattern
+def door_name(port, pattern=CENTRAL_PORTS):
+    prefix, _, suffix = os.path.basename(pattern).partition('*')
+    name = os.path.basename(port)
+    return name[len(prefix):len(name) - len(suffix)]
+
+
+# a KeykeeperSerialMgr for every central found, all on one event loop and fed
+# from the same database, so a change reaches all doors at the same time
+# centrals plugged in later are picked up, one unplugged keeps trying to reconnect
+class KeykeeperCentrals:
+    DISCOVER_INTERVAL = 5
+
+    def __init__(self, db, status_pipe, pattern=CENTRAL_PORTS, command_window=4,
+                 sync_state_file='sync_state.json', access_log=None, battery=None):
+        self.db = db
+        self.status_pipe = status_pipe
+        self.pattern = pattern
+        self.command_window = command_window
+        self.sync_state = SyncState(sync_state_file)
+        self.access_log = access_log
+        self.battery = battery
+        # {port: KeykeeperSerialMgr}
+        self.centrals = {}
+        self._tasks = {}
+        self._found = asyncio.Event()
+
+    # start managing the centrals that showed up since the last call
+    def discover(self):
+        for port in sorted(glob.glob(self.pattern)):
+            if port in self.centrals:
+                continue
+            door = door_name(port, self.pattern)
+            mgr = KeykeeperSerialMgr(
+                self.db, self.status_pipe, self.command_window, access_log=self.access_log,
+                battery=self.battery, port=port, door=door, sync_state=self.sync_state)
+            self.centrals[port] = mgr
+            task = asyncio.ensure_future(mgr.run_async())
+            task.add_done_callback(lambda task, door=door: self._stopped(door, task))
+            self._tasks[port] = task
+        if self.centrals:
+            self._found.set()
+
+    def _stopped(self, door, task):
+        if not task.cancelled() and task.exception() is not None:
+            send(self.status_pipe, CentralStatus(
+                "stopped: {}".format(task.exception()), door))
+
+    async def run_async(self):
+        try:
+            while True:
+                self.discover()
+                if not self.centrals:
+                    send(self.status_pipe, CentralStatus("no central found"))
+                await asyncio.sleep(self.DISCOVER_INTERVAL)
+        finally:
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # returns once every central has every change made to the database so far,
+    # waits for the first central to show up
+    async def wait_synced(self):
+        await self._found.wait()
+        await asyncio.gather(*(mgr.wait_synced() for mgr in list(self.centrals.values())))
+
+
 def _test_serialmgr():
     db = KeykeeperDB()
     pipein, pipeout = os.pipe()
     k = KeykeeperSerialMgr(db, pipeout)
     p = multiprocessing.Process(target=k.run, daemon=True)
     p.start()
+    decoder = FrameDecoder()
     while True:
-        print(os.read(pipein, 100).decode('utf8'))
+        for event in decoder.feed(os.read(pipein, 4096)):
+            print(event)
+
+
+# compare the status parser against the old search-every-pattern approach
+def _bench_parse_status(logfile='central_sample.log', rounds=200):
+    def parse_status_legacy(l):
+        regs = {
+            StatusType.IDENTITY: r"<inf> bt_hci_core: Identity: (.{17}) \((.*)\)",
+            StatusType.DEVICE_FOUND: r"<inf> app: Device found: \[(.{17})\] \(RSSI (-?\d+)\) \(TYPE (\d)\) \(BONDED (\d)\)",
+            StatusType.BATTERY_LEVEL: r"<inf> app: Battery Level: (\d{1,3})%",
+            StatusType.CONNECTED: r"<inf> app: Connected: \[(.{17})\]",
+            StatusType.AUTHENTICATED: r"<inf> app: KEY AUTHENTICATED. OPEN DOOR PLEASE.",
+            StatusType.DISCONNECTED: r"<inf> app: Disconnected: \[(.{17})\] \(reason (\d+)\)",
+        }
+        for k in regs:
+            m = re.search(pattern=regs[k], string=l)
+            if m:
+                return k, m.groups()
+        return None, None
+
+    with open(logfile, newline='') as f:
+        lines = f.readlines()
+    for name, parse in (('legacy', parse_status_legacy), ('compiled', parse_status)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for line in lines:
+                parse(line)
+        elapsed = time.perf_counter() - start
+        print("{:>8}: {:>10.0f} lines/s".format(
+            name, rounds * len(lines) / elapsed))
+
+
+# plan a sync of a central holding half of a large database
+def _bench_plan_sync(n=10000):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        db.generate_coins(['member{}'.format(i) for i in range(n)])
+        coins = list(db.coins.values())[:n // 2]
+        bonds = [(c.address_str,) for c in coins] + [('C0:00:00:00:00:01',)]
+        spacekeys = [(c.address_str, c.hex_keys()[2][:2]) for c in coins] + \
+            [('C0:00:00:00:00:01', '00')]
+        start = time.perf_counter()
+        plan = plan_sync(db.identity[0], bonds, spacekeys, db)
+        elapsed = time.perf_counter() - start
+        print("planned {} steps for {} coins in {:.1f} ms".format(
+            len(plan), n, elapsed * 1000))
+
+
+# show what a sync would do: serialmgr.py plan [db file] [port]
+def _dry_run(filename='db.json', port=CENTRAL_PORT):
+    db = open_db(filename, getpass.getpass('database password: '))
+    k = KeykeeperSerialMgr(db, None)
+    asyncio.run(k.dry_run_async(port))
 
 
 if __name__ == "__main__":
-    _test_serialmgr()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_parse_status(*sys.argv[2:3])
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench_plan':
+        _bench_plan_sync(*map(int, sys.argv[2:3]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'plan':
+        _dry_run(*sys.argv[2:4])
+    else:
+        _test_serialmgr()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+import asyncio
+import multiprocessing
+import sys
+import time
+import oocd
+from status_bus import send, StationStatus
+
+
+# a programming station: power switch, adapter config and an openocd of its own,
+# listening on a TCL port no other station uses
+class Station:
+    def __init__(self, name, tcl_port, power_pin=13, adapter_config='board.ocd'):
+        self.name = name
+        self.power_pin = power_pin
+        self.adapter_config = adapter_config
+        self.tcl_port = tcl_port
+
+    async def open(self):
+        self._switch = oocd.PowerSwitch(self.power_pin)
+        self._session = oocd.OpenOCDSession(self.adapter_config, self.tcl_port)
+        await self._session.start()
+
+    async def provision(self, image):
+        return await self._session.provision(
+            image, self._switch.powercycle, self._switch.shutdown)
+
+    async def close(self):
+        await self._session.close()
+
+
+# station without hardware, its openocd is a fake TCL server answering
+# with the canned outputs from test_programming.py
+class SimulatedStation(Station):
+    def __init__(self, name, chip='unlocked', program='program'):
+        # the fake server picks a free port
+        super().__init__(name, None)
+        self.chip = chip
+        self.program = program
+
+    async def open(self):
+        from test_programming import FakeOpenOCDTclServer
+        self._server = await FakeOpenOCDTclServer(self.chip, self.program).start()
+        self._session = oocd.OpenOCDSession(port=self._server.port, spawn=False)
+        await self._session.start()
+
+    # powering a real coin takes two 100 ms sleeps
+    async def provision(self, image):
+        def power_on():
+            time.sleep(0.2)
+        return await self._session.provision(image, power_on, lambda: None)
+
+    async def close(self):
+        await self._session.close()
+        await self._server.close()
+
+
+# runs in a process of its own, provisions jobs until it gets None
+def _station_worker(station, jobs, results):
+    async def work():
+        # a station that can't start has to reach the scheduler, it waits for it
+        try:
+            await station.open()
+        except Exception as e:
+            results.put(('failed', station.name, None, str(e)))
+            return
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                job_id, image = job
+                results.put(('started', station.name, job_id, None))
+                try:
+                    result = await station.provision(image)
+                except Exception as e:
+                    result = oocd.ProvisionResult(False, [], str(e))
+                results.put(('done', station.name, job_id, result))
+        finally:
+            await station.close()
+        results.put(('stopped', station.name, None, None))
+    asyncio.run(work())
+
+
+# what a station has done so far
+class StationProgress:
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.current = None
+        self.alive = True
+
+    def __str__(self):
+        state = 'job {}'.format(self.current) if self.current is not None else \
+            ('idle' if self.alive else 'offline')
+        return '{} done, {} failed, {}'.format(self.done, self.failed, state)
+
+
+# provisions a queue of images on all stations at once,
+# every station takes the next image as soon as it is free
+class StationScheduler:
+    def __init__(self, stations, status_pipe=None):
+        ports = [s.tcl_port for s in stations if s.tcl_port is not None]
+        if len(set(ports)) != len(ports):
+            raise ValueError("stations share a TCL port: {}".format(ports))
+        self.stations = stations
+        self.status_pipe = status_pipe
+        self.progress = {}
+
+    def _report(self, name):
+        send(self.status_pipe, StationStatus(name, str(self.progress[name])))
+
+    # returns one ProvisionResult per image, in order
+    def run(self, images):
+        jobs = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for job in enumerate(images):
+            jobs.put(job)
+        for _ in self.stations:
+            jobs.put(None)
+        self.progress = {s.name: StationProgress() for s in self.stations}
+        workers = [multiprocessing.Process(target=_station_worker, args=(s, jobs, results),
+                                           daemon=True) for s in self.stations]
+        for w in workers:
+            w.start()
+
+        outcome = [None] * len(images)
+        pending = len(images)
+        alive = len(self.stations)
+        while pending > 0 and alive > 0:
+            kind, name, job_id, result = results.get()
+            progress = self.progress[name]
+            if kind == 'started':
+                progress.current = job_id
+            elif kind == 'done':
+                progress.current = None
+                if result.ok:
+                    progress.done += 1
+                else:
+                    progress.failed += 1
+                outcome[job_id] = result
+                pending -= 1
+            else:
+                progress.alive = False
+                alive -= 1
+            self._report(name)
+
+        for w in workers:
+            if pending > 0:
+                w.terminate()
+            w.join()
+        # jobs no station was left to do
+        return [r if r is not None else oocd.ProvisionResult(False, [], 'no station left')
+                for r in outcome]
+
+
+# coins per minute for 1 to max_stations simulated stations
+def _bench_stations(max_stations=4, coins=8):
+    for n in range(1, max_stations + 1):
+        scheduler = StationScheduler(
+            [SimulatedStation('sim{}'.format(i)) for i in range(n)], status_pipe=None)
+        start = time.perf_counter()
+        results = scheduler.run(['coin.hex'] * coins)
+        elapsed = time.perf_counter() - start
+        print("{} stations: {} coins in {:.1f} s, {:.1f} coins/min, {} failed".format(
+            n, coins, elapsed, coins / elapsed * 60, sum(not r.ok for r in results)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_stations(*map(int, sys.argv[2:4]))
+    else:
+        stations = [SimulatedStation('sim{}'.format(i)) for i in range(2)]
+        for result in StationScheduler(stations, print).run(['coin.hex'] * 4):
+            print(result.ok, result.error, '{:.2f} s'.format(result.duration))
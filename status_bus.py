@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import json
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from enum import IntEnum
+
+# status events from the serial manager, the provisioning code and the stations
+# to the TUI, one frame per event: kind (1 byte), payload length (2 bytes,
+# big endian), then the event's fields as a JSON array.
+# frames below PIPE_BUF are written atomically, so several writers can share a pipe
+
+
+class EventKind(IntEnum):
+    CENTRAL_STATUS = 1
+    COIN_SEEN = 2
+    BATTERY_LEVEL = 3
+    COIN_AUTHENTICATED = 4
+    COIN_PROGRESS = 5
+    STATION_STATUS = 6
+
+
+# what a central is doing: connecting, synchronizing, scanning, failed commands
+# door tells the centrals apart when there are several, None when there is one
+class CentralStatus(namedtuple('CentralStatus', ['text', 'door'], defaults=(None,))):
+    __slots__ = ()
+    kind = EventKind.CENTRAL_STATUS
+
+
+# a coin showed up in a scan, door as for CentralStatus
+class CoinSeen(namedtuple('CoinSeen', ['address', 'rssi', 'door'], defaults=(None,))):
+    __slots__ = ()
+    kind = EventKind.COIN_SEEN
+
+
+# battery level a connected coin reported, door as for CentralStatus
+class BatteryLevel(namedtuple('BatteryLevel', ['address', 'level', 'door'], defaults=(None,))):
+    __slots__ = ()
+    kind = EventKind.BATTERY_LEVEL
+
+
+# name is None for coins that aren't in the database
+class CoinAuthenticated(namedtuple('CoinAuthenticated', ['name', 'address', 'battery_level', 'door'],
+                                   defaults=(None,))):
+    __slots__ = ()
+    kind = EventKind.COIN_AUTHENTICATED
+
+
+# a step of writing a coin, `step` is an oocd.ProgressType name or ''
+class CoinProgress(namedtuple('CoinProgress', ['step', 'text'])):
+    __slots__ = ()
+    kind = EventKind.COIN_PROGRESS
+
+
+class StationStatus(namedtuple('StationStatus', ['station', 'text'])):
+    __slots__ = ()
+    kind = EventKind.STATION_STATUS
+
+
+_EVENTS = {cls.kind: cls for cls in
+           (CentralStatus, CoinSeen, BatteryLevel, CoinAuthenticated, CoinProgress, StationStatus)}
+_HEADER = struct.Struct('>BH')
+MAX_PAYLOAD = 0xffff
+
+
+def encode(event):
+    payload = json.dumps(event, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("status event too large: {} bytes".format(len(payload)))
+    return _HEADER.pack(event.kind, len(payload)) + payload
+
+
+# write an event to a status pipe, or hand it to a callable when
+# sender and receiver share an event loop, None drops it
+def send(fd, event):
+    if fd is None:
+        return
+    if callable(fd):
+        fd(event)
+    else:
+        os.write(fd, encode(event))
+
+
+# turns the bytes read from a pipe back into events, however they were cut up
+class FrameDecoder:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    # all events completed by `data`, events of unknown kinds are skipped
+    def feed(self, data):
+        self._buffer += data
+        events = []
+        pos = 0
+        while len(self._buffer) - pos >= _HEADER.size:
+            kind, length = _HEADER.unpack_from(self._buffer, pos)
+            end = pos + _HEADER.size + length
+            if end > len(self._buffer):
+                break
+            cls = _EVENTS.get(kind)
+            if cls is not None:
+                events.append(cls(*json.loads(self._buffer[pos + _HEADER.size:end])))
+            pos = end
+        del self._buffer[:pos]
+        return events
+
+
+# print the events arriving on a pipe
+def _print_events(fd):
+    decoder = FrameDecoder()
+    while True:
+        data = os.read(fd, 4096)
+        if not data:
+            break
+        for event in decoder.feed(data):
+            print(event)
+
+
+def _bench_bus(count=100000):
+    events = [BatteryLevel('C0:11:22:33:44:{:02X}'.format(i % 256), i % 101)
+              for i in range(count)]
+    start = time.perf_counter()
+    data = b''.join(map(encode, events))
+    encoded = time.perf_counter() - start
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    # the size urwid reads from a watched pipe, frames get cut anywhere
+    decoded = []
+    for i in range(0, len(data), 4096):
+        decoded += decoder.feed(data[i:i + 4096])
+    elapsed = time.perf_counter() - start
+    print("{} events, {} bytes: encode {:.0f} ms, decode {:.0f} ms ({:.0f} events/s)".format(
+        count, len(data), encoded * 1000, elapsed * 1000, count / elapsed))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_bus(*map(int, sys.argv[2:3]))
+    else:
+        _print_events(sys.stdin.fileno())
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import tempfile
+
+from access_log import AccessLog, AccessKind
+
+
+# a garbled record is refused by record(), the writer keeps going
+def test_record_validation():
+    directory = tempfile.mkdtemp()
+    try:
+        log = AccessLog(directory)
+        for args in [('C0:00:00:00:00', 'alice', 50, 0),
+                     ('C0:00:00:00:00:ZZ', 'alice', 50, 0),
+                     (None, 'alice', 50, 0),
+                     ('C0:00:00:00:00:01', 'alice', -1, 0),
+                     ('C0:00:00:00:00:01', 'alice', 50, 256),
+                     ('C0:00:00:00:00:01', 'al\nice', 50, 0)]:
+            try:
+                log.record(AccessKind.OPENED, *args, t=1000.0)
+            except ValueError:
+                continue
+            raise AssertionError("{} was recorded".format(args))
+        try:
+            log.record(7, 'C0:00:00:00:00:01', t=1000.0)
+            raise AssertionError("kind 7 was recorded")
+        except ValueError:
+            pass
+        log.record(AccessKind.OPENED, 'C0:00:00:00:00:01', 'alice', 100, 0, t=1000.0)
+        log.close()
+        records = list(AccessLog(directory).records())
+        assert [(r.address, r.name, r.battery_level) for r in records] == [
+            ('C0:00:00:00:00:01', 'alice', 100)]
+    finally:
+        shutil.rmtree(directory)
+
+
+# whatever stops the writer is raised by record() and close()
+def test_writer_error():
+    import access_log
+    directory = tempfile.mkdtemp()
+    append = access_log._Segment.append
+
+    def broken(*args):
+        raise RuntimeError("broken")
+    access_log._Segment.append = broken
+    try:
+        log = AccessLog(directory)
+        log.BLOCK_RECORDS = 1
+        log.record(AccessKind.OPENED, 'C0:00:00:00:00:01', 'alice', 100, 0, t=1000.0)
+        log._writer.join(5)
+        assert not log._writer.is_alive()
+        try:
+            log.record(AccessKind.OPENED, 'C0:00:00:00:00:01', 'alice', 100, 0, t=1001.0)
+            raise AssertionError("recorded after the writer stopped")
+        except OSError as e:
+            assert isinstance(e.__cause__, RuntimeError)
+        # the record that wasn't written is still found
+        assert len(list(log.records())) == 1
+        try:
+            log.close()
+            raise AssertionError("closed without the error")
+        except OSError:
+            pass
+    finally:
+        access_log._Segment.append = append
+        shutil.rmtree(directory)
+
+
+# every record keeps the door of the central that reported it
+def test_doors():
+    directory = tempfile.mkdtemp()
+    try:
+        log = AccessLog(directory)
+        log.record(AccessKind.OPENED, 'C0:00:00:00:00:01', 'alice', 90, 0, 1000.0, 'front')
+        log.record(AccessKind.OPENED, 'C0:00:00:00:00:01', 'alice', 90, 0, 1001.0, 'workshop')
+        log.record(AccessKind.FAILED, 'C0:00:00:00:00:02', None, 0, 0x13, 1002.0, 'front')
+        log.record(AccessKind.OPENED, 'C0:00:00:00:00:03', 'bob', 80, 0, 1003.0)
+        log.close()
+        log = AccessLog(directory)
+        assert [r.door for r in log.records()] == ['front', 'workshop', 'front', None]
+        assert [r.time for r in log.records(door='front')] == [1000.0, 1002.0]
+        assert [r.time for r in log.opened_between(0, 2000, 'workshop')] == [1001.0]
+        assert log.last_access()['alice'].door == 'workshop'
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def _small_log(directory):
+    log = AccessLog(directory)
+    log.BLOCK_RECORDS = 4
+    log.SEGMENT_SIZE = 1
+    return log
+
+
+# queries see every segment, also after a reopen and after the clock stepped back
+def test_queries_across_segments():
+    directory = tempfile.mkdtemp()
+    try:
+        log = _small_log(directory)
+        expected = []
+        for i in range(40):
+            address = 'C0:00:00:00:00:{:02X}'.format(i % 3)
+            if i % 5 == 4:
+                record = (AccessKind.FAILED, address, None, 0, 0x13, 1000.0 + i, 'front')
+            else:
+                record = (AccessKind.OPENED, address, 'member{}'.format(i % 3), 90, 0,
+                          1000.0 + i, 'front')
+            log.record(*record)
+            expected.append(record)
+        log.close()
+        assert len([f for f in os.listdir(directory) if f.endswith('.seg')]) == 10
+
+        def check(log, expected):
+            records = list(log.records())
+            assert [(r.kind, r.address, r.name, r.battery_level, r.reason, r.time, r.door)
+                    for r in records] == expected
+            assert [r.time for r in log.records(1010, 1019.5)] == [
+                r[5] for r in expected if 1010 <= r[5] <= 1019.5]
+            assert [r.time for r in log.opened_between(1010, 1019.5)] == [
+                r[5] for r in expected if 1010 <= r[5] <= 1019.5 and r[0] == AccessKind.OPENED]
+            last = {}
+            for r in expected:
+                if r[2] is not None:
+                    last[r[2]] = r[5]
+            assert {name: r.time for name, r in log.last_access().items()} == last
+            failed = {}
+            for r in expected:
+                if r[0] == AccessKind.FAILED:
+                    failed[r[1]] = failed.get(r[1], 0) + 1
+            assert dict(log.failed_connections()) == failed
+
+        log = _small_log(directory)
+        check(log, expected)
+        # a clock stepped back, the new records are older than the ones before
+        for i in range(8):
+            record = (AccessKind.OPENED, 'C0:00:00:00:00:09', 'late', 50, 0, 1015.5 + i, 'front')
+            log.record(*record)
+            expected.append(record)
+        log.close()
+        log = AccessLog(directory)
+        check(log, expected)
+        assert [r.name for r in log.records(1014.9, 1015.6)] == ['member0', 'late']
+        log.close()
+    finally:
+        shutil.rmtree(directory)
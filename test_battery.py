@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import tempfile
+
+from battery import BatteryStore, RingBuffer, DAY, WEEK
+
+
+# a full ring drops its oldest entries, in order
+def test_ring_wraparound():
+    ring = RingBuffer(4)
+    assert ring.last() is None
+    for i in range(10):
+        ring.append(float(i), i * 10)
+        assert len(ring) == min(i + 1, 4)
+        assert ring.last() == (float(i), i * 10)
+    assert list(ring.items()) == [(6.0, 60), (7.0, 70), (8.0, 80), (9.0, 90)]
+
+
+# daily and weekly means of the readings, the slope from the daily ones
+def test_rollups():
+    store = BatteryStore()
+    store.DAYS = 5
+    store.WEEKS = 2
+    address = 'C0:00:00:00:00:01'
+    start = 100 * WEEK
+    # two readings a day, one below and one above the day's level
+    for day in range(30):
+        store.add(address, 100 - day - 1, start + day * DAY + 0.25 * DAY)
+        store.add(address, 100 - day + 1, start + day * DAY + 0.75 * DAY)
+    daily = store.daily(address)
+    # the last five finished days and the running one
+    assert daily == [(start + (day + 0.5) * DAY, 100 - day) for day in range(24, 30)]
+    weekly = store.weekly(address)
+    # the last two finished weeks and the running one
+    assert [t for t, _ in weekly] == [(100 + week + 0.5) * WEEK for week in (2, 3, 4)]
+    assert [level for _, level in weekly] == [100 - 17, 100 - 24, 100 - 28.5]
+    assert abs(store.slope(address) + 1) < 1e-6
+    assert store.level(address) == 72
+    assert abs(store.days_left(address, now=start + 29.75 * DAY) - 72) < 1e-6
+    assert [d[0] for d in store.dying_within(100, now=start + 29.75 * DAY)] == [address]
+    assert store.dying_within(10, now=start + 29.75 * DAY) == []
+
+
+# the coin heard from longest ago is dropped first
+def test_max_coins():
+    store = BatteryStore()
+    store.MAX_COINS = 2
+    store.add('C0:00:00:00:00:01', 90, 1000.0)
+    store.add('C0:00:00:00:00:02', 90, 1001.0)
+    store.add('C0:00:00:00:00:01', 89, 1002.0)
+    store.add('C0:00:00:00:00:03', 90, 1003.0)
+    assert list(store.coins) == ['C0:00:00:00:00:01', 'C0:00:00:00:00:03']
+
+
+# a saved store comes back with its rings and running periods
+def test_save_load():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'battery.json')
+        store = BatteryStore(filename)
+        store.READINGS = 8
+        for day in range(20):
+            for n in range(3):
+                store.add('C0:00:00:00:00:01', 100 - day, day * DAY + n * DAY / 3)
+                store.add('C0:00:00:00:00:02', 100 - day // 2, day * DAY + n * DAY / 3)
+        store.save()
+        loaded = BatteryStore(filename)
+        for address in store.coins:
+            assert loaded.daily(address) == store.daily(address)
+            assert loaded.weekly(address) == store.weekly(address)
+            assert loaded.level(address) == store.level(address)
+            assert loaded.slope(address) == store.slope(address)
+        # the running day goes on where it was
+        store.add('C0:00:00:00:00:01', 70, 19.9 * DAY)
+        loaded.add('C0:00:00:00:00:01', 70, 19.9 * DAY)
+        assert loaded.daily('C0:00:00:00:00:01') == store.daily('C0:00:00:00:00:01')
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+import tty
+
+# a keykeeper central on a pseudo-terminal, behind a symlink named like its
+# /dev/serial/by-id entry. A reboot makes it show up on a new pty, the old one
+# goes away like the USB device of a real central does.
+
+
+class FakeCentral:
+    def __init__(self, directory, door, command_delay=0.0, boot_time=0.05):
+        self.link = os.path.join(directory, 'usb-ZEPHYR_N39_BLE_KEYKEEPER_{}-if00'.format(door))
+        self.door = door
+        self.command_delay = command_delay
+        self.boot_time = boot_time
+        self.identity = 'C0:' + ':'.join('{:02X}'.format(b) for b in secrets.token_bytes(5))
+        # {address: spacekey}
+        self.bonds = {}
+        self.scanning = False
+        self.reboots = 0
+        self._pty = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._commands = asyncio.Queue()
+        self._open()
+        self._worker = asyncio.ensure_future(self._work())
+        return self
+
+    # a new pty, the symlink is switched over to it at once
+    def _open(self):
+        master, slave = os.openpty()
+        # the line discipline must not echo or translate, the shell echoes itself
+        tty.setraw(slave)
+        self._pty = (master, slave)
+        self._buffer = bytearray()
+        tmp = self.link + '.tmp'
+        os.symlink(os.ttyname(slave), tmp)
+        os.replace(tmp, self.link)
+        self._loop.add_reader(master, self._on_readable, master)
+
+    def _close(self, pty):
+        self._loop.remove_reader(pty[0])
+        os.close(pty[0])
+        os.close(pty[1])
+
+    def _on_readable(self, master):
+        try:
+            data = os.read(master, 4096)
+        except OSError:
+            return
+        if master != self._pty[0]:
+            return
+        self._buffer += data
+        while b'\n' in self._buffer:
+            line, _, rest = self._buffer.partition(b'\n')
+            self._buffer = bytearray(rest)
+            self._commands.put_nowait(line.decode().strip('\r'))
+
+    def _write(self, text):
+        os.write(self._pty[0], text.encode())
+
+    async def _work(self):
+        while True:
+            line = await self._commands.get()
+            self._write('uart:~$ {}\r\n'.format(line))
+            if not line:
+                continue
+            await asyncio.sleep(self.command_delay)
+            if line == 'reboot':
+                await self._reboot()
+            else:
+                self._write(self._execute(line.split()) + 'done\r\n')
+
+    # the old pty answers the reboot and disappears once the new one is up
+    async def _reboot(self):
+        old = self._pty
+        self.scanning = False
+        self.reboots += 1
+        self._open()
+        os.write(old[0], b'done\r\n')
+        await asyncio.sleep(self.boot_time)
+        self._close(old)
+
+    def _execute(self, words):
+        command = words[0]
+        if command == 'settings' and words[1:] == ['load']:
+            return '[00:00:00.448,427] <inf> bt_hci_core: Identity: {} (random)\r\n'.format(
+                self.identity)
+        if command == 'settings' and words[1:] == ['clear']:
+            self.bonds = {}
+            return ''
+        if command == 'central_setup':
+            self.identity = words[1]
+            return ''
+        if command == 'stats' and words[1:] == ['bonds']:
+            return ''.join('[{}] keys: 34, flags: 17\r\n'.format(addr) for addr in self.bonds)
+        if command == 'stats' and words[1:] == ['spacekey']:
+            return ''.join('[{}] : {}...\r\n'.format(addr, spacekey[:2].upper())
+                           for addr, spacekey in self.bonds.items())
+        if command == 'coin' and words[1] == 'add' and len(words) == 6:
+            self.bonds[words[2]] = words[5]
+            return ''
+        if command == 'coin' and words[1] == 'del' and len(words) == 3:
+            if self.bonds.pop(words[2], None) is None:
+                return '<err> app: coin not found\r\n'
+            return ''
+        if command == 'ble_start':
+            self.scanning = True
+            return '<inf> app: Bluetooth initialized\r\n' \
+                '<inf> app: Scanning successfully started\r\n'
+        return '{}: command not found\r\n'.format(command)
+
+    # a status line of the scanning central, like a coin opening the door
+    def status(self, line):
+        self._write('[00:00:10.000,000] <inf> app: {}\r\n'.format(line))
+
+    async def close(self):
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._close(self._pty)
+        os.remove(self.link)
+
+
+# a shell that answers each command from `replies`, {command: output lines}.
+# A reply of None hangs the shell, it doesn't answer that command or any later one.
+# Unknown commands just print `done`.
+class ScriptedShell:
+    def __init__(self, replies):
+        self.replies = replies
+        self.written = []
+        self.hung = False
+        self._lines = asyncio.Queue()
+
+    def write(self, data):
+        command = data.decode().strip()
+        self.written.append(command)
+        reply = self.replies.get(command, [])
+        self.hung = self.hung or reply is None
+        if self.hung:
+            return
+        for line in ['uart:~$ ' + command] + reply + ['done']:
+            self._lines.put_nowait(line + '\r\n')
+
+    # a status line of the scanning central in between the command output
+    def log(self, line):
+        self._lines.put_nowait(line + '\r\n')
+
+    async def readline(self):
+        return await self._lines.get()
+
+
+def test_command_errors():
+    from serialmgr import CommandChannel
+    shell = ScriptedShell({
+        'coin del C0:00:00:00:00:01': ['<err> app: coin not found'],
+        'bogus': ['bogus: command not found'],
+        'coin add': ['coin add: wrong parameter count'],
+    })
+    # log messages of anything else running on the central don't fail a command
+    shell.log('[00:00:10.000,000] <wrn> bt_conn: Connection failed, error 0x3e')
+    shell.log('[00:00:10.000,000] <err> bt_smp: pairing error')
+    results = asyncio.run(CommandChannel(shell, window=2).execute(
+        ['stats bonds', 'coin del C0:00:00:00:00:01', 'bogus', 'coin add', 'ble_start']))
+    assert [r.command for r in results] == shell.written
+    assert [r.ok for r in results] == [True, False, False, False, True]
+
+
+def test_command_timeout():
+    from serialmgr import CommandChannel
+    shell = ScriptedShell({'coin del C0:00:00:00:00:02': None})
+    commands = ['coin del C0:00:00:00:00:0{}'.format(i) for i in range(1, 7)]
+    results = asyncio.run(CommandChannel(shell, window=3, timeout=0.1).execute(commands))
+    # the batch ends at the timeout, everything from the silent command on fails
+    assert [r.command for r in results] == commands
+    assert [r.ok for r in results] == [True] + [False] * 5
+    assert shell.written == commands[:4]
+
+
+def test_plan_sync():
+    from key_db import KeykeeperDB
+    from serialmgr import plan_sync
+    directory = tempfile.mkdtemp()
+    try:
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        db.generate_coins(['alice', 'bob', 'carol'])
+        alice, bob, carol = (db.coins[db.names[name]] for name in ('alice', 'bob', 'carol'))
+        identity = db.identity[0]
+
+        def actions(plan):
+            return sorted((step.action, step.address) for step in plan)
+
+        # a fresh central gets the identity and every coin
+        plan = plan_sync(None, [], [], db)
+        assert plan[0].action == 'setup'
+        assert actions(plan[1:]) == sorted(('add', c.address_str) for c in (alice, bob, carol))
+
+        # alice is in sync, bob's spacekey is stale and a removed coin is left
+        gone = 'C0:00:00:00:00:01'
+        spacekeys = [(alice.address_str, '{:02X}'.format(alice.spacekey[0])),
+                     (bob.address_str, '{:02X}'.format(bob.spacekey[0] ^ 0xff)),
+                     (gone, '12')]
+        bonds = [(addr,) for addr, _ in spacekeys]
+        assert actions(plan_sync(identity, bonds, spacekeys, db)) == sorted([
+            ('del', bob.address_str), ('del', gone),
+            ('add', bob.address_str), ('add', carol.address_str)])
+
+        # a central of another identity or with a bond lacking its spacekey
+        # starts over from scratch
+        for central_identity, central_bonds in (('C0:FF:FF:FF:FF:FF', bonds),
+                                                (identity, bonds + [(carol.address_str,)])):
+            plan = plan_sync(central_identity, central_bonds, spacekeys, db)
+            assert [step.action for step in plan[:2]] == ['clear', 'setup']
+            assert actions(plan[2:]) == sorted(
+                ('add', c.address_str) for c in (alice, bob, carol))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_plan_changes():
+    from key_db import KeykeeperDB
+    from serialmgr import plan_changes
+    directory = tempfile.mkdtemp()
+    try:
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        db.generate_coins(['alice', 'bob', 'carol'])
+        alice, carol = (db.coins[db.names[name]].address_str for name in ('alice', 'carol'))
+        changes = []
+        db.subscribe(changes.extend)
+        db.remove_coin('alice')
+        db.rekey_coin('carol')
+        db.generate_coins(['dave', 'eve'])
+        db.remove_coin('eve')
+        new_carol, dave = (db.coins[db.names[name]].address_str for name in ('carol', 'dave'))
+        steps, resync = plan_changes(changes)
+        # eve came and went within the batch, she never reaches the central
+        assert not resync
+        assert sorted((step.action, step.address) for step in steps) == sorted([
+            ('del', alice), ('del', carol), ('add', new_carol), ('add', dave)])
+
+        changes.clear()
+        db.generate_identity()
+        assert plan_changes(changes) == ([], True)
+    finally:
+        shutil.rmtree(directory)
+
+
+# a change made while a batch is being pushed isn't on the central yet, the sync
+# state must not claim it is
+def test_push_fingerprint():
+    from key_db import KeykeeperDB
+    from serialmgr import KeykeeperSerialMgr
+
+    async def push(directory):
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        mgr = KeykeeperSerialMgr(db, [].append,
+                                 sync_state_file=os.path.join(directory, 'sync_state.json'))
+        mgr.identity = db.identity[0]
+        mgr.central_serial = ScriptedShell({})
+        db.generate_coin('alice')
+        write = mgr.central_serial.write
+
+        def write_then_add(data):
+            if 'bob' not in db.names:
+                db.generate_coin('bob')
+            write(data)
+        mgr.central_serial.write = write_then_add
+        await mgr._push_changes()
+        return db, mgr
+
+    directory = tempfile.mkdtemp()
+    try:
+        db, mgr = asyncio.run(push(directory))
+        assert len(mgr.central_serial.written) == 1
+        assert mgr._changes
+        assert not mgr.sync_state.is_synced(db.identity[0], len(db.coins), db.fingerprint())
+        db.remove_coin('bob')
+        assert mgr.sync_state.is_synced(db.identity[0], len(db.coins), db.fingerprint())
+    finally:
+        shutil.rmtree(directory)
+
+
+# centrals of `doors` fake doors get synced, then a batch of new members is rolled
+# out to all of them, returns the seconds the initial sync and the rollout took
+async def _sync_doors(doors, coins=20, new_coins=10, command_delay=0.02):
+    from key_db import KeykeeperDB
+    from serialmgr import KeykeeperCentrals
+    from status_bus import EventKind
+    directory = tempfile.mkdtemp()
+    try:
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        db.generate_coins(['member{}'.format(i) for i in range(coins)])
+        fakes = [FakeCentral(directory, 'door{}'.format(i), command_delay).start()
+                 for i in range(doors)]
+        events = []
+        centrals = KeykeeperCentrals(
+            db, events.append, os.path.join(directory, 'usb-ZEPHYR_N39_BLE_KEYKEEPER_*-if00'),
+            sync_state_file=os.path.join(directory, 'sync_state.json'))
+        started = time.perf_counter()
+        task = asyncio.ensure_future(centrals.run_async())
+        await asyncio.wait_for(centrals.wait_synced(), 30)
+        synced = time.perf_counter() - started
+
+        # wait until every door scans again before changing the database
+        while not all(fake.scanning for fake in fakes):
+            await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        db.generate_coins(['new{}'.format(i) for i in range(new_coins)])
+        await asyncio.sleep(0)
+        await asyncio.wait_for(centrals.wait_synced(), 30)
+        rolled_out = time.perf_counter() - started
+
+        expected = {coin.address_str for coin in db.coins.values()}
+        for fake in fakes:
+            assert set(fake.bonds) == expected, fake.door
+            assert fake.identity == db.identity[0]
+        doors_seen = {event.door for event in events if event.kind == EventKind.CENTRAL_STATUS}
+        assert doors_seen == {'door{}'.format(i) for i in range(doors)}, doors_seen
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        for fake in fakes:
+            await fake.close()
+        return synced, rolled_out
+    finally:
+        shutil.rmtree(directory)
+
+
+# a door unplugged while the others get a rekeyed coin has to catch up once
+# it's back, even though the others already synced that database
+def test_unplugged_door_resyncs():
+    from key_db import KeykeeperDB
+    from serialmgr import KeykeeperCentrals
+
+    async def sync(db, directory):
+        centrals = KeykeeperCentrals(
+            db, [].append, os.path.join(directory, 'usb-ZEPHYR_N39_BLE_KEYKEEPER_*-if00'),
+            sync_state_file=os.path.join(directory, 'sync_state.json'))
+        task = asyncio.ensure_future(centrals.run_async())
+        await asyncio.wait_for(centrals.wait_synced(), 30)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def run(directory):
+        db = KeykeeperDB(os.path.join(directory, 'db.json'))
+        db.generate_coins(['member{}'.format(i) for i in range(5)])
+        door_a = FakeCentral(directory, 'A').start()
+        door_b = FakeCentral(directory, 'B').start()
+        await sync(db, directory)
+        await door_b.close()
+        db.rekey_coin('member0')
+        await sync(db, directory)
+        door_b.start()
+        await sync(db, directory)
+        expected = {coin.address_str for coin in db.coins.values()}
+        assert set(door_a.bonds) == expected
+        assert set(door_b.bonds) == expected
+        await door_a.close()
+        await door_b.close()
+
+    directory = tempfile.mkdtemp()
+    try:
+        asyncio.run(run(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_parallel_sync():
+    synced, rolled_out = asyncio.run(_sync_doors(3, new_coins=10, command_delay=0.05))
+    # 0.5 s of batching and ten 50 ms commands per door, one door after
+    # the other would take 2 s
+    assert rolled_out < 0.5 + 2 * 10 * 0.05
+
+
+# time the sync of 1 to max_doors doors, they should all take about as long as one
+def _bench_doors(max_doors=4, coins=50, new_coins=20):
+    for doors in range(1, max_doors + 1):
+        synced, rolled_out = asyncio.run(_sync_doors(doors, coins, new_coins))
+        print("{} doors: initial sync {:.2f} s, {} new coins rolled out in {:.2f} s".format(
+            doors, synced, new_coins, rolled_out))
+
+
+# fake centrals for keykeeper-mgr.py, started with
+# KEYKEEPER_CENTRALS='<directory>/usb-ZEPHYR_N39_BLE_KEYKEEPER_*-if00'
+async def _run_fake_centrals(directory, doors):
+    os.makedirs(directory, exist_ok=True)
+    fakes = [FakeCentral(directory, 'door{}'.format(i), 0.01).start() for i in range(doors)]
+    for fake in fakes:
+        print("door {} on {}".format(fake.door, fake.link))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for fake in fakes:
+            await fake.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench_doors(*map(int, sys.argv[2:5]))
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'run':
+        asyncio.run(_run_fake_centrals(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 2))
+    else:
+        print("usage: {} bench [doors] [coins] [new coins] | run <directory> [doors]".format(
+            sys.argv[0]))
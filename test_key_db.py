@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from key_db import KeykeeperDB, KeykeeperSQLiteDB, RecordCipher, migrate_json_to_sqlite
+
+
+# everything a database holds, comparable across backends
+def _state(db):
+    return list(db.identity), dict(db.coins.items()), dict(db.names.items())
+
+
+# members added, rekeyed and removed over several saves
+def _fill(db):
+    db.generate_coins(['alice', 'bob', 'carol'])
+    db.save()
+    db.rekey_coin('bob')
+    db.remove_coin('carol')
+    db.save()
+    db.generate_coin('dave')
+    db.save()
+
+
+# each backend, plain and with a password, comes back the same after a reopen
+def test_roundtrip():
+    for cls, name in [(KeykeeperDB, 'db.json'), (KeykeeperSQLiteDB, 'db.sqlite')]:
+        for passw in ['', 'secret']:
+            directory = tempfile.mkdtemp()
+            try:
+                filename = os.path.join(directory, name)
+                db = cls(filename, passw)
+                _fill(db)
+                state = _state(db)
+                fingerprint = db.fingerprint()
+                db.close()
+                db = cls(filename, passw)
+                assert _state(db) == state, (cls, passw)
+                assert db.fingerprint() == fingerprint
+                assert sorted(db.names) == ['alice', 'bob', 'dave']
+                assert db.name_of(db.names['bob']) == 'bob'
+                db.close()
+                # no key is stored in the clear with a password
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                coin = state[1][state[2]['alice']]
+                assert (coin.hex_keys()[1].encode() in data) == (passw == ''), (cls, passw)
+            finally:
+                shutil.rmtree(directory)
+
+
+# changes after the snapshot are replayed from the journal, a torn last
+# record is dropped
+def test_journal_replay():
+    for passw in ['', 'secret']:
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'db.json')
+            db = KeykeeperDB(filename, passw)
+            db.save()
+            with open(filename, 'rb') as f:
+                snapshot = f.read()
+            _fill(db)
+            state = _state(db)
+            db.close()
+            # the snapshot is untouched, everything is in the journal
+            with open(filename, 'rb') as f:
+                assert f.read() == snapshot
+            assert _state(KeykeeperDB(filename, passw)) == state
+            with open(filename + '.journal', 'a') as f:
+                f.write('{"op": "add", "na')
+            assert _state(KeykeeperDB(filename, passw)) == state
+        finally:
+            shutil.rmtree(directory)
+
+
+# a journal past its threshold is folded into the snapshot
+def test_compaction():
+    for passw in ['', 'secret']:
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'db.json')
+            db = KeykeeperDB(filename, passw)
+            db.save()
+            db._store.compact_threshold = 1000
+            for i in range(20):
+                db.generate_coin('member{}'.format(i))
+                db.save()
+            state = _state(db)
+            db.close()
+            assert os.path.getsize(filename + '.journal') < 1000 + 1000
+            with open(filename) as f:
+                snapshot = json.load(f)
+            stored = snapshot['encrypted']['coins'] if passw else snapshot['names']
+            assert len(stored) >= 10
+            assert _state(KeykeeperDB(filename, passw)) == state
+        finally:
+            shutil.rmtree(directory)
+
+
+# a compaction folds in what is saved, changes made since stay out of the snapshot
+def test_compaction_skips_unsaved():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'db.json')
+        db = KeykeeperDB(filename)
+        db.save()
+        db.generate_coin('alice')
+        db.save()
+        db.generate_coin('bob')
+        db._store.compact_async(db._capture, db._lock)
+        db._store.wait_for_compaction()
+        with open(filename) as f:
+            assert list(json.load(f)['names']) == ['alice']
+        assert os.path.getsize(filename + '.journal') == 0
+        assert list(KeykeeperDB(filename).names) == ['alice']
+        db.close()
+        assert sorted(KeykeeperDB(filename).names) == ['alice', 'bob']
+    finally:
+        shutil.rmtree(directory)
+
+
+# the keys of a JSON database end up in SQLite, still under the password
+def test_migrate_json_to_sqlite():
+    for passw in ['', 'secret']:
+        directory = tempfile.mkdtemp()
+        try:
+            json_filename = os.path.join(directory, 'db.json')
+            sqlite_filename = os.path.join(directory, 'db.sqlite')
+            db = KeykeeperDB(json_filename, passw)
+            _fill(db)
+            state = _state(db)
+            db.close()
+            migrate_json_to_sqlite(json_filename, sqlite_filename, passw).close()
+            db = KeykeeperSQLiteDB(sqlite_filename, passw)
+            assert _state(db) == state
+            db.close()
+            if passw:
+                try:
+                    KeykeeperSQLiteDB(sqlite_filename, 'wrong')
+                    raise AssertionError("opened with a wrong password")
+                except ValueError:
+                    pass
+        finally:
+            shutil.rmtree(directory)
+
+
+# a record only opens with the password and where it was sealed
+def test_record_cipher():
+    cipher = RecordCipher('secret', iterations=1000)
+    token = cipher.seal('keys', 'C0:00:00:00:00:01')
+    assert cipher.open(token, 'C0:00:00:00:00:01') == 'keys'
+    assert RecordCipher.from_params('secret', cipher.params()).open(
+        token, 'C0:00:00:00:00:01') == 'keys'
+    for other, aad in [(cipher, 'C0:00:00:00:00:02'),
+                       (RecordCipher.from_params('wrong', cipher.params()), 'C0:00:00:00:00:01')]:
+        try:
+            other.open(token, aad)
+            raise AssertionError("opened with {}".format(aad))
+        except ValueError:
+            pass
+
+
+# unlocking with a wrong password raises instead of handing out garbage
+def test_wrong_password():
+    for cls, name in [(KeykeeperDB, 'db.json'), (KeykeeperSQLiteDB, 'db.sqlite')]:
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, name)
+            db = cls(filename, 'secret')
+            _fill(db)
+            db.close()
+            try:
+                cls(filename, 'wrong')
+                raise AssertionError("{} opened with a wrong password".format(cls.__name__))
+            except ValueError:
+                pass
+        finally:
+            shutil.rmtree(directory)
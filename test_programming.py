@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 
+import asyncio
+import contextlib
+import io
 import os
 import sys
 import time
@@ -195,8 +198,521 @@ def test_program_verification_fail():
     print("shutdown command invoked")
     print("")
 
+# canned output of one of the test functions above
+def canned_output(name):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        globals()['test_' + name]()
+    return output.getvalue()
+
+
+# flash of a simulated coin, pages exist once they are written to
+# `rate` in bytes per second makes writing take time like a real adapter does
+class SimulatedFlash:
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.pages = {}
+
+    # (page, offset in page, offset in data, length) pieces of a range
+    def _spans(self, addr, size):
+        pos = 0
+        while pos < size:
+            page = (addr + pos) & ~(self.PAGE_SIZE - 1)
+            offset = addr + pos - page
+            n = min(self.PAGE_SIZE - offset, size - pos)
+            yield page, offset, pos, n
+            pos += n
+
+    async def busy(self, size):
+        if self.rate:
+            await asyncio.sleep(size / self.rate)
+
+    def erase(self, start, size):
+        for page, _, _, _ in self._spans(start, size):
+            self.pages.pop(page, None)
+
+    def mass_erase(self):
+        self.pages.clear()
+
+    def write(self, segments):
+        for addr, data in segments:
+            for page, offset, pos, n in self._spans(addr, len(data)):
+                content = self.pages.setdefault(page, bytearray(b'\xff' * self.PAGE_SIZE))
+                content[offset:offset + n] = data[pos:pos + n]
+
+    def read(self, addr, size):
+        out = bytearray()
+        for page, offset, _, n in self._spans(addr, size):
+            content = self.pages.get(page, b'\xff' * self.PAGE_SIZE)
+            out += content[offset:offset + n]
+        return bytes(out)
+
+    # first (address, found, expected) that differs from the segments, None if all match
+    def diff(self, segments):
+        for addr, data in segments:
+            found = self.read(addr, len(data))
+            if found != data:
+                i = next(i for i in range(len(data)) if found[i] != data[i])
+                return addr + i, found[i], data[i]
+        return None
+
+
+# stands in for openocd's TCL RPC port and answers oocd.OpenOCDSession
+# from the canned outputs above, `chip` is 'unlocked', 'locked' or 'notfound'
+# images that exist as files are written to `flash`
+class FakeOpenOCDTclServer:
+    TERMINATOR = b'\x1a'
+
+    def __init__(self, chip='unlocked', program='program', port=0, flash=None):
+        self.chip = chip
+        self.program = program
+        self.port = port
+        self.flash = flash if flash is not None else SimulatedFlash()
+        self.commands = []
+        # names of commands openocd gets stuck in
+        self.hang = set()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                command = (await reader.readuntil(self.TERMINATOR))[:-1].decode('utf8')
+                self.commands.append(command)
+                if command == 'shutdown':
+                    break
+                if command.split(' ', 1)[0] in self.hang:
+                    # stuck until the client gives up on it
+                    await reader.read()
+                    break
+                reply = await self._reply(command)
+                writer.write(reply.encode('utf8') + self.TERMINATOR)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def _reply(self, command):
+        name = command.split(' ', 1)[0]
+        if name == 'keykeeper_check':
+            return self.chip
+        if name == 'keykeeper_recover':
+            if self.chip == 'notfound':
+                return 'notfound'
+            self.chip = 'unlocked'
+            self.flash.mass_erase()
+            return 'ok'
+        if name == 'keykeeper_lock':
+            if self.chip == 'notfound':
+                return 'failed'
+            self.chip = 'locked'
+            return 'ok'
+        if name == 'keykeeper_write':
+            if self.chip != 'unlocked':
+                return 'Error: nrf52.cpu -- clearing lockup after double fault'
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(None, canned_output, self.program)
+            # the log of write_image, openocd's program adds the start marker and
+            # verifies right away, here that is a command of its own
+            output = output.partition('** Verify Started **')[0].replace(
+                '** Programming Started **', '')
+            segments = self._image(command)
+            if segments is not None and self.program == 'program':
+                for addr, data in segments:
+                    self.flash.erase(addr, len(data))
+                self.flash.write(segments)
+                await self.flash.busy(2 * sum(len(data) for _, data in segments))
+            return output
+        if name == 'keykeeper_verify':
+            if self.chip != 'unlocked':
+                return 'Error: nrf52.cpu -- clearing lockup after double fault'
+            return await self._verify(self._image(command) or [])
+        if name == 'keykeeper_program_range':
+            if self.chip != 'unlocked':
+                return 'Error: nrf52.cpu -- clearing lockup after double fault'
+            segments = self._image(command) or []
+            start, size = (int(n, 0) for n in command.rsplit(' ', 2)[1:])
+            self.flash.erase(start, size)
+            self.flash.write(segments)
+            written = sum(len(data) for _, data in segments)
+            await self.flash.busy(max(written, size))
+            return 'wrote {} bytes from file {}\n'.format(written, self._filename(command)) + \
+                await self._verify(segments)
+        return ''
+
+    # the file name in braces of a keykeeper_* command
+    def _filename(self, command):
+        return command[command.index('{') + 1:command.index('}')]
+
+    # segments of the image file of a command, None if there is no such file
+    def _image(self, command):
+        from coin_image import parse_hex
+        try:
+            with open(self._filename(command)) as f:
+                return parse_hex(f)[0]
+        except (ValueError, OSError):
+            return None
+
+    # output of verify_image, the target computes checksums much faster than it writes
+    async def _verify(self, segments):
+        size = sum(len(data) for _, data in segments)
+        await self.flash.busy(size / 20)
+        diff = self.flash.diff(segments)
+        if diff is None:
+            return 'verified {} bytes in 0.1s'.format(size)
+        return 'checksum mismatch - attempting binary compare\n' \
+            'diff 0 address 0x{:08x}. Was 0x{:02x} instead of 0x{:02x}\n' \
+            'No more differences found.'.format(*diff)
+
+
+# a coin that already runs the firmware only gets its key page rewritten,
+# one of another member keeps nothing but the firmware
+def test_rekey():
+    from coin_image import FirmwareTemplate, parse_hex, _synthetic_base
+    from key_db import _coin_material
+    import oocd
+    template = FirmwareTemplate(*_synthetic_base())
+    first, second = _coin_material(2, set())
+    no_power = lambda: None
+
+    async def rekey():
+        server = await FakeOpenOCDTclServer().start()
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            assert (await session.rekey(template, first, no_power, no_power)).ok
+            # the coin comes back unlocked, with the firmware still on it
+            server.chip = 'unlocked'
+            before = {page: bytes(content) for page, content in server.flash.pages.items()}
+            del server.commands[:]
+            result = await session.rekey(template, second, no_power, no_power)
+        await server.close()
+        return server, before, result
+
+    server, before, result = asyncio.run(rekey())
+    assert result.ok, result
+    assert not any(command.startswith('keykeeper_program ') for command in server.commands)
+    assert sum(command.startswith('keykeeper_program_range ')
+               for command in server.commands) == 1
+    changed = {page for page in set(before) | set(server.flash.pages)
+               if before.get(page) != server.flash.pages.get(page)}
+    assert changed == {template.key_page}
+    assert server.flash.diff(parse_hex(template.image(second).splitlines())[0]) is None
+
+
+# every station needs an openocd port of its own, progress without a status
+# pipe goes nowhere
+def test_station_ports():
+    from stations import Station, SimulatedStation, StationScheduler
+    from status_bus import StationStatus
+    try:
+        StationScheduler([Station('a', 6666), Station('b', 6666, power_pin=19)])
+        raise AssertionError("stations sharing a port were accepted")
+    except ValueError:
+        pass
+    scheduler = StationScheduler([Station('a', 6666), Station('b', 6667, power_pin=19),
+                                  SimulatedStation('c'), SimulatedStation('d')])
+    scheduler.progress = {'a': 'idle'}
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        scheduler._report('a')
+    assert out.getvalue() == ''
+    events = []
+    scheduler.status_pipe = events.append
+    scheduler._report('a')
+    assert events == [StationStatus('a', 'idle')]
+
+
+# a reply to keykeeper_check that isn't a state fails the coin, it doesn't
+# count as a locked one that gets erased
+def test_check_garbage_reply():
+    import shutil
+    import tempfile
+    import oocd
+    no_power = lambda: None
+    garbage = 'Error: nrf52.cpu -- clearing lockup after double fault'
+
+    async def check(directory):
+        server = await FakeOpenOCDTclServer().start()
+        server.chip = garbage
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            try:
+                await session.check()
+                raise AssertionError("garbage taken for a state")
+            except ValueError:
+                pass
+            result = await session.provision('coin.hex', no_power, no_power)
+            queue = _provisioning_queue(directory, session)
+            queue.enqueue(['alice'])
+            errors = await queue.run(['alice'])
+            step = queue.journal.jobs['alice'].step
+            queue.close()
+        await server.close()
+        return server, result, errors, step
+
+    directory = tempfile.mkdtemp()
+    try:
+        server, result, errors, step = asyncio.run(check(directory))
+    finally:
+        shutil.rmtree(directory)
+    assert not result.ok
+    assert garbage in result.error
+    assert garbage in errors['alice']
+    assert step == 'image'
+    assert 'keykeeper_recover' not in server.commands
+    assert not server.flash.pages
+
+
+# progress is reported phase by phase, while the coin is being written
+def test_program_progress():
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import _coin_material
+    import oocd
+    template = FirmwareTemplate(*_synthetic_base())
+    coin, = _coin_material(1, set())
+
+    async def program():
+        server = await FakeOpenOCDTclServer(flash=SimulatedFlash(200000)).start()
+        progress = []
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            with template.temp_image(coin) as image:
+                outcome = await session.program_and_verify(
+                    image, lambda event: progress.append((event.step, list(server.commands))))
+        await server.close()
+        return outcome, progress
+
+    outcome, progress = asyncio.run(program())
+    assert outcome == (True, True)
+    steps = [step for step, _ in progress]
+    assert [step for step in steps if step != 'ERASE_RANGE' and step != 'CHIP_DETECTED'] == [
+        'PROGRAMMING_STARTED', 'PROGRAMMING_FINISHED', 'VERIFY_STARTED', 'VERIFY_RESULT']
+    # writing had not been sent when it was reported as started, verifying
+    # was reported before it was sent
+    assert not any(c.startswith('keykeeper_write') for c in progress[0][1])
+    verify_started = progress[steps.index('VERIFY_STARTED')][1]
+    assert not any(c.startswith('keykeeper_verify') for c in verify_started)
+
+
+# a verification openocd gets stuck in is given up after the verify timeout
+def test_program_phase_timeout():
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import _coin_material
+    import oocd
+    template = FirmwareTemplate(*_synthetic_base())
+    coin, = _coin_material(1, set())
+    timeouts = dict(oocd.PHASE_TIMEOUTS, verifying=0.2)
+
+    async def program():
+        server = await FakeOpenOCDTclServer().start()
+        server.hang.add('keykeeper_verify')
+        progress = []
+        async with oocd.OpenOCDSession(port=server.port, spawn=False,
+                                       timeouts=timeouts) as session:
+            with template.temp_image(coin) as image:
+                started = time.perf_counter()
+                outcome = await session.program_and_verify(image, progress.append)
+                elapsed = time.perf_counter() - started
+        await server.close()
+        return outcome, progress, elapsed
+
+    outcome, progress, elapsed = asyncio.run(program())
+    assert outcome == (True, False)
+    assert progress[-1].step == 'TIMEOUT'
+    assert 'verifying' in progress[-1].text
+    assert elapsed < oocd.PHASE_TIMEOUTS['verifying']
+
+
+def test_provisioning_resume():
+    import shutil
+    import tempfile
+    from provisioning import _test_resume
+    directory = tempfile.mkdtemp()
+    try:
+        asyncio.run(_test_resume(5, directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+# a provisioning queue in `directory`, programming through `session`
+def _provisioning_queue(directory, session):
+    from coin_image import FirmwareTemplate, _synthetic_base
+    from key_db import KeykeeperDB
+    from provisioning import ProvisioningQueue
+    no_power = lambda: None
+    queue = ProvisioningQueue(
+        KeykeeperDB(os.path.join(directory, 'db.json')), FirmwareTemplate(*_synthetic_base()),
+        session, os.path.join(directory, 'provisioning.journal'),
+        os.path.join(directory, 'images'), power_on=no_power, power_off=no_power)
+    queue.POLL_INTERVAL = 0.05
+    return queue
+
+
+# a failed coin stays queued but isn't written onto the next member's coin
+def test_provisioning_runs_named_jobs():
+    import shutil
+    import tempfile
+    from coin_image import parse_hex
+    import oocd
+
+    async def provision(directory):
+        server = await FakeOpenOCDTclServer(program='program_fail').start()
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            queue = _provisioning_queue(directory, session)
+            queue.enqueue(['alice'])
+            alice_errors = await queue.run(['alice'])
+            server.program = 'program'
+            queue.enqueue(['bob'])
+            bob_errors = await queue.run(['bob'])
+            steps = {job.name: job.step for job in queue.journal.jobs.values()}
+            bob = queue.db.coins[queue.db.names['bob']]
+            image = parse_hex(queue.template.image(bob).splitlines())[0]
+            queue.close()
+        await server.close()
+        return alice_errors, bob_errors, steps, server.flash.diff(image)
+
+    directory = tempfile.mkdtemp()
+    try:
+        alice_errors, bob_errors, steps, diff = asyncio.run(provision(directory))
+    finally:
+        shutil.rmtree(directory)
+    assert alice_errors == {'alice': 'programming failed'}
+    assert bob_errors == {}
+    assert steps == {'alice': 'image', 'bob': 'synced'}
+    assert diff is None
+
+
+# a member with a finished coin doesn't get a copy of it, only a replacement
+# with new keys when asked for
+def test_provisioning_replaces_coin():
+    import shutil
+    import tempfile
+    from key_db import addr_key
+    from provisioning import _simulated_jig
+    import oocd
+
+    async def provision(directory):
+        server = await FakeOpenOCDTclServer().start()
+        jig = asyncio.ensure_future(_simulated_jig(server, handling=0.05))
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            queue = _provisioning_queue(directory, session)
+            queue.enqueue(['alice'])
+            assert await queue.run(['alice']) == {}
+            first = queue.journal.jobs['alice'].address
+            refused = queue.enqueue(['alice'])
+            assert queue.journal.jobs['alice'].step == 'synced'
+            assert queue.enqueue(['alice'], replace=True) == {}
+            second = queue.journal.jobs['alice'].address
+            errors = await queue.run(['alice'])
+            db = queue.db
+            queue.close()
+        jig.cancel()
+        await server.close()
+        return refused, errors, first, second, db
+
+    directory = tempfile.mkdtemp()
+    try:
+        refused, errors, first, second, db = asyncio.run(provision(directory))
+    finally:
+        shutil.rmtree(directory)
+    assert refused == {'alice': 'has a coin already'}
+    assert errors == {}
+    assert first != second
+    assert addr_key(first) not in db.coins
+    assert db.coins[db.names['alice']].address_str == second
+
+
+# the journal lost the lock of a verified coin, the coin is kept as it is
+def test_provisioning_verified_coin_locked():
+    import shutil
+    import tempfile
+    import oocd
+
+    async def provision(directory):
+        server = await FakeOpenOCDTclServer().start()
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            queue = _provisioning_queue(directory, session)
+            queue.enqueue(['alice'])
+            record = queue.journal.record
+
+            # power loss right after locking, before the journal has it
+            def lost_lock(name, step, address=None):
+                if step == 'locked':
+                    raise KeyboardInterrupt()
+                record(name, step, address)
+            queue.journal.record = lost_lock
+            try:
+                await queue.run(['alice'])
+            except KeyboardInterrupt:
+                pass
+            queue.journal.record = record
+            flash = dict(server.flash.pages)
+            del server.commands[:]
+            errors = await queue.resume()
+            step = queue.journal.jobs['alice'].step
+            queue.close()
+        await server.close()
+        return errors, step, server.commands, flash == server.flash.pages
+
+    directory = tempfile.mkdtemp()
+    try:
+        errors, step, commands, unchanged = asyncio.run(provision(directory))
+    finally:
+        shutil.rmtree(directory)
+    assert errors == {}
+    assert step == 'synced'
+    assert 'keykeeper_recover' not in commands
+    assert 'keykeeper_write' not in commands
+    assert unchanged
+
+
+# a locked coin left on the jig is someone's, it is waited out instead of erased
+def test_provisioning_keeps_locked_coin():
+    import shutil
+    import tempfile
+    from provisioning import _simulated_jig
+    import oocd
+
+    async def provision(directory):
+        server = await FakeOpenOCDTclServer(chip='locked').start()
+        jig = asyncio.ensure_future(_simulated_jig(server, handling=0.1))
+        async with oocd.OpenOCDSession(port=server.port, spawn=False) as session:
+            queue = _provisioning_queue(directory, session)
+            queue.enqueue(['alice'])
+            errors = await queue.run(['alice'])
+            queue.close()
+        jig.cancel()
+        await server.close()
+        return errors, server.commands
+
+    directory = tempfile.mkdtemp()
+    try:
+        errors, commands = asyncio.run(provision(directory))
+    finally:
+        shutil.rmtree(directory)
+    assert errors == {}
+    assert 'keykeeper_recover' not in commands
+
+
+async def _run_fake_tcl_server(port, chip):
+    server = await FakeOpenOCDTclServer(chip, port=port).start()
+    print("fake openocd TCL server with {} chip on port {}".format(chip, server.port))
+    await asyncio.Event().wait()
+
+
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2 and sys.argv[1] == 'tcl_server':
+        asyncio.run(_run_fake_tcl_server(
+            int(sys.argv[2]) if len(sys.argv) > 2 else 6666,
+            sys.argv[3] if len(sys.argv) > 3 else 'unlocked'))
+    elif len(sys.argv) == 2:
         if sys.argv[1] == 'check_unlocked':
             test_check_unlocked()
         elif sys.argv[1] == 'check_locked':
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+import random
+
+from status_bus import (encode, FrameDecoder, CentralStatus, CoinSeen, BatteryLevel,
+                        CoinAuthenticated, CoinProgress, StationStatus, _HEADER)
+
+
+def _events():
+    return [CentralStatus("syncing", 'front'), CoinSeen('C0:11:22:33:44:55', -60),
+            BatteryLevel('C0:11:22:33:44:55', 87, 'front'),
+            CoinAuthenticated('jürgen', 'C0:11:22:33:44:55', 87, 'workshop'),
+            CoinProgress('PROGRAMMING_STARTED', ''), StationStatus('sim0', "1 done"),
+            CentralStatus("")]
+
+
+# events come out the same however the pipe cut their frames
+def test_frames_split_anywhere():
+    events = _events()
+    data = b''.join(map(encode, events))
+    for cut in range(len(data) + 1):
+        decoder = FrameDecoder()
+        assert decoder.feed(data[:cut]) + decoder.feed(data[cut:]) == events, cut
+    decoder = FrameDecoder()
+    assert sum((decoder.feed(data[i:i + 1]) for i in range(len(data))), []) == events
+    rng = random.Random(1)
+    for _ in range(100):
+        cuts = sorted(rng.sample(range(len(data)), 5)) + [len(data)]
+        decoder = FrameDecoder()
+        decoded = []
+        start = 0
+        for end in cuts:
+            decoded += decoder.feed(data[start:end])
+            start = end
+        assert decoded == events, cuts
+
+
+# a frame of a kind the reader doesn't know is skipped, the ones around it aren't
+def test_unknown_kind():
+    events = _events()
+    payload = b'["from a newer sender"]'
+    unknown = _HEADER.pack(200, len(payload)) + payload
+    data = encode(events[0]) + unknown + b''.join(map(encode, events[1:])) + unknown
+    decoder = FrameDecoder()
+    decoded = []
+    for i in range(0, len(data), 7):
+        decoded += decoder.feed(data[i:i + 7])
+    assert decoded == events
+    assert decoder.feed(b'') == []